@@ -0,0 +1,1271 @@
+import argparse
+import asyncio
+import contextlib
+import gzip
+import json
+import io
+import os
+import platform
+import random
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import websockets
+
+import daemon
+
+
+# -----------------------------
+# SYNTHETIC GCODE
+# -----------------------------
+"""
+Writes a file that looks like an OrcaSlicer export: small header, a big toolpath body, then the filament summary and the config block at the end.
+That is where Orca puts the two keys the daemon needs, so it is the worst case for the old forward scan.
+"""
+def write_synthetic_gcode(path, size_mb, presets, grams, seed=0):
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+
+    with open(path, "w") as f:
+        f.write("; HEADER_BLOCK_START\n; generated by OrcaSlicer 2.1.1\n; total layer number: 500\n; HEADER_BLOCK_END\nM83\n")
+
+        # Build one chunk of moves and repeat it, generating every line is far slower than the parser we are measuring
+        lines = []
+        for layer in range(200):
+            lines.append(f";LAYER_CHANGE\n;Z:{layer * 0.2:.2f}\nG1 Z{layer * 0.2:.2f} F600\n")
+            if len(grams) > 1:
+                lines.append(f"T{layer % len(grams)}\n")
+            for _ in range(20):
+                lines.append(f"G1 X{rng.uniform(0, 256):.3f} Y{rng.uniform(0, 256):.3f} E{rng.uniform(0, 2):.5f}\n")
+        chunk = "".join(lines)
+
+        written = f.tell()
+        while written < target:
+            f.write(chunk)
+            written += len(chunk)
+
+        f.write("; filament used [mm] = " + ", ".join(f"{g * 330:.2f}" for g in grams) + "\n")
+        f.write("; filament used [cm3] = " + ", ".join(f"{g / 1.24:.2f}" for g in grams) + "\n")
+        f.write("; filament used [g] = " + ", ".join(f"{g:.2f}" for g in grams) + "\n")
+        f.write("; total filament used [g] = " + f"{sum(grams):.2f}" + "\n")
+        f.write("; CONFIG_BLOCK_START\n")
+        for i in range(400):
+            f.write(f"; setting_{i:03d} = {rng.random():.4f}\n")
+        f.write("; filament_settings_id = " + ";".join(f'"{p}"' for p in presets) + "\n")
+        for i in range(400, 800):
+            f.write(f"; setting_{i:03d} = {rng.random():.4f}\n")
+        f.write("; CONFIG_BLOCK_END\n")
+
+
+def write_synthetic_bgcode(path, size_mb, presets, grams, seed=0):
+    """
+    Binary G-code with the same content: metadata blocks first (deflated), then uncompressed G-code blocks.
+    """
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+
+    def block(f, block_type, payload, compress=False):
+        data = zlib.compress(payload) if compress else payload
+        header = struct.pack("<HHI", block_type, 1 if compress else 0, len(payload))
+        if compress:
+            header += struct.pack("<I", len(data))
+        params = struct.pack("<H", 0)  # encoding: INI / plain text
+        f.write(header + params + data)
+        f.write(struct.pack("<I", zlib.crc32(header + params + data)))
+
+    with open(path, "wb") as f:
+        f.write(b"GCDE" + struct.pack("<IH", 1, 1))
+        block(f, 0, b"Producer=OrcaSlicer 2.1.1\n", compress=True)
+        block(f, 3, b"printer_model=Centauri Carbon\n", compress=True)
+        block(f, 4, ("filament used [g]=" + ", ".join(f"{g:.2f}" for g in grams) + "\n" + f"total filament used [g]={sum(grams):.2f}\n").encode(), compress=True)
+        config = "".join(f"setting_{i:03d} = {rng.random():.4f}\n" for i in range(800))
+        config += "filament_settings_id = " + ";".join(f'"{p}"' for p in presets) + "\n"
+        block(f, 2, config.encode(), compress=True)
+
+        chunk = "".join(f"G1 X{rng.uniform(0, 256):.3f} Y{rng.uniform(0, 256):.3f} E{rng.uniform(0, 2):.5f}\n" for _ in range(2000)).encode()
+        while f.tell() < target:
+            block(f, 1, chunk)
+
+
+def write_synthetic_gcode_gz(path, size_mb, presets, grams, seed=0):
+    text_path = path + ".src"
+    write_synthetic_gcode(text_path, size_mb, presets, grams, seed)
+    with open(text_path, "rb") as src, gzip.open(path, "wb", compresslevel=1) as dst:
+        while True:
+            data = src.read(1024 * 1024)
+            if not data:
+                break
+            dst.write(data)
+    os.remove(text_path)
+
+
+def synthetic_presets(count):
+    colors = ["Black", "White", "Red", "Blue", "Green", "Yellow", "Orange", "Purple", "Grey", "Silver", "Gold", "Pink", "Brown", "Cyan", "Magenta", "Transparent"]
+    return [f"ELEGOO - PLA - {colors[i % len(colors)]}" for i in range(count)]
+
+
+# -----------------------------
+# FAKE SPOOLMAN
+# -----------------------------
+"""
+Tiny in-memory stand-in for the Spoolman v1 API. delay is added to every request to mimic a NAS or a busy container.
+late_reply is how long a /use waits after it was applied before it answers, longer than the client timeout loses the reply.
+"""
+def synthetic_spools(count, seed=0):
+    rng = random.Random(seed)
+    vendors = ["ELEGOO", "Sunlu", "Bambu", "Polymaker", "eSUN", "Prusament", "Overture", "Jayo"]
+    materials = ["PLA", "PETG", "ABS", "ASA", "TPU", "PLA+"]
+    colors = ["Black", "White", "Red", "Blue", "Green", "Yellow", "Orange", "Purple", "Grey", "Silver", "Gold", "Pink", "Brown", "Cyan", "Magenta", "Transparent"]
+    spools = []
+    for i in range(1, count + 1):
+        spools.append({
+            "id": i,
+            "filament": {
+                "id": i,
+                "name": rng.choice(colors),
+                "material": rng.choice(materials),
+                "vendor": {"id": 1, "name": rng.choice(vendors)},
+            },
+            "remaining_weight": round(rng.uniform(0, 1000), 2),
+            "used_weight": 0.0,
+            "archived": rng.random() < 0.1,
+        })
+    return spools
+
+
+class FakeSpoolman:
+    def __init__(self, spools, delay=0.0, negative_use=True, late_reply=0.0):
+        self.spools = {s["id"]: s for s in spools}
+        self.delay = delay
+        self.late_reply = late_reply
+        self.negative_use = negative_use  # False answers a negative use_weight with 422, like a Spoolman that doesn't take refunds
+        self.requests = 0
+        self.uses = []      # (spool id, perf_counter) of every /use call
+        self.lock = threading.Lock()
+        self.listeners = []  # called as listener(event) on every change, see FakeSpoolmanEvents
+
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                owner.hit()
+                if self.path.split("?")[0] == "/api/v1/spool":
+                    return self.reply(200, list(owner.spools.values()))
+                m = re.fullmatch(r"/api/v1/spool/(\d+)", self.path)
+                if m and int(m.group(1)) in owner.spools:
+                    return self.reply(200, owner.spools[int(m.group(1))])
+                self.reply(404, {"message": "not found"})
+
+            def do_PUT(self):
+                owner.hit()
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                m = re.fullmatch(r"/api/v1/spool/(\d+)/use", self.path)
+                if not m or int(m.group(1)) not in owner.spools:
+                    return self.reply(404, {"message": "not found"})
+                if body.get("use_weight", 0) < 0 and not owner.negative_use:
+                    return self.reply(422, {"message": "use_weight must be positive"})
+                with owner.lock:
+                    spool = owner.spools[int(m.group(1))]
+                    spool["used_weight"] += body.get("use_weight", 0)
+                    spool["remaining_weight"] -= body.get("use_weight", 0)
+                    owner.uses.append((spool["id"], time.perf_counter()))
+                owner.publish("spool", "updated", spool)
+                if owner.late_reply:
+                    time.sleep(owner.late_reply)
+                try:
+                    self.reply(200, spool)
+                except OSError:
+                    pass  # the client gave up waiting
+
+            def do_PATCH(self):
+                owner.hit()
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                m = re.fullmatch(r"/api/v1/spool/(\d+)", self.path)
+                if not m or int(m.group(1)) not in owner.spools:
+                    return self.reply(404, {"message": "not found"})
+                with owner.lock:
+                    spool = owner.spools[int(m.group(1))]
+                    if "used_weight" in body:
+                        spool["remaining_weight"] += spool["used_weight"] - body["used_weight"]
+                        spool["used_weight"] = body["used_weight"]
+                owner.publish("spool", "updated", spool)
+                self.reply(200, spool)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def hit(self):
+        with self.lock:
+            self.requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+
+    def publish(self, resource, kind, payload):
+        event = {"type": kind, "resource": resource, "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "payload": json.loads(json.dumps(payload))}
+        for listener in self.listeners:
+            listener(event)
+
+    def edit_spool(self, spool_id, **fields):
+        """
+        A change made in the Spoolman UI, not through the daemon.
+        """
+        with self.lock:
+            spool = self.spools[spool_id]
+            spool.update(fields)
+        self.publish("spool", "updated", spool)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeSpoolmanEvents:
+    """
+    Spoolman's change event websocket for a FakeSpoolman, on its own port. Every connected client gets every event.
+    """
+    def __init__(self, fake):
+        self.fake = fake
+        self.clients = set()
+        self.server = None
+        self.url = None
+        self.loop = None
+
+    async def handler(self, ws):
+        self.clients.add(ws)
+        try:
+            await ws.wait_closed()
+        finally:
+            self.clients.discard(ws)
+
+    def send(self, event):
+        # FakeSpoolman publishes from its HTTP threads
+        self.loop.call_soon_threadsafe(websockets.broadcast, set(self.clients), json.dumps(event))
+
+    async def drop_clients(self):
+        for ws in list(self.clients):
+            await ws.close()
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await websockets.serve(self.handler, "127.0.0.1", 0)
+        self.url = f"ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/api/v1/"
+        self.fake.listeners.append(self.send)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.fake.listeners.remove(self.send)
+        self.server.close()
+        await self.server.wait_closed()
+
+
+# -----------------------------
+# FAKE SDCP PRINTER
+# -----------------------------
+"""
+Local websocket server that behaves like a Centauri Carbon status stream: idle, printing (status 13) for a while, stopped, then idle again.
+rate is status packets per second while printing. CurrentLayer climbs to total_layers over print_seconds,
+or the print is stopped part way when cancel_at (0-1) is set.
+"""
+class FakeSdcpPrinter:
+    def __init__(self, filename, rate=10, print_seconds=2.0, idle_packets=3, total_layers=100, cancel_at=None):
+        self.filename = filename
+        self.rate = rate
+        self.print_seconds = print_seconds
+        self.idle_packets = idle_packets
+        self.total_layers = total_layers
+        self.cancel_at = cancel_at
+        self.task_id = f"task-{filename}"
+        self.sent = 0
+        self.started_at = None  # perf_counter of the first status 13 packet
+        self.server = None
+        self.url = None
+
+    def status_packet(self, status, layer=0):
+        return json.dumps({"Status": {"CurrentStatus": [1 if status == 1 else 0], "PrintInfo": {
+            "Status": status, "Filename": f"/local/{self.filename}", "TaskId": self.task_id,
+            "CurrentLayer": layer, "TotalLayer": self.total_layers,
+        }}})
+
+    async def handler(self, ws):
+        try:
+            await self.play(ws)
+        except websockets.ConnectionClosed:
+            pass  # the daemon side hung up part way, eg a benchmark that has what it needs
+
+    async def play(self, ws):
+        interval = 1 / self.rate if self.rate else 0
+        for _ in range(self.idle_packets):
+            await ws.send(self.status_packet(1))
+            self.sent += 1
+        progress_end = self.cancel_at if self.cancel_at is not None else 1.0
+        start = time.monotonic()
+        end = start + self.print_seconds * progress_end
+        while time.monotonic() < end:
+            layer = 1 + int((time.monotonic() - start) / self.print_seconds * (self.total_layers - 1))
+            await ws.send(self.status_packet(13, layer))
+            if self.started_at is None:
+                self.started_at = time.perf_counter()
+            self.sent += 1
+            await asyncio.sleep(interval)
+        await ws.send(self.status_packet(13, max(1, int(self.total_layers * progress_end))))
+        for status in ((8 if self.cancel_at is not None else 9), 1, 1):
+            await ws.send(self.status_packet(status))
+            self.sent += 1
+        await ws.wait_closed()
+
+    async def __aenter__(self):
+        self.server = await websockets.serve(self.handler, "127.0.0.1", 0)
+        self.url = f"ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class FakeSdcpHistoryPrinter:
+    """
+    A printer that only answers the print history requests: Cmd 320 (task ids) and Cmd 321 (task details).
+    tasks is a list of HistoryDetailTaskList entries, {"TaskId", "TaskName", "BeginTime", "EndTime", "TaskStatus", "AlreadyPrintLayer"}.
+    """
+    def __init__(self, tasks, mainboard="0" * 16):
+        self.tasks = {task["TaskId"]: task for task in tasks}
+        self.mainboard = mainboard
+        self.server = None
+        self.url = None
+
+    async def handler(self, ws):
+        try:
+            await ws.send(json.dumps({"Attributes": {"Name": "Centauri Carbon", "MainboardID": self.mainboard}}))
+            async for msg in ws:
+                request = json.loads(msg).get("Data") or {}
+                if request.get("Cmd") == 320:
+                    data = {"Ack": 0, "HistoryData": list(self.tasks)}
+                elif request.get("Cmd") == 321:
+                    data = {"Ack": 0, "HistoryDetailTaskList": [self.tasks[i] for i in request["Data"]["Id"] if i in self.tasks]}
+                else:
+                    continue
+                await ws.send(json.dumps({"Id": "", "Topic": f"sdcp/response/{self.mainboard}", "Data": {
+                    "Cmd": request["Cmd"], "Data": data, "RequestID": request.get("RequestID"), "MainboardID": self.mainboard,
+                }}))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def __aenter__(self):
+        self.server = await websockets.serve(self.handler, "127.0.0.1", 0)
+        self.url = f"ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+# -----------------------------
+# BENCHMARKS
+# -----------------------------
+def bench_parse(sizes_mb, filaments, repeat, formats=("text",)):
+    """
+    Time and bytes read per file for the forward scan vs the tail-first scan, and for the gzip / binary readers.
+    """
+    results = []
+    writers = {
+        "text": (".gcode", write_synthetic_gcode, (("forward", daemon.scan_gcode_forward), ("tail", daemon.scan_gcode_tail))),
+        "gzip": (".gcode.gz", write_synthetic_gcode_gz, (("gzip_stream", daemon.scan_gcode_gzip),)),
+        "bgcode": (".bgcode", write_synthetic_bgcode, (("bgcode_blocks", daemon.scan_gcode_binary),)),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb, file_format in [(size_mb, file_format) for size_mb in sizes_mb for file_format in formats]:
+            extension, writer, scans = writers[file_format]
+            path = os.path.join(tmp, f"bench_{size_mb}mb{extension}")
+            presets = synthetic_presets(filaments)
+            grams = [round(10 + i * 1.5, 2) for i in range(filaments)]
+            writer(path, size_mb, presets, grams)
+
+            for mode, scan in scans:
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    found_presets, found_grams, bytes_read = scan(path)
+                    timings.append(time.perf_counter() - start)
+
+                assert found_presets == presets and found_grams == grams, f"{mode} scan returned wrong metadata"
+
+                results.append({
+                    "bench": "parse",
+                    "mode": mode,
+                    "file_mb": size_mb,
+                    "file_bytes": os.path.getsize(path),
+                    "filaments": filaments,
+                    "bytes_read": bytes_read,
+                    "best_s": round(min(timings), 6),
+                    "mean_s": round(sum(timings) / len(timings), 6),
+                    "mb_per_s": round(os.path.getsize(path) / (1024 * 1024) / min(timings), 1),
+                })
+
+            os.remove(path)
+    return results
+
+
+def bench_layers(sizes_mb, filaments, repeat):
+    """
+    Cost of the optional per-layer usage pass (layer_index), and of the lookup done when a print is cancelled.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        index = daemon.LayerIndex(os.path.join(tmp, "layers"), enabled=True)
+        for size_mb in sizes_mb:
+            path = os.path.join(tmp, f"bench_{size_mb}mb.gcode")
+            presets = synthetic_presets(filaments)
+            grams = [round(10 + i * 1.5, 2) for i in range(filaments)]
+            write_synthetic_gcode(path, size_mb, presets, grams)
+
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                layers = index.build(path, path)
+                timings.append(time.perf_counter() - start)
+
+            # The last layer has to add up to the slicer's totals, same as the print start deduction
+            full = index.usage_at(path, layers)
+            assert all(abs(full[p] - g) < 0.01 for p, g in zip(presets, grams)), "layer index does not add up to the slicer totals"
+
+            lookups = 1000
+            start = time.perf_counter()
+            for i in range(lookups):
+                index.usage_at(path, i % layers)
+            lookup = (time.perf_counter() - start) / lookups
+
+            file_bytes = os.path.getsize(path)
+            results.append({
+                "bench": "layers",
+                "file_mb": size_mb,
+                "file_bytes": file_bytes,
+                "filaments": filaments,
+                "layers": layers,
+                "index_bytes": os.path.getsize(index.path_for(path)),
+                "best_s": round(min(timings), 6),
+                "mean_s": round(sum(timings) / len(timings), 6),
+                "mb_per_s": round(file_bytes / 1024 / 1024 / min(timings), 1),
+                "lookup_us": round(lookup * 1e6, 1),
+            })
+            os.remove(path)
+    return results
+
+
+def near_miss(preset, rng):
+    """
+    Mangles a preset the way people do: a dropped or doubled letter in one of the names, or the dashes left out.
+    """
+    vendor, material, color = [p.strip() for p in preset.split(" - ")]
+    kind = rng.choice(["drop", "double", "nodash"])
+    if kind == "nodash":
+        return f"{vendor} {material} {color}"
+    i = rng.randrange(1, len(color))
+    color = color[:i] + color[i:][1:] if kind == "drop" else color[:i] + color[i - 1] + color[i:]
+    return f"{vendor} - {material} - {color}"
+
+
+def bench_match(spool_count, preset_count, repeat):
+    """
+    Preset -> spool resolution: exact presets, near misses through the fuzzy index, and the memoized repeat of both.
+    """
+    rng = random.Random(1)
+    spools = synthetic_spools(spool_count)
+    daemon.spool_cache = daemon.SpoolCache(None)
+    daemon.spool_cache.load(spools)
+
+    live = sorted({daemon.spool_match_fields(s) for s in spools if not s["archived"]})
+    exact = [f"{v} - {m} - {c}" for v, m, c in rng.sample(live, min(preset_count, len(live)))]
+    misses = [near_miss(p, rng) for p in exact]
+
+    start = time.perf_counter()
+    fuzzy = daemon.FuzzySpoolIndex(daemon.spool_cache.index["exact"])
+    build_s = time.perf_counter() - start
+    daemon.spool_cache.index["fuzzy"] = fuzzy
+
+    results = []
+    for mode, presets in (("exact", exact), ("near_miss", misses)):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            resolved = [daemon.match_preset(p, daemon.spool_cache.index) for p in presets]
+            timings.append((time.perf_counter() - start) / len(presets))
+
+        # Cached: first call fills the memo (and logs every fuzzy match, which we don't want here), then time the repeats
+        with contextlib.redirect_stdout(io.StringIO()):
+            for p in presets:
+                daemon.resolve_preset(p)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for p in presets:
+                daemon.resolve_preset(p)
+        cached = (time.perf_counter() - start) / (repeat * len(presets))
+
+        # A near miss counts as right if it landed on the spool its exact preset resolves to
+        expected = [daemon.match_preset(p, daemon.spool_cache.index)[0] for p in exact]
+        results.append({
+            "bench": "match",
+            "mode": mode,
+            "spools": spool_count,
+            "presets": len(presets),
+            "fuzzy_index_build_ms": round(build_s * 1000, 2),
+            "resolve_us": round(min(timings) * 1e6, 2),
+            "cached_us": round(cached * 1e6, 3),
+            "matched": sum(1 for spool_id, _, _ in resolved if spool_id is not None),
+            "correct": sum(1 for (spool_id, _, _), want in zip(resolved, expected) if spool_id == want),
+            "stages": {str(stage or "none"): sum(1 for _, s, _ in resolved if s == stage) for stage in {s for _, s, _ in resolved}},
+        })
+    return results
+
+
+def bench_events(spool_count, prints, delay_ms):
+    """
+    Spool cache kept fresh by polling + per-print revalidation vs by Spoolman's change events:
+    Spoolman requests and time per print start, and how long an edit made in Spoolman takes to reach the matcher.
+    """
+    results = []
+    spools = synthetic_spools(spool_count)
+    live = [s for s in spools if not s["archived"]]
+    target = live[0]
+    preset = " - ".join(daemon.spool_match_fields(target))
+
+    for mode in ("polling", "events"):
+        with FakeSpoolman(json.loads(json.dumps(spools)), delay=delay_ms / 1000) as fake:
+            client = daemon.SpoolmanClient([fake.url])
+            daemon.spoolman = client
+            daemon.spool_cache = daemon.SpoolCache(client, ttl=3600)
+
+            async def run():
+                events = watcher = None
+                if mode == "events":
+                    events = await FakeSpoolmanEvents(fake).__aenter__()
+                    daemon.SPOOLMAN_EVENTS_URL = events.url
+                    watcher = asyncio.create_task(daemon.spool_cache.watch_events())
+                    while not daemon.spool_cache.subscribed:
+                        await asyncio.sleep(0.01)
+                else:
+                    await daemon.spool_cache.refresh()
+
+                # Print starts: what handle_print_start does before it deducts
+                before = fake.requests
+                start = time.perf_counter()
+                for _ in range(prints):
+                    await daemon.spool_cache.ensure_fresh()
+                    spool_id = daemon.find_spool_for_preset(preset)
+                    if await daemon.spool_cache.revalidate([spool_id]):
+                        spool_id = daemon.find_spool_for_preset(preset)
+                per_print = (time.perf_counter() - start) / prints
+                requests_per_print = (fake.requests - before) / prints
+
+                # Someone archives the spool we would match in the Spoolman UI
+                matched = daemon.find_spool_for_preset(preset)
+                start = time.perf_counter()
+                fake.edit_spool(matched, archived=True)
+                visible_ms = None
+                if mode == "events":
+                    while daemon.find_spool_for_preset(preset) == matched and time.perf_counter() - start < 5:
+                        await asyncio.sleep(0.001)
+                    visible_ms = round((time.perf_counter() - start) * 1000, 2)
+                    # The socket dropping puts the cache back on polling, then it resubscribes
+                    await events.drop_clients()
+                    while daemon.spool_cache.subscribed:
+                        await asyncio.sleep(0.01)
+                    fallback_stale = daemon.spool_cache.is_stale()
+                    watcher.cancel()
+                    await events.__aexit__()
+                else:
+                    fallback_stale = None
+                return per_print, requests_per_print, visible_ms, fallback_stale
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                per_print, requests_per_print, visible_ms, fallback_stale = asyncio.run(run())
+            results.append({
+                "bench": "events",
+                "mode": mode,
+                "spools": spool_count,
+                "server_delay_ms": delay_ms,
+                "prints": prints,
+                "print_start_ms": round(per_print * 1000, 3),
+                "spoolman_requests_per_print": round(requests_per_print, 2),
+                "external_change_visible_ms": visible_ms,
+                "stale_after_disconnect": fallback_stale,
+                "events_applied": daemon.spool_cache.stats["events"],
+            })
+            client.close()
+    daemon.SPOOLMAN_EVENTS_URL = None
+    return results
+
+
+def bench_jobs(job_counts, filaments, cap):
+    """
+    Memory per retained job: the old layout (a metadata dict of lists in pending_jobs plus the full index entry) vs
+    JobRecord + the offset-only metadata index, with and without the pending_jobs_max cap. Also the cost of reloading an evicted job.
+    """
+    results = []
+    presets = synthetic_presets(filaments)
+    for count in job_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            daemon.WATCH_FOLDER = tmp
+            index_path = os.path.join(tmp, ".spooler_index.jsonl")
+            with open(index_path, "w") as f:
+                for i in range(count):
+                    meta = {"filament_presets": presets, "filament_g_list": [round(10 + i % 97 + j * 1.5, 2) for j in range(filaments)]}
+                    f.write(json.dumps({"filename": f"plate_{i:06d}.gcode", "size": 1000 + i, "mtime_ns": i, "inode": i, "meta": meta}) + "\n")
+
+            def legacy():
+                # What the daemon used to hold: every index line as parsed, and a dict per job sharing its lists
+                entries, jobs = {}, {}
+                with open(index_path) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        entries[entry["filename"]] = entry
+                        jobs[entry["filename"]] = {**entry["meta"], "path": os.path.join(tmp, entry["filename"])}
+                return entries, jobs
+
+            def compact(max_entries):
+                daemon.metadata_index = daemon.MetadataIndex(index_path)
+                daemon.pending_jobs = daemon.PendingJobs(max_entries)
+                daemon.preset_table = daemon.PresetTable()
+                daemon.metadata_index.load()
+                for name in list(daemon.metadata_index.entries):
+                    daemon.register_job(name, {**daemon.metadata_index.read_meta(name), "path": os.path.join(tmp, name)})
+                return daemon.metadata_index, daemon.pending_jobs
+
+            for mode, build in (("legacy_dicts", legacy), ("job_records", lambda: compact(0)), (f"job_records_cap_{cap}", lambda: compact(cap))):
+                # Timed and traced separately, tracemalloc slows allocation down a lot
+                start = time.perf_counter()
+                held = build()
+                elapsed = time.perf_counter() - start
+                del held
+                tracemalloc.start()
+                held = build()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                result = {
+                    "bench": "jobs",
+                    "mode": mode,
+                    "jobs": count,
+                    "filaments": filaments,
+                    "bytes_per_job": round(current / count, 1),
+                    "total_mb": round(current / 1024 / 1024, 2),
+                    "peak_mb": round(peak / 1024 / 1024, 2),
+                    "load_s": round(elapsed, 3),
+                }
+                if mode != "legacy_dicts":
+                    # The oldest job is the first to go once the cap is hit
+                    oldest = "plate_000000.gcode"
+                    start = time.perf_counter()
+                    job = daemon.pending_jobs.get(oldest)
+                    result["get_oldest_us"] = round((time.perf_counter() - start) * 1e6, 1)
+                    result["in_memory"] = len(daemon.pending_jobs)
+                    assert job is not None and job.filament_presets == presets
+                results.append(result)
+                del held
+    return results
+
+
+def bench_spoolman(spool_count, filaments, delay_ms, repeat):
+    """
+    Print-start HTTP cost: the old bare requests calls made one after another vs the pooled client with concurrent /use calls.
+    """
+    results = []
+    deductions = [(i, 1.5) for i in range(1, filaments + 1)]
+
+    with FakeSpoolman(synthetic_spools(spool_count), delay=delay_ms / 1000) as fake:
+        client = daemon.SpoolmanClient([fake.url])
+
+        def legacy():
+            requests.get(f"{fake.url}/api/v1/spool").json()
+            for spool_id, grams in deductions:
+                requests.put(f"{fake.url}/api/v1/spool/{spool_id}/use", json={"use_weight": grams})
+
+        async def pooled():
+            await client.get_spools()
+            await asyncio.gather(*(client.use_spool(spool_id, grams) for spool_id, grams in deductions))
+
+        for mode, run in (("legacy_serial", legacy), ("pooled_concurrent", lambda: asyncio.run(pooled()))):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+
+            results.append({
+                "bench": "spoolman",
+                "mode": mode,
+                "spools": spool_count,
+                "filaments": filaments,
+                "server_delay_ms": delay_ms,
+                "best_s": round(min(timings), 6),
+                "mean_s": round(sum(timings) / len(timings), 6),
+            })
+
+        client.close()
+    return results
+
+
+def bench_scan(file_count, size_mb, workers, filaments, unique=1):
+    """
+    Startup scan over a folder of old G-codes: the previous serial loop (settle wait + parse per file), the pooled scan with and without
+    the content cache, and a restart that hits the metadata index. The folder holds copies of `unique` different plates.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        templates = []
+        for u in range(unique):
+            template = os.path.join(tmp, "template.gcode.src")
+            write_synthetic_gcode(template, size_mb, synthetic_presets(filaments), [round(10 + i * 1.5, 2) for i in range(filaments)], seed=u)
+            with open(template, "rb") as f:
+                templates.append(f.read())
+            os.remove(template)
+        old = time.time() - 3600
+        for i in range(file_count):
+            path = os.path.join(tmp, f"plate_{i:04d}.gcode")
+            with open(path, "wb") as f:
+                f.write(templates[i % unique])
+            os.utime(path, (old, old))
+
+        daemon.WATCH_FOLDER = tmp
+        index_path = os.path.join(tmp, ".spooler_index.jsonl")
+
+        def serial():
+            for filename in os.listdir(tmp):
+                if filename.endswith(".gcode"):
+                    path = os.path.join(tmp, filename)
+                    daemon.wait_for_file_complete(path)
+                    daemon.pending_jobs.put(filename, daemon.parse_gcode_metadata(path))
+
+        def pooled(keep_index, content_hash="sample"):
+            if not keep_index and os.path.exists(index_path):
+                os.remove(index_path)
+            daemon.CONTENT_HASH = content_hash
+            daemon.metadata_index = daemon.MetadataIndex(index_path)
+            executor = daemon.make_scan_executor(workers=workers)
+            asyncio.run(daemon.initial_folder_scan(executor))
+            executor.shutdown()
+
+        modes = (
+            ("serial_settle_wait", serial),
+            ("pooled_no_content_hash", lambda: pooled(False, "off")),
+            ("pooled", lambda: pooled(False)),
+            ("pooled_full_hash", lambda: pooled(False, "full")),
+            ("pooled_indexed_restart", lambda: pooled(True)),
+        )
+        for mode, run in modes:
+            daemon.pending_jobs.clear()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+            elapsed = time.perf_counter() - start
+            assert len(daemon.pending_jobs) == file_count
+
+            results.append({
+                "bench": "scan",
+                "mode": mode,
+                "files": file_count,
+                "unique": unique,
+                "file_mb": size_mb,
+                "workers": workers,
+                "total_s": round(elapsed, 6),
+                "per_file_ms": round(elapsed / file_count * 1000, 3),
+                "content_hit_rate": round(daemon.metadata_index.content_hit_rate(), 3) if mode != "serial_settle_wait" else None,
+            })
+        daemon.CONTENT_HASH = "sample"
+    return results
+
+
+def bench_printers(printer_counts, rate, print_seconds, spool_count):
+    """
+    Load test: N fake printers all printing at once, served by one daemon event loop with one shared spool cache and Spoolman session.
+    """
+    results = []
+    daemon.config["always_running"] = True
+    daemon.DELETE_AFTER_PRINT = False
+
+    for count in printer_counts:
+        with FakeSpoolman(synthetic_spools(spool_count)) as fake:
+            client = daemon.SpoolmanClient([fake.url], pool_size=max(8, count))
+            daemon.spoolman = client
+            daemon.spool_cache = daemon.SpoolCache(client)
+
+            journal_dir = tempfile.TemporaryDirectory()
+            daemon.deduction_queue = daemon.DeductionQueue(os.path.join(journal_dir.name, "deductions.jsonl"))
+            daemon.print_sessions = daemon.PrintSessions(os.path.join(journal_dir.name, "sessions.json"))
+
+            async def run():
+                drainer = asyncio.create_task(daemon.deduction_queue.drainer())
+                printers = [FakeSdcpPrinter(f"plate_{i}.gcode", rate, print_seconds) for i in range(count)]
+                for p in printers:
+                    await p.__aenter__()
+                    daemon.register_job(p.filename, {"filament_presets": ["ELEGOO - PLA - Black", "Sunlu - PETG - Red"], "filament_g_list": [12.5, 3.25], "path": p.filename})
+
+                listener = asyncio.create_task(daemon.sdcp_listener([
+                    {"name": f"p{i}", "sdcp_ws_url": p.url, "watch_folder": None} for i, p in enumerate(printers)
+                ]))
+
+                # Every printer deducts two spools once, wait for all of them
+                deadline = time.monotonic() + print_seconds + 30
+                while sum(1 for s in fake.spools.values() if s["used_weight"]) < 2 and time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+                await asyncio.sleep(print_seconds + 0.5)
+
+                await daemon.deduction_queue.flush(timeout=10)
+                listener.cancel()
+                drainer.cancel()
+                try:
+                    await listener
+                except asyncio.CancelledError:
+                    pass
+                for p in printers:
+                    await p.__aexit__()
+                return sum(p.sent for p in printers)
+
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            sent = asyncio.run(run())
+            cpu = time.process_time() - cpu
+            wall = time.perf_counter() - wall
+
+            results.append({
+                "bench": "printers",
+                "printers": count,
+                "status_rate_hz": rate,
+                "messages": sent,
+                "wall_s": round(wall, 3),
+                "cpu_s": round(cpu, 3),
+                "cpu_ms_per_printer": round(cpu / count * 1000, 2),
+                "spoolman_requests": fake.requests,
+                "spoolman_requests_per_printer": round(fake.requests / count, 2),
+                "used_g_total": round(sum(s["used_weight"] for s in fake.spools.values()), 2),
+            })
+            client.close()
+            journal_dir.cleanup()
+    return results
+
+
+def bench_latency(spool_count, prints, filaments, rate, delay_ms):
+    """
+    Print start -> deduction, end to end: from the first status 13 packet a fake printer sends, through the SDCP listener, matching against
+    the fake Spoolman's inventory and the deduction journal, to the last /use call Spoolman receives for that print.
+    The first print finds the spool cache cold and has to fetch the whole inventory, the rest run against a warm cache.
+    """
+    rng = random.Random(2)
+    spools = synthetic_spools(spool_count)
+    live = sorted({daemon.spool_match_fields(s) for s in spools if not s["archived"]})
+    daemon.DELETE_AFTER_PRINT = False
+
+    with FakeSpoolman(spools, delay=delay_ms / 1000) as fake:
+        client = daemon.SpoolmanClient([fake.url])
+        daemon.spoolman = client
+        daemon.spool_cache = daemon.SpoolCache(client)
+        journal_dir = tempfile.TemporaryDirectory()
+        daemon.deduction_queue = daemon.DeductionQueue(os.path.join(journal_dir.name, "deductions.jsonl"))
+        daemon.print_sessions = daemon.PrintSessions(os.path.join(journal_dir.name, "sessions.json"))
+
+        async def one_print(i):
+            # Distinct presets never resolve to the same spool, so every filament is its own /use call
+            presets = [" - ".join(fields) for fields in rng.sample(live, filaments)]
+            printer = FakeSdcpPrinter(f"latency_{i}.gcode", rate=rate, print_seconds=0.5)
+            daemon.register_job(printer.filename, {"filament_presets": presets, "filament_g_list": [round(rng.uniform(1, 50), 2) for _ in presets], "path": None})
+            async with printer:
+                before = len(fake.uses)
+                listener = asyncio.create_task(daemon.sdcp_listener([{"name": f"p{i}", "sdcp_ws_url": printer.url, "watch_folder": None}]))
+                deadline = time.monotonic() + 30
+                while len(fake.uses) - before < filaments and time.monotonic() < deadline:
+                    await asyncio.sleep(0.001)
+                latency = fake.uses[-1][1] - printer.started_at if len(fake.uses) - before >= filaments else None
+                listener.cancel()
+                try:
+                    await listener
+                except asyncio.CancelledError:
+                    pass
+            return latency
+
+        async def run():
+            drainer = asyncio.create_task(daemon.deduction_queue.drainer())
+            latencies = [await one_print(i) for i in range(prints)]
+            drainer.cancel()
+            return latencies
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies = asyncio.run(run())
+        client.close()
+        journal_dir.cleanup()
+
+    warm = sorted(latency * 1000 for latency in latencies[1:] if latency is not None)
+    return [{
+        "bench": "latency",
+        "spools": spool_count,
+        "prints": prints,
+        "filaments": filaments,
+        "status_rate_hz": rate,
+        "server_delay_ms": delay_ms,
+        "missed": sum(1 for latency in latencies if latency is None),
+        "cold_ms": round(latencies[0] * 1000, 2) if latencies[0] is not None else None,
+        "warm_p50_ms": round(warm[len(warm) // 2], 2) if warm else None,
+        "warm_p95_ms": round(warm[min(len(warm) - 1, int(len(warm) * 0.95))], 2) if warm else None,
+        "warm_max_ms": round(warm[-1], 2) if warm else None,
+    }]
+
+
+def write_synthetic_recording(path, hours, rate, print_minutes=60, idle_minutes=10):
+    """
+    Printer traffic as daemon.SdcpRecorder writes it: prints of print_minutes with idle gaps between them, status packets at rate per second
+    while printing, one every 15 seconds while idle (the keepalive's get_state), and some non-status traffic. Returns how many prints it holds.
+    """
+    recorder = daemon.SdcpRecorder(os.path.dirname(path))
+    recorder.file = gzip.open(path, "wt", encoding="utf-8")
+    ts = 1_700_000_000.0
+    end = ts + hours * 3600
+    prints = 0
+    attributes = json.dumps({"Attributes": {"Name": "Centauri Carbon", "MainboardID": "0" * 16}})
+    while ts < end:
+        printer = FakeSdcpPrinter(f"plate_{prints}.gcode", total_layers=500)
+        for _ in range(idle_minutes * 4):
+            recorder.write(printer.status_packet(1), ts)
+            ts += 15
+        steps = int(print_minutes * 60 * rate)
+        for i in range(steps):
+            recorder.write(printer.status_packet(13, 1 + i * 499 // steps), ts)
+            if i % 50 == 0:
+                recorder.write(attributes, ts)
+            ts += 1 / rate
+        recorder.write(printer.status_packet(9), ts)
+        recorder.write(printer.status_packet(1), ts + 1)
+        ts += 2
+        prints += 1
+    recorder.close()
+    return prints
+
+
+def bench_replay(hours, rate):
+    """
+    Status handling throughput: hours of recorded printer traffic replayed through the parser and the print state machine as fast as possible.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "farm.sdcp.gz")
+        prints = write_synthetic_recording(path, hours, rate)
+        stats = daemon.replay_sdcp([path], verbose=False)
+        assert stats["actions"].get("start") == prints and stats["actions"].get("finished") == prints, stats["actions"]
+        return [{
+            "bench": "replay",
+            "hours": hours,
+            "status_rate_hz": rate,
+            "recording_bytes": os.path.getsize(path),
+            "messages": stats["messages"],
+            "prints": prints,
+            "elapsed_s": round(stats["elapsed_s"], 3),
+            "messages_per_s": round(stats["messages_per_s"]),
+            "recorded_hours_per_s": round(stats["recorded_s"] / 3600 / stats["elapsed_s"], 1),
+        }]
+
+
+def bench_reconcile(file_count, size_mb, spool_count, filaments, unique=10):
+    """
+    Offline reconcile of an archive of file_count G-codes against a fake printer history that lists each one printed once or twice,
+    with one in ten stopped half way. Reports the time and the Spoolman requests it took, next to the /use calls charging the same
+    prints one job at a time would have made.
+    """
+    rng = random.Random(3)
+    spools = synthetic_spools(spool_count)
+    live = sorted({daemon.spool_match_fields(s) for s in spools if not s["archived"]})
+    variants = [[" - ".join(fields) for fields in rng.sample(live, filaments)] for _ in range(unique)]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, "archive")
+        os.makedirs(folder)
+        tasks = []
+        per_job_calls = 0
+        for i in range(file_count):
+            presets = variants[i % unique]
+            write_synthetic_gcode(os.path.join(folder, f"plate_{i}.gcode"), size_mb, presets, [round(rng.uniform(1, 50), 2) for _ in presets], seed=i % unique)
+            for _ in range(rng.choice((1, 1, 2))):
+                stopped = rng.random() < 0.1
+                tasks.append({
+                    "TaskId": f"task-{len(tasks)}", "TaskName": f"/local/plate_{i}.gcode", "BeginTime": 1_700_000_000 + len(tasks) * 3600,
+                    "EndTime": 1_700_000_000 + len(tasks) * 3600 + 1800, "TaskStatus": 3 if stopped else 1, "AlreadyPrintLayer": 50 if stopped else 0,
+                })
+                per_job_calls += filaments
+
+        for mode in ("dry_run", "apply"):
+            with FakeSpoolman(spools) as fake:
+                client = daemon.SpoolmanClient([fake.url])
+                daemon.spoolman = client
+                daemon.spool_cache = daemon.SpoolCache(client)
+                state = os.path.join(tmp, mode)
+                os.makedirs(state)
+                daemon.metadata_index = daemon.MetadataIndex(os.path.join(state, "index.jsonl"))
+                daemon.deduction_queue = daemon.DeductionQueue(os.path.join(state, "deductions.jsonl"))
+                daemon.print_sessions = daemon.PrintSessions(os.path.join(state, "sessions.json"))
+
+                async def run():
+                    async with FakeSdcpHistoryPrinter(tasks) as printer:
+                        start = time.perf_counter()
+                        history = await daemon.fetch_print_history(printer.url)
+                        ok = await daemon.reconcile([folder], history, dry_run=mode == "dry_run", printer={"name": "p", "sdcp_ws_url": printer.url, "watch_folder": None})
+                        return ok, time.perf_counter() - start
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ok, elapsed = asyncio.run(run())
+                client.close()
+
+                results.append({
+                    "bench": "reconcile",
+                    "mode": mode,
+                    "files": file_count,
+                    "file_mb": size_mb,
+                    "unique": unique,
+                    "spools": spool_count,
+                    "filaments": filaments,
+                    "prints": len(tasks),
+                    "ok": ok,
+                    "elapsed_s": round(elapsed, 3),
+                    "spoolman_requests": fake.requests,
+                    "use_calls": len(fake.uses),
+                    "per_job_use_calls": per_job_calls,
+                })
+    return results
+
+
+# -----------------------------
+# SUITE
+# -----------------------------
+"""
+A fixed set of the benchmarks above, written as one JSON document so two versions can be compared with the compare subcommand:
+    python benchmark.py suite --out before.json
+    (change things)
+    python benchmark.py suite --out after.json
+    python benchmark.py compare before.json after.json
+Results are matched up by the fields in RESULT_KEYS. Timings (fields ending in _s, _ms or _us) are lower is better,
+rates (ending in _per_s) are higher is better, everything else is informational.
+"""
+RESULT_KEYS = ("bench", "mode", "file_mb", "filaments", "spools", "presets", "files", "unique", "printers", "prints", "jobs", "workers", "server_delay_ms", "hours")
+
+
+def run_suite(quick=False):
+    if quick:
+        sizes, spools, scan_files, prints = [1, 20], 5000, 50, 5
+    else:
+        sizes, spools, scan_files, prints = [1, 50, 500], 50000, 300, 20
+
+    results = []
+    results += bench_parse(sizes, 4, 3)
+    results += bench_parse([1], 16, 3)
+    results += bench_parse([sizes[1]], 4, 3, ("gzip", "bgcode"))
+    results += bench_match(spools, 200, 5)
+    results += bench_scan(scan_files, 2, 8, 4, unique=10)
+    results += bench_latency(spools, prints, 4, 20, 0)
+    results += bench_replay(2 if quick else 24, 2)
+    results += bench_reconcile(50 if quick else 500, 1, spools, 4)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "suite": "quick" if quick else "full",
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+
+
+def metric_direction(name):
+    if name.endswith("_per_s"):
+        return 1
+    if name.endswith(("_s", "_ms", "_us")):
+        return -1
+    return 0
+
+
+def compare_results(before, after, threshold):
+    """
+    One row per metric present in both runs. change is after / before - 1, a regression is a change in the wrong direction beyond threshold.
+    """
+    def keyed(doc):
+        return {tuple((k, r.get(k)) for k in RESULT_KEYS if k in r): r for r in doc["results"]}
+
+    old = keyed(before)
+    rows = []
+    for key, new in keyed(after).items():
+        if key not in old:
+            continue
+        for metric, value in new.items():
+            direction = metric_direction(metric)
+            base = old[key].get(metric)
+            if not direction or not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or not base:
+                continue
+            change = value / base - 1
+            rows.append({
+                **dict(key),
+                "metric": metric,
+                "before": base,
+                "after": value,
+                "change": round(change, 4),
+                "regression": change * direction < -threshold,
+            })
+    return rows
+
+
+# -----------------------------
+# MAIN
+# -----------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Spooler benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p_parse = sub.add_parser("parse", help="G-code metadata parser")
+    p_parse.add_argument("--sizes", type=float, nargs="+", default=[1, 50, 300], help="file sizes in MB")
+    p_parse.add_argument("--filaments", type=int, default=4)
+    p_parse.add_argument("--repeat", type=int, default=3)
+    p_parse.add_argument("--formats", nargs="+", default=["text"], choices=["text", "gzip", "bgcode"])
+
+    p_layers = sub.add_parser("layers", help="Per-layer usage index build + cancelled print lookup")
+    p_layers.add_argument("--sizes", type=float, nargs="+", default=[1, 50, 300], help="file sizes in MB")
+    p_layers.add_argument("--filaments", type=int, default=4)
+    p_layers.add_argument("--repeat", type=int, default=1)
+
+    p_match = sub.add_parser("match", help="Preset -> spool matching, exact and near-miss presets")
+    p_match.add_argument("--spools", type=int, default=50000)
+    p_match.add_argument("--presets", type=int, default=200)
+    p_match.add_argument("--repeat", type=int, default=5)
+
+    p_events = sub.add_parser("events", help="Spool cache freshness: polling vs Spoolman change events")
+    p_events.add_argument("--spools", type=int, default=5000)
+    p_events.add_argument("--prints", type=int, default=50)
+    p_events.add_argument("--delay-ms", type=float, default=20)
+
+    p_jobs = sub.add_parser("jobs", help="Memory per retained job, and reloading jobs evicted by pending_jobs_max")
+    p_jobs.add_argument("--jobs", type=int, nargs="+", default=[10000, 100000])
+    p_jobs.add_argument("--filaments", type=int, default=4)
+    p_jobs.add_argument("--cap", type=int, default=10000)
+
+    p_spoolman = sub.add_parser("spoolman", help="Spoolman refresh + deduction against a local fake server")
+    p_spoolman.add_argument("--spools", type=int, default=1000)
+    p_spoolman.add_argument("--filaments", type=int, default=4)
+    p_spoolman.add_argument("--delay-ms", type=float, default=20)
+    p_spoolman.add_argument("--repeat", type=int, default=5)
+
+    p_scan = sub.add_parser("scan", help="Initial folder scan over a directory of synthetic G-codes")
+    p_scan.add_argument("--files", type=int, default=300)
+    p_scan.add_argument("--size", type=float, default=2, help="size of each file in MB")
+    p_scan.add_argument("--workers", type=int, default=8)
+    p_scan.add_argument("--filaments", type=int, default=4)
+    p_scan.add_argument("--unique", type=int, default=1, help="distinct plates, the rest of the files are copies")
+
+    p_printers = sub.add_parser("printers", help="Many fake SDCP printers served by one daemon loop")
+    p_printers.add_argument("--printers", type=int, nargs="+", default=[1, 8, 32])
+    p_printers.add_argument("--rate", type=float, default=20, help="status packets per second per printer")
+    p_printers.add_argument("--print-seconds", type=float, default=3)
+    p_printers.add_argument("--spools", type=int, default=1000)
+
+    p_latency = sub.add_parser("latency", help="Print start -> deduction through a fake printer and a fake Spoolman")
+    p_latency.add_argument("--spools", type=int, default=50000)
+    p_latency.add_argument("--prints", type=int, default=20)
+    p_latency.add_argument("--filaments", type=int, default=4)
+    p_latency.add_argument("--rate", type=float, default=20, help="status packets per second")
+    p_latency.add_argument("--delay-ms", type=float, default=0)
+
+    p_replay = sub.add_parser("replay", help="SDCP status handling throughput over hours of synthetic recorded traffic")
+    p_replay.add_argument("--hours", type=float, default=24)
+    p_replay.add_argument("--rate", type=float, default=2, help="status packets per second while printing")
+
+    p_reconcile = sub.add_parser("reconcile", help="Offline reconcile of an archive of G-codes against a fake printer's print history")
+    p_reconcile.add_argument("--files", type=int, default=500)
+    p_reconcile.add_argument("--size", type=float, default=1, help="MB per file")
+    p_reconcile.add_argument("--spools", type=int, default=50000)
+    p_reconcile.add_argument("--filaments", type=int, default=4)
+    p_reconcile.add_argument("--unique", type=int, default=10, help="distinct files among them, the rest are copies")
+
+    p_suite = sub.add_parser("suite", help="Parse, match, scan and latency benchmarks as one JSON document")
+    p_suite.add_argument("--out", help="write the results here as well as to stdout")
+    p_suite.add_argument("--quick", action="store_true", help="smaller files and inventory")
+
+    p_compare = sub.add_parser("compare", help="Compare two suite results, exits 1 on a regression")
+    p_compare.add_argument("before")
+    p_compare.add_argument("after")
+    p_compare.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression")
+
+    args = parser.parse_args()
+
+    if args.bench == "suite":
+        doc = run_suite(args.quick)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(doc, f, indent=1)
+        print(json.dumps(doc))
+        return
+    if args.bench == "compare":
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        rows = compare_results(before, after, args.threshold)
+        for row in rows:
+            print(json.dumps(row))
+        regressions = [row for row in rows if row["regression"]]
+        print(f"{len(regressions)} regressions in {len(rows)} metrics ({before.get('commit')} -> {after.get('commit')})", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+    if args.bench == "parse":
+        results = bench_parse(args.sizes, args.filaments, args.repeat, args.formats)
+    elif args.bench == "layers":
+        results = bench_layers(args.sizes, args.filaments, args.repeat)
+    elif args.bench == "match":
+        results = bench_match(args.spools, args.presets, args.repeat)
+    elif args.bench == "events":
+        results = bench_events(args.spools, args.prints, args.delay_ms)
+    elif args.bench == "jobs":
+        results = bench_jobs(args.jobs, args.filaments, args.cap)
+    elif args.bench == "scan":
+        results = bench_scan(args.files, args.size, args.workers, args.filaments, args.unique)
+    elif args.bench == "printers":
+        results = bench_printers(args.printers, args.rate, args.print_seconds, args.spools)
+    elif args.bench == "spoolman":
+        results = bench_spoolman(args.spools, args.filaments, args.delay_ms, args.repeat)
+    elif args.bench == "latency":
+        results = bench_latency(args.spools, args.prints, args.filaments, args.rate, args.delay_ms)
+    elif args.bench == "replay":
+        results = bench_replay(args.hours, args.rate)
+    elif args.bench == "reconcile":
+        results = bench_reconcile(args.files, args.size, args.spools, args.filaments, args.unique)
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
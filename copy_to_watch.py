@@ -2,6 +2,7 @@ import shutil
 import sys
 import os
 import json
+import socket
 import subprocess
 
 # OrcaSlicer passes the G-code file path as the first argument
@@ -33,21 +34,125 @@ os.makedirs(WATCH_FOLDER, exist_ok=True)
 
 output_name = os.environ.get('SLIC3R_PP_OUTPUT_NAME')
 
-# Copy file: Atomic copy and then replace to help ensure daemon gets full file.
+cfg = {}
+if CONFIG_PATH is not None:
+    with open(CONFIG_PATH, "r") as f:
+        cfg = json.load(f)
 
-dest = os.path.join(WATCH_FOLDER, os.path.basename(output_name))
-temp_dest = dest + ".tmp"
-shutil.copy2(gcode_path, temp_dest)
-os.replace(temp_dest, dest)
+HANDOFF_PORT = cfg.get("handoff_port", 7913)
+HANDOFF_TOKEN_PATH = os.path.join(DAEMON_FOLDER, ".spooler_handoff_token")
 
-print(f"[POST] Copied {gcode_path} → {dest}")
 
+# ------------------------------
+# Fast Path: Hand metadata to a running daemon
+# ------------------------------
+"""
+If the daemon is already running, there is no need to copy the G-code anywhere.
+We read the two filament lines from the end of the file (same as the daemon's scan_gcode_tail) and send them over localhost,
+along with the token the daemon checks (see HANDOFF SERVER in daemon.py).
+Always running mode only. A one time mode daemon exits once its own print is done, a job handed to it would never be charged.
+"""
+def read_tail_metadata(path):
+    """
+    The daemon's own tail scan, from gcode_tail.py next to daemon.py. None, None if that can't be found (DAEMON_FOLDER is wrong).
+    """
+    sys.path.insert(0, DAEMON_FOLDER)
+    try:
+        from gcode_tail import scan_gcode_tail
+    except ImportError:
+        return None, None
+    finally:
+        sys.path.pop(0)
+
+    presets, grams, _ = scan_gcode_tail(path)
+    return presets, grams
+
+
+def read_handoff_token():
+    if cfg.get("handoff_token"):
+        return cfg["handoff_token"]
+    try:
+        with open(HANDOFF_TOKEN_PATH, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def handoff_to_daemon(path, name):
+    """
+    Returns True if a running daemon took the metadata.
+    """
+    if not HANDOFF_PORT or not cfg.get("always_running", True):
+        return False
+    if not name.lower().endswith(".gcode"):
+        return False  # .gcode.gz / .bgcode are left for the daemon's own readers
+    try:
+        sock = socket.create_connection(("127.0.0.1", HANDOFF_PORT), timeout=0.5)
+    except OSError:
+        return False  # daemon not running
+
+    token = read_handoff_token()
+    presets, grams = read_tail_metadata(path)
+    if token is None or presets is None or grams is None:
+        sock.close()
+        return False  # let the daemon do a full parse of the file instead
+
+    try:
+        with sock:
+            sock.settimeout(5)
+            sock.sendall((json.dumps({"filename": name, "filament_presets": presets, "filament_g_list": grams, "token": token}) + "\n").encode())
+            return sock.makefile("rb").readline().strip() == b"ok"
+    except OSError:
+        return False
 
-if CONFIG_PATH is not None:
-    with open(CONFIG_PATH, "r") as f:
-        cfg = json.load(f)
 
-    if not cfg.get("always_running", True):
+# ------------------------------
+# Fallback: Place file in the watch folder
+# ------------------------------
+"""
+Hardlink if we can (same filesystem), then a reflink (copy-on-write clone, Linux btrfs / xfs), then a real copy as last resort.
+Always written to a .tmp name then os.replace()d into place so the daemon only sees the finished file.
+"""
+def reflink(src, dst):
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def place_file(src, dest):
+    temp_dest = dest + ".tmp"
+    if os.path.exists(temp_dest):
+        os.remove(temp_dest)
+
+    try:
+        os.link(src, temp_dest)
+        method = "Linked"
+    except (OSError, AttributeError):
+        try:
+            reflink(src, temp_dest)
+            shutil.copystat(src, temp_dest)
+            method = "Cloned"
+        except (OSError, ImportError):
+            if os.path.exists(temp_dest):
+                os.remove(temp_dest)
+            shutil.copy2(src, temp_dest)
+            method = "Copied"
+
+    os.replace(temp_dest, dest)
+    return method
+
+
+name = os.path.basename(output_name)
+
+if handoff_to_daemon(gcode_path, name):
+    print(f"[POST] Sent filament info for {name} to running daemon")
+else:
+    dest = os.path.join(WATCH_FOLDER, name)
+    method = place_file(gcode_path, dest)
+    print(f"[POST] {method} {gcode_path} → {dest}")
+
+    if CONFIG_PATH is not None and not cfg.get("always_running", True):
 
         env = os.environ.copy()
         env["AGENT_VENV"] = LOCAL_VENV
@@ -61,5 +166,5 @@ if CONFIG_PATH is not None:
             else:
                 subprocess.Popen([DAEMON_FOLDER + r"\run.bat"], shell=True, env=env)
         else:
-            subprocess.Popen(["bash", DAEMON_FOLDER + r"\run.sh"], env=env)
+            subprocess.Popen(["bash", os.path.join(DAEMON_FOLDER, "run.sh")], env=env)
 
@@ -1,75 +1,576 @@
+import time
+STARTUP_T0 = time.perf_counter()  # for --startup-profile, taken before any heavy imports
+
+import argparse
 import asyncio
 import json
 import os
-import time
+import queue
 import re
+import gzip
+import struct
+import hashlib
+import zlib
+import uuid
+import random
+import itertools
+import bisect
+import contextlib
+from array import array
+from collections import OrderedDict, deque
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
 import websockets
-import requests
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+
+from gcode_tail import GCODE_TAIL_BLOCK_SIZE, match_metadata_line, scan_gcode_tail
+
+# requests and watchdog are imported where they are first used. They are the slowest imports we have and
+# neither is needed to get the printer connection up, which in one time mode is a race against the first layer.
 
 
 # -----------------------------
 # CONFIG LOADING
 # -----------------------------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
 def load_config():
-    with open("config.json", "r") as f:
+    # Next to this file, so it doesn't matter which folder the daemon is started from
+    with open(os.path.join(SCRIPT_DIR, "config.json"), "r") as f:
         return json.load(f)
 
 config = load_config()
 
-SDCP_WS_URL = config["sdcp_ws_url"]
+SDCP_WS_URL = config.get("sdcp_ws_url")
 WATCH_FOLDER = config["watch_folder"]
 SPOOLMAN_URL = config["spoolman_url"]
 SPOOLMAN_LOCAL_URL = config["spoolman_local_url"]
 DELETE_AFTER_PRINT = config.get("delete_after_print", True)
+SCAN_WORKERS = config.get("scan_workers", min(8, os.cpu_count() or 1))
+SCAN_USE_PROCESSES = config.get("scan_use_processes", False)
+SETTLE_SKIP_AGE = config.get("settle_skip_age", 10)  # seconds, files older than this are not waited on
+INGEST_WORKERS = config.get("ingest_workers", 2)
+INGEST_QUEUE_SIZE = config.get("ingest_queue_size", 256)
+JOB_WAIT_TIMEOUT = config.get("job_wait_timeout", 60)  # seconds a print start waits for its G-code to be parsed
+SDCP_QUEUE_SIZE = config.get("sdcp_queue_size", 256)
+SDCP_BACKOFF_MAX = config.get("sdcp_backoff_max", 60)  # seconds, cap for the reconnect delay
+SDCP_STATS_INTERVAL = config.get("sdcp_stats_interval", 0)  # seconds between stats lines, 0 = off
+METADATA_INDEX_PATH = config.get("metadata_index_path") or os.path.join(WATCH_FOLDER, ".spooler_index.jsonl")
+DEDUCTION_JOURNAL_PATH = config.get("deduction_journal_path") or os.path.join(WATCH_FOLDER, ".spooler_deductions.jsonl")
+PRINT_SESSIONS_PATH = config.get("print_sessions_path") or os.path.join(WATCH_FOLDER, ".spooler_sessions.json")
+HANDOFF_PORT = config.get("handoff_port", 7913)  # localhost port copy_to_watch.py sends metadata to, 0 = off
+HANDOFF_TOKEN_PATH = os.path.join(SCRIPT_DIR, ".spooler_handoff_token")  # used when handoff_token isn't set
+HANDOFF_TTL = config.get("handoff_ttl", 7 * 24 * 3600)  # seconds a handed-off job is kept in the index without a file
+DEDUCTION_BATCH_SIZE = config.get("deduction_batch_size", 20)  # spools per drain round
+DEDUCTION_RETRY_MAX = config.get("deduction_retry_max", 300)  # seconds, cap for the retry delay while Spoolman is down
+PENDING_JOBS_MAX = config.get("pending_jobs_max", 10000)  # jobs kept in memory, older ones are reloaded from the metadata index, 0 = no cap
+WATCH_RECURSIVE = config.get("watch_recursive", False)  # also watch subfolders of the watch folder(s)
+SPOOLMAN_EVENTS = config.get("spoolman_events", True)  # follow Spoolman's change events in always running mode
+SPOOLMAN_EVENTS_URL = config.get("spoolman_events_url")  # default: the websocket on the active Spoolman url
+
+
+def load_printers():
+    """
+    "printers" is a list of {"name", "sdcp_ws_url", "watch_folder"}. watch_folder is optional, a relative path is a subfolder of watch_folder.
+    Without a "printers" list it is the single printer at sdcp_ws_url, same as before.
+    """
+    entries = config.get("printers") or [{"name": "", "sdcp_ws_url": SDCP_WS_URL}]
+    printers = []
+    for i, entry in enumerate(entries):
+        folder = entry.get("watch_folder")
+        if folder and not os.path.isabs(folder):
+            folder = os.path.join(WATCH_FOLDER, folder)
+        printers.append({
+            "name": entry.get("name") or (f"printer{i + 1}" if len(entries) > 1 else ""),
+            "sdcp_ws_url": entry["sdcp_ws_url"],
+            "watch_folder": folder,  # None = the main watch folder
+        })
+    return printers
+
+PRINTERS = load_printers()
+
+
+# -----------------------------
+# STARTUP PROFILE
+# -----------------------------
+"""
+--startup-profile prints how long each startup step took, counted from the top of this file.
+The one that matters for one time mode is "websocket connected", the printer sends the print start status soon after the first layer begins.
+"""
+startup_profile = False
+startup_marks = {}  # label -> seconds since STARTUP_T0
+
+
+def mark_startup(label):
+    if label in startup_marks:
+        return
+    startup_marks[label] = time.perf_counter() - STARTUP_T0
+    if startup_profile:
+        print(f"[PROFILE] {startup_marks[label] * 1000:8.1f} ms  {label}")
+
+
+mark_startup("imports + config loaded")
 
 
 # -----------------------------
 # GLOBAL STATE
 # -----------------------------
-pending_jobs = {}   # filename → metadata
-spool_cache = []    # list of spools from Spoolman
+# pending_jobs (job key → JobRecord) is set up in JOB REGISTRY
+job_waiters = {}    # job key → future, resolved by register_job when that file's metadata arrives
 shutdown_event = asyncio.Event()
 
 
 # -----------------------------
-# SPOOLMAN API (v1)
+# METRICS
 # -----------------------------
-def refresh_spool_cache():
+"""
+Counters, gauges and histograms for every stage of the pipeline, kept in memory, no extra dependencies.
+    - metrics_port: served on http://127.0.0.1:<port>/metrics in the Prometheus text format, 0 = off
+    - metrics_log_interval: printed as one JSON line every n seconds ("[METRICS] {...}"), 0 = off
+Names follow the Prometheus conventions (spooler_ prefix, _total for counters, base units). Labels are keyword arguments.
+Updated from the loop and from the parser threads, so every update takes the lock. Parses that run in the scan process pool
+(scan_use_processes) happen in another process and are not counted.
+"""
+METRICS_PORT = config.get("metrics_port", 0)
+METRICS_LOG_INTERVAL = config.get("metrics_log_interval", 0)  # seconds, 0 = off
+LOOP_LAG_INTERVAL = 0.5  # seconds between loop lag samples
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(4 ** i * 1024 for i in range(10))  # 1 KB .. 256 MB
+
+METRIC_HELP = {
+    "spooler_parse_seconds": ("histogram", "Time to read the filament metadata from one G-code"),
+    "spooler_parse_bytes": ("histogram", "Bytes read from disk to parse one G-code"),
+    "spooler_http_request_seconds": ("histogram", "Spoolman request latency per endpoint"),
+    "spooler_spool_refresh_seconds": ("histogram", "Full spool inventory download"),
+    "spooler_match_seconds": ("histogram", "Matching one preset to a spool, memoized lookups excluded"),
+    "spooler_start_to_deduction_seconds": ("histogram", "Print start detected to deduction accepted by Spoolman"),
+    "spooler_jobs_ingested_total": ("counter", "Jobs registered, by where their metadata came from"),
+    "spooler_matches_total": ("counter", "Presets matched at print start, by matching stage"),
+    "spooler_failures_total": ("counter", "Failures, by kind"),
+    "spooler_reconnects_total": ("counter", "Websocket reconnects, by target"),
+    "spooler_loop_lag_seconds": ("gauge", "How late the event loop ran the last lag sample"),
+    "spooler_loop_lag_samples_seconds": ("histogram", "Every loop lag sample, so a stall between two scrapes still shows"),
+    "spooler_pending_deductions": ("gauge", "Deductions in the journal not yet accepted by Spoolman"),
+}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # per bucket, the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket the q-th observation falls in. Good enough for a log line.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value, labels is a sorted tuple of (label, value)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(BYTES_BUCKETS if name.endswith("_bytes") else SECONDS_BUCKETS)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def series(name, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return name
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        return name + "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+    def render(self):
+        """
+        Prometheus text exposition format.
+        """
+        with self.lock:
+            by_name = {}
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges), ("histogram", self.histograms)):
+                for (name, labels), value in values.items():
+                    by_name.setdefault(name, (kind, []))[1].append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, samples = by_name[name]
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, (kind, name))[1]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples, key=lambda s: s[0]):
+                if kind != "histogram":
+                    lines.append(f"{self.series(name, labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds + (float("inf"),), value.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{self.series(name + '_bucket', labels, (('le', le),))} {cumulative}")
+                lines.append(f"{self.series(name + '_sum', labels)} {value.sum}")
+                lines.append(f"{self.series(name + '_count', labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        The same numbers as a dict for the JSON log. Histograms are summarised as count, sum, p50 and p95.
+        """
+        with self.lock:
+            return {
+                "counters": {self.series(name, labels): value for (name, labels), value in self.counters.items()},
+                "gauges": {self.series(name, labels): value for (name, labels), value in self.gauges.items()},
+                "histograms": {
+                    self.series(name, labels): {"count": h.count, "sum": round(h.sum, 6), "p50": h.quantile(0.5), "p95": h.quantile(0.95)}
+                    for (name, labels), h in self.histograms.items()
+                },
+            }
+
+
+metrics = Metrics()
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
     """
-    Ensuring we always have the latest spool information
+    Sleeps for interval and records how much later than that it woke up. Anything blocking the loop shows up here.
     """
-    global spool_cache
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.set("spooler_loop_lag_seconds", round(lag, 6))
+        metrics.observe("spooler_loop_lag_samples_seconds", lag)
+
+
+async def log_metrics(interval=None):
+    interval = interval or METRICS_LOG_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        print(f"[METRICS] {json.dumps({'ts': round(time.time(), 3), **metrics.snapshot()})}")
+
+
+async def handle_metrics_request(reader, writer):
     try:
-        r = requests.get(f"{SPOOLMAN_URL}/api/v1/spool")
-        r.raise_for_status()
-        spool_cache = r.json()
-        print(f"[SPOOLMAN] Loaded {len(spool_cache)} spools")
-    except:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Headers are not needed, but read them so the client isn't cut off mid request
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+    except Exception as e:
+        print(f"[METRICS] Bad request: {e}")
+    finally:
+        try:
+            await writer.drain()
+            writer.close()
+        except Exception:
+            pass
+
+
+async def start_metrics_server(port=None):
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, "127.0.0.1", port)
+    except OSError as e:
+        print(f"[METRICS] Could not listen on port {port}: {e}")
+        return None
+    print(f"[METRICS] Serving on http://127.0.0.1:{port}/metrics")
+    return server
+
+
+"""
+profile_job captures a cProfile of one job's parse, which runs in an ingest thread so nothing else ends up in its profile. Set it to a job
+key (the filename, see job_key) or "*" for the next job that gets parsed. Written to profile_dir as <job>.<stage>.prof, open them with
+python -m pstats or snakeviz. Profiling slows that job down, so it is opt-in.
+Print start isn't profiled: it runs on the event loop across awaits, so its profile would be mostly whatever else the loop did meanwhile.
+"""
+class JobProfiler:
+    def __init__(self, target, folder):
+        self.target = target
+        self.folder = folder
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        with self.lock:
+            if not self.target or self.target not in ("*", key):
+                return False
+            self.target = None  # one job only
+            return True
+
+    @contextlib.contextmanager
+    def capture(self, key, stage):
+        if not self.target or not self.claim(key):
+            yield
+            return
+
+        import cProfile
+
+        profiler = cProfile.Profile()
         try:
-            r = requests.get(f"{SPOOLMAN_URL}/api/v1/spool")
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows one profiler at a time, e.g. the whole daemon is already running under cProfile
+            print(f"[PROFILE] Not profiling {stage} of {key}, another profiler is active: {e}")
+            profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                path = os.path.join(self.folder, f"{key.replace('/', '_')}.{stage}.prof")
+                try:
+                    os.makedirs(self.folder, exist_ok=True)
+                    profiler.dump_stats(path)
+                    print(f"[PROFILE] {stage} of {key} written to {path}")
+                except OSError as e:
+                    print(f"[PROFILE] Failed to write {path}: {e}")
+
+
+job_profiler = JobProfiler(config.get("profile_job"), config.get("profile_dir") or os.path.join(WATCH_FOLDER, ".spooler_profiles"))
+
+
+# -----------------------------
+# SPOOLMAN API (v1)
+# -----------------------------
+"""
+All Spoolman calls go through one pooled requests.Session and run in worker threads, so the websocket loop and keepalive never stall on HTTP.
+spoolman_url is tried first, spoolman_local_url is the fallback if it is unreachable.
+"""
+class SpoolmanClient:
+    def __init__(self, urls, timeout=5, retries=2, pool_size=8):
+        self.urls = [u.rstrip("/") for u in urls if u]
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.active_url = self.urls[0] if self.urls else None
+        self.session = None  # created on first request, see get_session
+        self.session_lock = threading.Lock()
+
+    def get_session(self):
+        with self.session_lock:
+            if self.session is None:
+                self.session = self.make_session()
+            return self.session
+
+    def make_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Connect errors are retried for every method, the request never reached Spoolman. A read timeout or a 502/503/504 from a proxy
+        # may come after Spoolman already deducted, so those are only retried for GET. PUT /use is not idempotent.
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=self.retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=len(self.urls) or 1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def request(self, method, path, **kwargs):
+        """
+        Blocking request. Tries the last working url first and then the others.
+        Only a failed connect moves on to the next url. A read timeout is raised as is, the request may have been handled already
+        and spoolman_url and spoolman_local_url are usually the same server.
+        """
+        import requests
+
+        session = self.get_session()
+        kwargs.setdefault("timeout", self.timeout)
+        order = [self.active_url] + [u for u in self.urls if u != self.active_url]
+        last_error = None
+
+        endpoint = re.sub(r"/\d+", "/{id}", path)
+        for base in order:
+            start = time.perf_counter()
+            try:
+                r = session.request(method, f"{base}{path}", **kwargs)
+            except requests.ConnectionError as e:  # includes ConnectTimeout, not ReadTimeout
+                metrics.inc("spooler_failures_total", kind="spoolman_unreachable")
+                last_error = e
+                if method != "GET" and not self.never_connected(e):
+                    raise  # dropped after it was sent, eg "Connection aborted". Spoolman may have deducted already
+                continue
+            finally:
+                metrics.observe("spooler_http_request_seconds", time.perf_counter() - start, method=method, endpoint=endpoint)
+
+            if base != self.active_url:
+                print(f"[SPOOLMAN] Switched to {base}")
+                self.active_url = base
             r.raise_for_status()
-            spool_cache = r.json()
-            print(f"[SPOOLMAN] Loaded {len(spool_cache)} spools")
-        except Exception as e:
-            print(f"[SPOOLMAN] Failed to load spools: {e}")
+            return r
+
+        raise last_error or requests.ConnectionError("No Spoolman url configured")
+
+    @staticmethod
+    def never_connected(error):
+        from urllib3.exceptions import NewConnectionError
+        import requests
+
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def unanswered(error):
+        """
+        True if the request was sent but no reply came back (read timeout, connection dropped), so Spoolman may have handled it.
+        """
+        import requests
+
+        if isinstance(error, requests.ReadTimeout):
+            return True
+        return isinstance(error, requests.ConnectionError) and not SpoolmanClient.never_connected(error)
+
+    async def get_spools(self):
+        r = await asyncio.to_thread(self.request, "GET", "/api/v1/spool")
+        return r.json()
+
+    async def get_spool(self, spool_id):
+        r = await asyncio.to_thread(self.request, "GET", f"/api/v1/spool/{spool_id}")
+        return r.json()
+
+    def events_url(self):
+        """
+        Spoolman's websocket for change events on every resource. Same host as the active url unless spoolman_events_url is set.
+        """
+        if SPOOLMAN_EVENTS_URL:
+            return SPOOLMAN_EVENTS_URL
+        base = self.active_url or ""
+        return ("ws" + base[4:] if base.startswith("http") else base) + "/api/v1/"
+
+    async def use_spool(self, spool_id, filament_g):
+        r = await asyncio.to_thread(self.request, "PUT", f"/api/v1/spool/{spool_id}/use", json={"use_weight": filament_g})
+        return r.json()
+
+    def refund(self, spool_id, filament_g):
+        """
+        Blocking. Gives filament_g back to a spool (a print stopped early, see handle_print_end). Spoolman's /use takes a negative
+        use_weight, but should a Spoolman refuse one (400 / 422) the spool's used_weight is lowered with a PATCH instead.
+        """
+        import requests
 
+        try:
+            return self.request("PUT", f"/api/v1/spool/{spool_id}/use", json={"use_weight": -filament_g}).json()
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in (400, 422):
+                raise
+        spool = self.request("GET", f"/api/v1/spool/{spool_id}").json()
+        used = max(0.0, (spool.get("used_weight") or 0.0) - filament_g)
+        return self.request("PATCH", f"/api/v1/spool/{spool_id}", json={"used_weight": used}).json()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+spoolman = SpoolmanClient(
+    [SPOOLMAN_URL, SPOOLMAN_LOCAL_URL],
+    timeout=config.get("spoolman_timeout", 5),
+    retries=config.get("spoolman_retries", 2),
+    pool_size=config.get("spoolman_pool_size", 8),
+)
 
-def update_spoolman(spool_id, filament_g):
+
+RETRYABLE_4XX = (408, 409, 425, 429)  # client errors that can go away by themselves
+UNANSWERED = "unanswered"  # update_spoolman result when Spoolman may or may not have taken it
+
+
+async def update_spoolman(spool_id, filament_g):
     """
     This is what we use to actually deduct filament from a spool.
     after we have gained our spool_id by matching in find_spool_for_preset it will then deduct the filament_g that we obtained from the GCODE.
+    Returns True if Spoolman accepted it, None if it rejected it for good (eg 404, the spool was deleted), False if it is worth trying again,
+    UNANSWERED if it was sent but no reply came back. Sending that again could deduct it twice, see DeductionQueue.check_unanswered.
     """
-    url = f"{SPOOLMAN_URL}/api/v1/spool/{spool_id}/use"
-    payload = {"use_weight": filament_g}
-
     try:
-        r = requests.put(url, json=payload)
-        r.raise_for_status()
-        print(f"[SPOOLMAN] Subtracted {filament_g}g from spool {spool_id}")
+        if filament_g < 0:
+            spool = await asyncio.to_thread(spoolman.refund, spool_id, -filament_g)
+            print(f"[SPOOLMAN] Gave {-filament_g}g back to spool {spool_id}")
+        else:
+            spool = await spoolman.use_spool(spool_id, filament_g)
+            print(f"[SPOOLMAN] Subtracted {filament_g}g from spool {spool_id}")
+        # Spoolman hands back the updated spool, keep the cached weight in step with it
+        spool_cache.patch([spool])
+        return True
     except Exception as e:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        if status is not None and 400 <= status < 500 and status not in RETRYABLE_4XX:
+            metrics.inc("spooler_failures_total", kind="rejected")
+            print(f"[SPOOLMAN] Spoolman rejected {filament_g}g for spool {spool_id} ({status}), not retrying: {e}")
+            return None
+        if SpoolmanClient.unanswered(e):
+            metrics.inc("spooler_failures_total", kind="unanswered")
+            print(f"[SPOOLMAN] No reply to {filament_g}g for spool {spool_id}, Spoolman may have taken it: {e}")
+            return UNANSWERED
+        metrics.inc("spooler_failures_total", kind="deduction")
         print(f"[SPOOLMAN] Error updating spool: {e}")
+        return False
+
+
+async def deduct_filament(deductions):
+    """
+    deductions is a list of (spool_id, filament_g). Every spool is updated at the same time rather than one after the other.
+    """
+    return await asyncio.gather(*(update_spoolman(spool_id, filament_g) for spool_id, filament_g in deductions))
 
 
 # -----------------------------
@@ -90,22 +591,175 @@ def split_preset_name(preset):
     return vendor, material, color
 
 
-def find_spool_for_preset(preset):
+def normalize_name(value):
+    return (value or "").strip().lower()
+
+
+def spool_match_fields(spool):
+    """
+    Returns the normalized (vendor, material, color) of a spool.
+    Spoolman keeps these on the filament, the color being the filament name. Falls back to top level keys if the filament block is missing them.
+    """
+    f = spool.get("filament") or {}
+    vendor = (f.get("vendor") or {}).get("name") or spool.get("vendor")
+    material = f.get("material") or spool.get("material")
+    color = f.get("name") or spool.get("color") or spool.get("name")
+    return normalize_name(vendor), normalize_name(material), normalize_name(color)
+
+
+def spool_sort_key(spool):
+    """
+    Tie-break when several spools match the same key:
+    least remaining weight first (finish open spools before starting new ones), then most recently used, then lowest id.
+    """
+    remaining = spool.get("remaining_weight")
+    if remaining is None:
+        remaining = float("inf")
+
+    # Spoolman gives ISO timestamps, never used spools sort after used ones.
+    try:
+        last_used = datetime.fromisoformat(spool["last_used"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        last_used = 0.0
+
+    return (remaining, -last_used, spool.get("id", 0))
+
+
+def spool_index_keys(spool):
+    """
+    The (stage, key) pairs a spool is filed under in the matcher index. Empty for spools that are never matched.
+    """
+    if spool.get("archived") or "id" not in spool:
+        return []
+
+    vendor, material, color = spool_match_fields(spool)
+    if not color:
+        return []
+
+    keys = [("color", color)]
+    if vendor:
+        keys.append(("vendor_color", (vendor, color)))
+        if material:
+            keys.append(("exact", (vendor, material, color)))
+    return keys
+
+
+def build_spool_index(spools):
     """
-    Multi-stage matching using a filament preset string.
+    Builds the matcher index once per spool refresh so find_spool_for_preset is a few dict lookups instead of 3 passes over every spool.
+        "exact":        (vendor, material, color) -> spool id
+        "vendor_color": (vendor, color)           -> spool id
+        "color":        color                     -> spool id
+    Archived spools are never matched. "resolved" (see resolve_preset) and "fuzzy" (see FuzzySpoolIndex) are filled in lazily,
+    so they go away with the rest of the index whenever the spool cache changes.
+    """
+    best = {"exact": {}, "vendor_color": {}, "color": {}}
+
+    for spool in spools:
+        keys = spool_index_keys(spool)
+        if not keys:
+            continue
+
+        sort_key = spool_sort_key(spool)
+        for stage, key in keys:
+            current = best[stage].get(key)
+            if current is None or sort_key < current[0]:
+                best[stage][key] = (sort_key, spool["id"])
+
+    return {stage: {key: spool_id for key, (_, spool_id) in entries.items()} for stage, entries in best.items()}
+
+
+# -----------------------------
+# FUZZY PRESET MATCHING
+# -----------------------------
+"""
+Last resort before the color only pass, for presets that are nearly right ("Elegoo - PLA - Blak", or "ELEGOO PLA Black" without the dashes).
+Every distinct vendor / material / color name in the inventory is split into character trigrams, with an inverted index trigram -> names per field,
+so only names sharing at least one trigram with the preset are ever scored.
+    split preset:    Dice similarity per field, 2 * shared / (preset trigrams + name trigrams)
+    unsplit preset:  how much of each name is found anywhere in the preset
+Fields are weighted vendor 1, material 2, color 2, so a spool with the right vendor and color but the wrong material can't reach the default threshold.
+Only spools with all three names set take part.
+"""
+FUZZY_MATCH_THRESHOLD = config.get("fuzzy_match_threshold", 0.75)  # 0-1, anything above 1 turns fuzzy matching off
+FUZZY_FIELD_WEIGHTS = (1, 2, 2)  # vendor, material, color
+FUZZY_SPLIT_RE = re.compile(r"[\s_\-]+")
+
+
+def name_trigrams(value):
+    padded = " " + " ".join(FUZZY_SPLIT_RE.split(value.lower())).strip() + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzySpoolIndex:
+    def __init__(self, exact):
+        """
+        exact is the "exact" stage of the matcher index, (vendor, material, color) -> best spool id.
+        """
+        self.triples = exact
+        self.by_color = {}              # color -> [(vendor, material)]
+        self.grams = ({}, {}, {})       # per field: name -> trigram set
+        self.postings = ({}, {}, {})    # per field: trigram -> [names]
+        for vendor, material, color in exact:
+            self.by_color.setdefault(color, []).append((vendor, material))
+            for field, name in enumerate((vendor, material, color)):
+                if name in self.grams[field]:
+                    continue
+                grams = name_trigrams(name)
+                self.grams[field][name] = grams
+                for gram in grams:
+                    self.postings[field].setdefault(gram, []).append(name)
+
+    def similar(self, field, query, contained):
+        """
+        name -> similarity for every name in this field that shares a trigram with the query.
+        """
+        query_grams = name_trigrams(query)
+        shared = {}
+        for gram in query_grams:
+            for name in self.postings[field].get(gram, ()):
+                shared[name] = shared.get(name, 0) + 1
+        names = self.grams[field]
+        if contained:
+            return {name: count / len(names[name]) for name, count in shared.items()}
+        return {name: 2 * count / (len(query_grams) + len(names[name])) for name, count in shared.items()}
+
+    def match(self, preset):
+        """
+        Returns (spool_id, confidence) of the best scoring spool, (None, 0.0) if no spool shares a trigram with the preset's color.
+        """
+        vendor, material, color = split_preset_name(preset)
+        contained = not (vendor and material and color)
+        queries = (preset, preset, preset) if contained else (vendor, material, color)
+        vendor_sim, material_sim, color_sim = (self.similar(field, query, contained) for field, query in enumerate(queries))
+
+        w_vendor, w_material, w_color = FUZZY_FIELD_WEIGHTS
+        total = w_vendor + w_material + w_color
+        best = (None, 0.0, 0)
+        for color_name, c_sim in color_sim.items():
+            for vendor_name, material_name in self.by_color[color_name]:
+                score = (w_vendor * vendor_sim.get(vendor_name, 0.0) + w_material * material_sim.get(material_name, 0.0) + w_color * c_sim) / total
+                # On a tie the longer names win, "dark red" over "red" when the preset has both
+                specificity = len(vendor_name) + len(material_name) + len(color_name)
+                if (score, specificity) > best[1:]:
+                    best = (self.triples[(vendor_name, material_name, color_name)], score, specificity)
+        return best[0], round(best[1], 3)
+
+
+def match_preset(preset, spool_index):
+    """
+    Multi-stage matching using a filament preset string. Returns (spool_id, stage, confidence).
     1. Exact vendor + material + color
     2. Vendor + color
-    3. Color only
+    3. Fuzzy vendor + material + color, if the confidence reaches fuzzy_match_threshold
+    4. Color only
     """
     vendor, material, color = split_preset_name(preset)
-    if not vendor or not material or not color:
-        print(f"[MATCH] Invalid preset format: '{preset}'")
-        return None
+    vendor_l = normalize_name(vendor)
+    material_l = normalize_name(material)
+    color_l = normalize_name(color)
+    valid = vendor_l and material_l and color_l
 
-    vendor_l = vendor.lower()
-    material_l = material.lower()
-    color_l = color.lower()
-    
     """
     I have made 3 options here. But I prefer the first and will do my best to always match to that over all else.
     Reason: We want to filter spoolman completely for when we may have a big inventory of spools from various manufactorers and / or different material types that share the same color name.
@@ -113,52 +767,1475 @@ def find_spool_for_preset(preset):
     EG ELEGOO - Yellow - PLA would match in the second and third options against ELEGOO - Yellow - PETG. Which really is not ideal. I may even refactor this and remove the other options in the future if I run into any issues.
     I just thought it would be best to have some back up options. That being said, if we setup our spools properly in both orca AND spoolman, than it will never be a problem.
     """
-    # Exact match: vendor + material + color (color from 'color' or 'name')
-    for spool in spool_cache:
-        f = spool.get("filament", {})
-        s_vendor = f.get("vendor", {}).get("name", "").lower()
-        s_material = f.get("material", "").lower()
-        s_color = f.get("name", "").lower()
+    if valid:
+        # Exact match: vendor + material + color
+        spool_id = spool_index.get("exact", {}).get((vendor_l, material_l, color_l))
+        if spool_id is not None:
+            return spool_id, "exact", 1.0
+
+        # Vendor + color
+        spool_id = spool_index.get("vendor_color", {}).get((vendor_l, color_l))
+        if spool_id is not None:
+            return spool_id, "vendor_color", 1.0
+
+    # Near misses, and presets that aren't in the "Vendor - Material - Color" format at all
+    if FUZZY_MATCH_THRESHOLD <= 1 and spool_index.get("exact"):
+        fuzzy = spool_index.get("fuzzy")
+        if fuzzy is None:
+            fuzzy = spool_index["fuzzy"] = FuzzySpoolIndex(spool_index["exact"])
+        spool_id, confidence = fuzzy.match(preset)
+        if spool_id is not None and confidence >= FUZZY_MATCH_THRESHOLD:
+            return spool_id, "fuzzy", confidence
+
+    if not valid:
+        return None, None, 0.0
+
+    # Color only
+    spool_id = spool_index.get("color", {}).get(color_l)
+    return spool_id, ("color" if spool_id is not None else None), (1.0 if spool_id is not None else 0.0)
 
-        if s_vendor == vendor_l and s_material == material_l and s_color == color_l:
-            return spool["id"]
 
-    # Vendor + color
-    for spool in spool_cache:
-        s_vendor = spool.get("vendor", "").lower()
-        s_color = (spool.get("color") or spool.get("name", "")).lower()
+def resolve_preset(preset):
+    """
+    match_preset, memoized per preset string in the current matcher index. Every print of the same presets after the first is a dict lookup,
+    and a spool refresh / patch rebuilds the index, which drops the memo with it.
+    """
+    spool_index = spool_cache.index
+    resolved = spool_index.setdefault("resolved", {})
+    result = resolved.get(preset)
+    if result is None:
+        with metrics.timer("spooler_match_seconds"):
+            result = resolved[preset] = match_preset(preset, spool_index)
+        spool_id, stage, confidence = result
+        if stage == "fuzzy":
+            print(f"[MATCH] '{preset}' fuzzy matched to spool {spool_id} (confidence {confidence})")
+        elif stage is None and None in split_preset_name(preset):
+            print(f"[MATCH] Invalid preset format: '{preset}'")
+    return result
 
-        if s_vendor == vendor_l and s_color == color_l:
-            return spool["id"]
 
-    # Color only
-    for spool in spool_cache:
-        s_color = (spool.get("color") or spool.get("name", "")).lower()
-        if s_color == color_l:
-            return spool["id"]
+def find_spool_for_preset(preset):
+    return resolve_preset(preset)[0]
 
+# -----------------------------
+# SPOOL CACHE
+# -----------------------------
+"""
+Holds the spool list and matcher index between prints so a print start doesn't have to download the whole inventory first.
+    - Fresh (younger than spool_cache_ttl): used as-is.
+    - Stale: still used straight away, a full refresh runs in the background (stale-while-revalidate).
+    - Empty: the only case where a print start waits on the full download.
+Before deducting, only the spools we actually matched are re-fetched by id, and that is capped by spool_revalidate_timeout so a slow Spoolman never holds up the deduction.
+In always running mode the cache also follows Spoolman's change events (see watch_events). While that subscription is up the cache is
+never stale and print starts make no Spoolman calls at all before deducting. Polling only comes back while the subscription is down.
+Changes after the first load are applied incrementally: only the index keys the changed spools were or are filed under are re-ranked.
+"""
+class SpoolCache:
+    def __init__(self, client, ttl=300, revalidate_timeout=2):
+        self.client = client
+        self.ttl = ttl
+        self.revalidate_timeout = revalidate_timeout
+        self.by_id = {}     # spool id -> spool
+        self.members = {}   # (stage, key) -> ids of every spool filed under that key, see spool_index_keys
+        self.index = {}     # matcher index, see build_spool_index
+        self.loaded_at = None
+        self.refresh_task = None
+        self.subscribed = False  # True while watch_events is connected and caught up
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "revalidations": 0, "failures": 0, "events": 0}
+
+    @property
+    def spools(self):
+        return list(self.by_id.values())
+
+    def load(self, spools):
+        self.by_id = {s["id"]: s for s in spools if "id" in s}
+        self.members = {}
+        for spool in self.by_id.values():
+            for index_key in spool_index_keys(spool):
+                self.members.setdefault(index_key, set()).add(spool["id"])
+        self.index = build_spool_index(spools)
+        self.loaded_at = time.monotonic()
+
+    def apply(self, updated=(), removed=()):
+        """
+        Swaps changed spools into the cache and drops removed ids, then re-ranks only the index keys they touch.
+        The memoized preset resolutions are dropped, the fuzzy index only if a vendor / material / color combination came or went.
+        """
+        touched = set()
+
+        def unfile(spool_id):
+            old = self.by_id.pop(spool_id, None)
+            for index_key in spool_index_keys(old) if old else ():
+                self.members[index_key].discard(spool_id)
+                touched.add(index_key)
+
+        for spool_id in removed:
+            unfile(spool_id)
+        for spool in updated:
+            unfile(spool["id"])
+            self.by_id[spool["id"]] = spool
+            for index_key in spool_index_keys(spool):
+                self.members.setdefault(index_key, set()).add(spool["id"])
+                touched.add(index_key)
+
+        if not touched:
+            return
+        combinations_changed = False
+        for stage, key in touched:
+            entries = self.index.setdefault(stage, {})
+            ids = self.members.get((stage, key))
+            if ids:
+                combinations_changed = combinations_changed or (stage == "exact" and key not in entries)
+                entries[key] = min(ids, key=lambda i: spool_sort_key(self.by_id[i]))
+            else:
+                self.members.pop((stage, key), None)
+                combinations_changed = combinations_changed or (stage == "exact" and key in entries)
+                entries.pop(key, None)
+
+        self.index.pop("resolved", None)
+        if combinations_changed:
+            self.index.pop("fuzzy", None)
+
+    def patch(self, spools):
+        """
+        Swap updated spools (eg the response from /use) into the cache without a refetch.
+        """
+        self.apply(updated=[s for s in spools if isinstance(s, dict) and "id" in s])
+
+    def is_stale(self):
+        if self.subscribed:
+            return False
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    async def refresh(self):
+        """
+        Full inventory download. Returns True if it loaded.
+        Concurrent callers (eg several printers starting at once) share the one download in flight.
+        """
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.download())
+        return await asyncio.shield(self.refresh_task)
+
+    async def download(self):
+        mark_startup("first spool refresh started")
+        self.stats["refreshes"] += 1
+        start = time.perf_counter()
+        try:
+            spools = await self.client.get_spools()
+        except Exception as e:
+            self.stats["failures"] += 1
+            metrics.inc("spooler_failures_total", kind="spool_refresh")
+            print(f"[SPOOLMAN] Failed to load spools: {e}")
+            return False
+
+        self.load(spools)
+        metrics.observe("spooler_spool_refresh_seconds", time.perf_counter() - start)
+        mark_startup("spool cache loaded")
+        print(f"[SPOOLMAN] Loaded {len(spools)} spools")
+        return True
+
+    def refresh_in_background(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.download())
+
+    async def ensure_fresh(self):
+        """
+        Called at print start. Only blocks when there is nothing cached at all.
+        """
+        if self.loaded_at is None:
+            self.stats["misses"] += 1
+            await self.refresh()
+        elif self.is_stale():
+            self.stats["stale_hits"] += 1
+            self.refresh_in_background()
+        else:
+            self.stats["hits"] += 1
+
+    async def revalidate(self, spool_ids):
+        """
+        Re-fetch just these spools by id and patch them into the cache.
+        Returns True if any of them changed in a way that could change matching (archived, deleted, weight).
+        """
+        spool_ids = list(dict.fromkeys(spool_ids))
+        if not spool_ids or self.subscribed:
+            return False
+
+        self.stats["revalidations"] += 1
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(self.client.get_spool(i) for i in spool_ids), return_exceptions=True),
+                timeout=self.revalidate_timeout,
+            )
+        except asyncio.TimeoutError:
+            self.stats["failures"] += 1
+            print("[SPOOLMAN] Revalidation timed out, using cached spools")
+            return False
+
+        import requests
+
+        changed = False
+        updated, removed = [], []
+        for spool_id, result in zip(spool_ids, results):
+            if isinstance(result, requests.HTTPError) and result.response is not None and result.response.status_code == 404:
+                # Deleted in Spoolman since we last loaded
+                removed.append(spool_id)
+                changed = True
+            elif isinstance(result, Exception):
+                self.stats["failures"] += 1
+            else:
+                old = self.by_id.get(spool_id)
+                if old != result:
+                    changed = changed or old is None or spool_match_fields(old) != spool_match_fields(result) \
+                        or old.get("archived") != result.get("archived") or old.get("remaining_weight") != result.get("remaining_weight")
+                    updated.append(result)
+
+        self.apply(updated, removed)
+        return changed
+
+    async def background_refresher(self):
+        """
+        Keeps the cache warm in always running mode so print starts are normally a plain cache hit.
+        Idle while watch_events is subscribed.
+        """
+        while True:
+            await asyncio.sleep(self.ttl)
+            if not self.subscribed:
+                await self.refresh()
+
+    def apply_event(self, event):
+        """
+        One Spoolman change event: {"type": "added" | "updated" | "deleted", "resource": "spool" | "filament" | "vendor", "payload": {...}}.
+        Filament and vendor changes are copied into every spool that embeds them.
+        """
+        kind = event.get("type")
+        resource = event.get("resource")
+        payload = event.get("payload") or {}
+        if "id" not in payload:
+            return
+        self.stats["events"] += 1
+
+        if resource == "spool":
+            if kind == "deleted":
+                self.apply(removed=[payload["id"]])
+            else:
+                self.apply(updated=[payload])
+        elif resource == "filament":
+            users = [s for s in self.by_id.values() if (s.get("filament") or {}).get("id") == payload["id"]]
+            if kind == "deleted":
+                self.apply(removed=[s["id"] for s in users])
+            else:
+                self.apply(updated=[{**s, "filament": payload} for s in users])
+        elif resource == "vendor":
+            users = [s for s in self.by_id.values() if ((s.get("filament") or {}).get("vendor") or {}).get("id") == payload["id"]]
+            vendor = None if kind == "deleted" else payload
+            self.apply(updated=[{**s, "filament": {**s["filament"], "vendor": vendor}} for s in users])
+
+    async def watch_events(self, backoff_max=SDCP_BACKOFF_MAX):
+        """
+        Subscribes to Spoolman's websocket (/api/v1/, every resource) and applies change events as they arrive.
+        Every (re)connect does one full refresh first, to pick up whatever changed while we weren't listening.
+        Older Spoolman versions without the websocket API just never connect, and the cache keeps polling as before.
+        """
+        attempt = 0
+        while True:
+            url = self.client.events_url()
+            try:
+                async with websockets.connect(url) as ws:
+                    # Events that arrive during the refresh wait in the socket and are applied after it, applying one twice is harmless
+                    if not await self.refresh():
+                        raise ConnectionError("full refresh failed")
+                    self.subscribed = True
+                    attempt = 0
+                    print(f"[SPOOLMAN] Subscribed to change events at {url}")
+                    async for msg in ws:
+                        try:
+                            self.apply_event(json.loads(msg))
+                        except (ValueError, TypeError, AttributeError, KeyError) as e:
+                            print(f"[SPOOLMAN] Ignoring malformed change event: {e}")
+                print("[SPOOLMAN] Change event stream closed, polling until it is back")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == 0:
+                    print(f"[SPOOLMAN] Change events unavailable ({e}), polling every {self.ttl}s until they are back")
+            finally:
+                if self.subscribed and self.loaded_at is not None:
+                    # Events may be missed from here on, so the cache goes back to being refreshed / revalidated like before
+                    self.loaded_at = time.monotonic() - self.ttl - 1
+                self.subscribed = False
+
+            metrics.inc("spooler_reconnects_total", target="spoolman_events")
+            await asyncio.sleep(random.uniform(0, min(backoff_max, 2 ** attempt)))
+            attempt += 1
+
+    def stats_line(self):
+        return ", ".join(f"{k}={v}" for k, v in self.stats.items())
+
+
+spool_cache = SpoolCache(
+    spoolman,
+    ttl=config.get("spool_cache_ttl", 300),
+    revalidate_timeout=config.get("spool_revalidate_timeout", 2),
+)
+
+
+async def refresh_spool_cache():
+    """
+    Ensuring we always have the latest spool information
+    """
+    return await spool_cache.refresh()
+
+
+# -----------------------------
+# DEDUCTION JOURNAL
+# -----------------------------
+"""
+Every deduction is written to an append-only journal before Spoolman is called, so nothing is lost if Spoolman is down or the daemon dies mid print.
+    {"op": "add", "id", "job", "spool_id", "grams", "ts"}  - a deduction we owe Spoolman. The first one of a print also has its print
+                                                             session, so it is recorded as charged in the same write (see PrintSessions.recover),
+                                                             and its "ledger" keys
+    {"op": "done", "id"}                                     - Spoolman has taken it
+    {"op": "dead", "id", "status", ...the add entry}         - Spoolman rejected it for good (4xx, eg a deleted spool), never retried
+    {"op": "charged", "keys"}                                - charged ledger keys with no deduction of their own, and all of them after compaction
+    {"op": "unanswered", "ids", "spool_id", "grams",         - these were sent as one /use but no reply came back, see check_unanswered
+     "used_weight", "batch"}
+The charged ledger is every print ever charged, by printer + TaskId (see PrintSessions.task_key), plus the files --reconcile charged without
+a print history. Unlike the print sessions it is never trimmed, so --reconcile can tell what was charged however long ago.
+A background drainer sends pending deductions in batches, one /use call per spool (several jobs for the same spool are summed).
+If a batch fails it backs off exponentially up to deduction_retry_max and tries again. Pending entries are picked up again on restart.
+A /use that was sent but never answered (read timeout, connection dropped) may still have been taken. It is not sent again blindly:
+the spool's used_weight from before the send is journaled with it, and the next attempt first asks Spoolman whether used_weight has
+moved by that much. If it has, the deduction counts as done. If the used_weight from before isn't known it is dead-lettered for a
+manual look instead. Should someone else use the spool in between it counts as taken, a missed deduction rather than a double one.
+A crash between Spoolman accepting a /use and us writing "done" will still send that deduction again on restart.
+"""
+class DeductionQueue:
+    def __init__(self, path, batch_size=DEDUCTION_BATCH_SIZE, retry_max=DEDUCTION_RETRY_MAX):
+        self.path = path
+        self.batch_size = batch_size
+        self.retry_max = retry_max
+        self.pending = {}       # entry id -> add entry, in journal order
+        self.dead = {}          # entry id -> dead entry, kept through compaction so they can still be looked up
+        self.sessions = []      # print sessions found in the journal by load()
+        self.charged = set()    # charged ledger keys
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()     # set by the drainer whenever nothing is pending
+        self.stats = {"queued": 0, "sent": 0, "rejected": 0, "unanswered": 0, "batches": 0, "failed_batches": 0}
+
+    def load(self):
+        self.pending = {}
+        self.dead = {}
+        self.sessions = []
+        self.charged = set()
+        self.lines = 0
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    self.lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # half written line from a crash
+                    if entry.get("op") == "add":
+                        self.pending[entry["id"]] = entry
+                        if "session" in entry:
+                            self.sessions.append(entry["session"])
+                        self.charged.update(entry.get("ledger", ()))
+                    elif entry.get("op") == "charged":
+                        self.charged.update(entry["keys"])
+                    elif entry.get("op") == "unanswered":
+                        mark = {k: entry[k] for k in ("batch", "grams", "used_weight")}
+                        for entry_id in entry["ids"]:
+                            if entry_id in self.pending:
+                                self.pending[entry_id]["unanswered"] = mark
+                    elif entry.get("op") == "done":
+                        self.pending.pop(entry["id"], None)
+                    elif entry.get("op") == "dead":
+                        self.pending.pop(entry["id"], None)
+                        self.dead[entry["id"]] = entry
+        except FileNotFoundError:
+            pass
+        if self.pending:
+            print(f"[JOURNAL] {len(self.pending)} deductions still pending from last run")
+        return self.pending
+
+    def write(self, entries):
+        """
+        Blocking append + fsync, run through asyncio.to_thread.
+        """
+        with self.lock:
+            with open(self.path, "a") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.lines += len(entries)
+
+    async def enqueue(self, job, deductions, started=None, session=None, ledger=()):
+        """
+        deductions is a list of (spool_id, grams). Returns once they are safely on disk, Spoolman is called later by the drainer.
+        started is when the print start was seen (time.time()), for the start to deduction latency.
+        session is the print session these charge, {"printer", "job", "task_id", "deducted"}, written along with them.
+        ledger is the charged ledger keys these settle, written in the same write.
+        """
+        now = time.time()
+        entries = [{"op": "add", "id": uuid.uuid4().hex, "job": job, "spool_id": spool_id, "grams": grams, "ts": now} for spool_id, grams in deductions]
+        ledger = [key for key in ledger if key]
+        if not entries:
+            # Nothing matched a spool, the print still counts as charged
+            if ledger:
+                await asyncio.to_thread(self.write, [{"op": "charged", "keys": ledger}])
+                self.charged.update(ledger)
+            return
+        if started is not None:
+            for entry in entries:
+                entry["started"] = started
+        if session is not None:
+            entries[0]["session"] = session
+        if ledger:
+            entries[0]["ledger"] = ledger
+        await asyncio.to_thread(self.write, entries)
+        self.charged.update(ledger)
+        for entry in entries:
+            self.pending[entry["id"]] = entry
+        self.stats["queued"] += len(entries)
+        self.idle.clear()
+        self.wakeup.set()
+
+    def next_batch(self):
+        """
+        Groups pending entries by spool, oldest first, up to batch_size spools.
+        Returns {spool_id: [entries]}.
+        """
+        batch = {}
+        for entry in self.pending.values():
+            if entry["spool_id"] not in batch and len(batch) >= self.batch_size:
+                continue
+            batch.setdefault(entry["spool_id"], []).append(entry)
+        return batch
+
+    async def mark_done(self, done):
+        try:
+            await asyncio.to_thread(self.write, [{"op": "done", "id": e["id"]} for e in done])
+        except OSError as e:
+            print(f"[JOURNAL] Failed to mark deductions done: {e}")
+        now = time.time()
+        for entry in done:
+            self.pending.pop(entry["id"], None)
+            if "started" in entry:
+                metrics.observe("spooler_start_to_deduction_seconds", now - entry["started"])
+        self.stats["sent"] += len(done)
+
+    async def mark_dead(self, dead, reason):
+        dead = [{**entry, "op": "dead", "status": reason} for entry in dead]
+        try:
+            await asyncio.to_thread(self.write, dead)
+        except OSError as e:
+            print(f"[JOURNAL] Failed to mark deductions rejected: {e}")
+        for entry in dead:
+            self.pending.pop(entry["id"], None)
+            self.dead[entry["id"]] = entry
+            print(f"[JOURNAL] Dropped {entry['grams']}g for spool {entry['spool_id']} ({entry['job']}): {reason}")
+        self.stats["rejected"] += len(dead)
+
+    async def check_unanswered(self):
+        """
+        Settles the entries whose /use went unanswered before anything is sent again: done if the spool's used_weight moved by at least
+        their grams since, pending as normal if it didn't. Returns False if Spoolman couldn't be asked.
+        """
+        sends = {}  # batch -> [entries]
+        for entry in self.pending.values():
+            if "unanswered" in entry:
+                sends.setdefault(entry["unanswered"]["batch"], []).append(entry)
+
+        for entries in sends.values():
+            mark = entries[0]["unanswered"]
+            spool_id = entries[0]["spool_id"]
+            if mark["used_weight"] is None:
+                await self.mark_dead(entries, "no reply from Spoolman and its used_weight from before is unknown, check the spool by hand")
+                continue
+            try:
+                spool = await spoolman.get_spool(spool_id)
+            except Exception as e:
+                if getattr(getattr(e, "response", None), "status_code", None) == 404:
+                    await self.mark_dead(entries, "spool deleted in Spoolman")
+                    continue
+                print(f"[JOURNAL] Can't check spool {spool_id} for an unanswered deduction yet: {e}")
+                return False
+
+            moved = (spool.get("used_weight") or 0.0) - mark["used_weight"]
+            # grams is negative for a refund, used_weight then has to have come down
+            taken = moved >= mark["grams"] - 0.01 if mark["grams"] >= 0 else moved <= mark["grams"] + 0.01
+            if taken:
+                print(f"[JOURNAL] Spoolman did take the unanswered {mark['grams']}g for spool {spool_id}")
+                spool_cache.patch([spool])
+                await self.mark_done(entries)
+            else:
+                for entry in entries:
+                    del entry["unanswered"]
+        return True
+
+    async def drain_once(self):
+        """
+        Sends one batch. Returns True if every spool in it was accepted.
+        """
+        if not await self.check_unanswered():
+            self.stats["failed_batches"] += 1
+            return False
+
+        batch = self.next_batch()
+        if not batch:
+            return True
+
+        self.stats["batches"] += 1
+        spool_ids = list(batch)
+        totals = [round(sum(e["grams"] for e in batch[spool_id]), 4) for spool_id in spool_ids]
+        # Taken before sending: Spoolman's change event for this very /use may update the cache before the reply is in
+        used_before = [spool_cache.by_id.get(spool_id, {}).get("used_weight") for spool_id in spool_ids]
+        results = await deduct_filament(list(zip(spool_ids, totals)))
+
+        done = [entry for spool_id, ok in zip(spool_ids, results) if ok is True for entry in batch[spool_id]]
+        if done:
+            await self.mark_done(done)
+            print(f"[SPOOLMAN] Cache stats: {spool_cache.stats_line()}")
+
+        # Retrying these would only fail again, and they would hold on to a batch slot for ever
+        dead = [entry for spool_id, ok in zip(spool_ids, results) if ok is None for entry in batch[spool_id]]
+        if dead:
+            await self.mark_dead(dead, "Spoolman rejected it")
+
+        unanswered = [{"op": "unanswered", "ids": [e["id"] for e in batch[spool_id]], "spool_id": spool_id, "grams": grams,
+                       "used_weight": used, "batch": uuid.uuid4().hex}
+                      for spool_id, grams, used, ok in zip(spool_ids, totals, used_before, results) if ok == UNANSWERED]
+        if unanswered:
+            try:
+                await asyncio.to_thread(self.write, unanswered)
+            except OSError as e:
+                print(f"[JOURNAL] Failed to journal unanswered deductions: {e}")
+            for mark in unanswered:
+                for entry_id in mark["ids"]:
+                    self.pending[entry_id]["unanswered"] = {k: mark[k] for k in ("batch", "grams", "used_weight")}
+            self.stats["unanswered"] += len(unanswered)
+
+        metrics.set("spooler_pending_deductions", len(self.pending))
+        ok = all(result is True or result is None for result in results)
+        if not ok:
+            self.stats["failed_batches"] += 1
+        return ok
+
+    def compact(self):
+        """
+        Rewrites the journal with only the charged ledger, the pending and the rejected entries once enough of it is "done" lines.
+        """
+        with self.lock:
+            kept = len(self.pending) + len(self.dead) + 1
+            if self.lines <= 2 * kept + 100:
+                return
+            temp_path = self.path + ".tmp"
+            try:
+                with open(temp_path, "w") as f:
+                    f.write(json.dumps({"op": "charged", "keys": sorted(self.charged)}) + "\n")
+                    for entry in itertools.chain(self.dead.values(), self.pending.values()):
+                        f.write(json.dumps(entry) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+                self.lines = kept
+            except OSError as e:
+                print(f"[JOURNAL] Failed to compact: {e}")
+
+    async def drainer(self):
+        failures = 0
+
+        while True:
+            if not self.pending:
+                self.idle.set()
+                await asyncio.to_thread(self.compact)
+                await self.wakeup.wait()
+            self.wakeup.clear()
+
+            if await self.drain_once():
+                failures = 0
+                continue
+
+            # Spoolman is slow or down, back off before the next attempt. New deductions just queue up on disk meanwhile.
+            delay = min(self.retry_max, 2 ** failures)
+            failures += 1
+            print(f"[JOURNAL] {len(self.pending)} deductions pending, retrying in {delay} seconds")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush(self, timeout):
+        """
+        Waits up to timeout seconds for the queue to empty. Used before one time mode exits.
+        """
+        if not self.pending:
+            return True
+        self.idle.clear()
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"[JOURNAL] {len(self.pending)} deductions still pending, they will be sent next time the daemon runs")
+        return not self.pending
+
+
+deduction_queue = DeductionQueue(DEDUCTION_JOURNAL_PATH)
+
+
+async def queue_deductions(job, deductions, started=None, session=None, ledger=()):
+    """
+    deduction_queue.enqueue for a print. If the journal can't be written (disk full, permissions) the deductions go straight to Spoolman
+    instead of being lost.
+    """
+    try:
+        await deduction_queue.enqueue(job, deductions, started, session, ledger)
+    except OSError as e:
+        print(f"[JOURNAL] Failed to write the journal, sending to Spoolman directly: {e}")
+        await deduct_filament(deductions)
+
+
+# -----------------------------
+# PRINT SESSIONS
+# -----------------------------
+"""
+Remembers which prints have already been charged, so a reconnect or a daemon restart in the middle of a print doesn't deduct it a second time.
+A session is keyed by printer + filename + the SDCP TaskId. Firmware that doesn't send a TaskId falls back to printer + filename,
+and that session stays open until the printer goes idle, so the next print of the same file is charged again as normal.
+Kept as one small JSON file, rewritten on every change. Only the newest max_sessions are kept.
+A print is claimed with begin() as soon as its start is seen, before waiting on metadata, so a reconnect in that window doesn't start a
+second charge. The claim only counts in this run. Once charged, the session also goes into the deduction journal with the deductions,
+and recover() restores it from there if the daemon died before this file was saved.
+"""
+class PrintSessions:
+    def __init__(self, path, max_sessions=500):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.sessions = {}  # session key -> {"printer", "job", "task_id", "started", "charging", "charged", "ended", "deducted"}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(printer, job, task_id):
+        return f"{printer}|{job}|{task_id or ''}"
+
+    @staticmethod
+    def task_key(printer, task_id):
+        """
+        The print's charged ledger key, see DeductionQueue. The printer's history knows prints by TaskId only, so none without one.
+        """
+        return f"{printer}|{task_id}" if task_id else None
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                # A claim left over from a run that died before charging doesn't count, that print was never charged
+                self.sessions = {key: session for key, session in json.load(f).items() if not session.get("charging")}
+        except FileNotFoundError:
+            self.sessions = {}
+        except ValueError as e:
+            print(f"[SESSION] Print session file unreadable, starting fresh: {e}")
+            self.sessions = {}
+        return self.sessions
+
+    def save(self):
+        with self.lock:
+            if len(self.sessions) > self.max_sessions:
+                newest = sorted(self.sessions.items(), key=lambda kv: kv[1].get("started", 0))[-self.max_sessions:]
+                self.sessions = dict(newest)
+            temp_path = self.path + ".tmp"
+            try:
+                with open(temp_path, "w") as f:
+                    json.dump(self.sessions, f)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"[SESSION] Failed to save print sessions: {e}")
+
+    def already_charged(self, printer, job, task_id):
+        """
+        O(1) check before any deduction work is done.
+        """
+        session = self.sessions.get(self.key(printer, job, task_id))
+        if session is None:
+            return False
+        if session.get("charging"):
+            return True  # being charged right now
+        if not session.get("charged"):
+            return False
+        # Without a TaskId a finished session means this is a new print of the same file
+        return bool(task_id) or not session.get("ended")
+
+    def get(self, printer, job, task_id):
+        return self.sessions.get(self.key(printer, job, task_id))
+
+    def begin(self, printer, job, task_id):
+        self.sessions[self.key(printer, job, task_id)] = {
+            "printer": printer, "job": job, "task_id": task_id, "started": time.time(), "charging": True, "charged": False, "ended": False,
+        }
+
+    def abandon(self, printer, job, task_id):
+        """
+        The print start gave up without charging (no metadata), a later start of it may try again.
+        """
+        key = self.key(printer, job, task_id)
+        if self.sessions.get(key, {}).get("charging"):
+            del self.sessions[key]
+
+    def recover(self, journaled):
+        """
+        journaled is the sessions DeductionQueue.load found in the journal. Any not marked charged here were charged just before a crash.
+        """
+        recovered = 0
+        for session in journaled:
+            key = self.key(session["printer"], session["job"], session["task_id"])
+            if not self.sessions.get(key, {}).get("charged"):
+                self.sessions[key] = {**session, "started": time.time(), "charged": True, "ended": False}
+                recovered += 1
+        if recovered:
+            print(f"[SESSION] Recovered {recovered} charged print sessions from the deduction journal")
+            self.save()
+
+    async def mark_charged(self, printer, job, task_id, deducted=()):
+        """
+        deducted is a list of (preset, spool_id, grams), kept so a cancelled print can be corrected later, see handle_print_end.
+        """
+        self.sessions[self.key(printer, job, task_id)] = {
+            "printer": printer, "job": job, "task_id": task_id, "started": time.time(), "charged": True, "ended": False,
+            "deducted": [list(d) for d in deducted],
+        }
+        await asyncio.to_thread(self.save)
+
+    async def mark_corrected(self, printer, job, task_id):
+        session = self.get(printer, job, task_id)
+        if session is not None:
+            session["corrected"] = True
+            await asyncio.to_thread(self.save)
+
+    async def mark_ended(self, printer):
+        changed = False
+        for session in self.sessions.values():
+            if session["printer"] == printer and not session.get("ended"):
+                session["ended"] = True
+                changed = True
+        if changed:
+            await asyncio.to_thread(self.save)
+
+
+print_sessions = PrintSessions(PRINT_SESSIONS_PATH)
+
+
+# -----------------------------
+# WATCH FOLDERS
+# -----------------------------
+"""
+Jobs are keyed by their path relative to the main watch folder. For files directly in it that is just the filename, as it always was.
+Printers with their own watch subfolder get keys like "printer2/plate.gcode" so two printers can have a file with the same name.
+With watch_recursive every subfolder is watched too (except hidden ones like .spooler_layers), keyed the same way.
+"""
+def watch_folders():
+    folders = [WATCH_FOLDER]
+    for printer in PRINTERS:
+        if printer["watch_folder"] and printer["watch_folder"] not in folders:
+            folders.append(printer["watch_folder"])
+    if WATCH_RECURSIVE:
+        # A printer subfolder inside another watched folder is already covered by it
+        roots = [os.path.abspath(f) for f in folders]
+        folders = [f for f, root in zip(folders, roots) if not any(root.startswith(other + os.sep) for other in roots)]
+    return folders
+
+
+def list_gcode_files(folder):
+    """
+    Paths of the G-codes in a watch folder, and its subfolders with watch_recursive. Raises FileNotFoundError if the folder is missing.
+    """
+    if not WATCH_RECURSIVE:
+        return [os.path.join(folder, name) for name in os.listdir(folder) if is_gcode_file(name)]
+
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(folder)
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        paths.extend(os.path.join(root, name) for name in files if is_gcode_file(name))
+    return paths
+
+
+GCODE_EXTENSIONS = (".gcode", ".gcode.gz", ".bgcode")
+
+
+def is_gcode_file(name):
+    return name.lower().endswith(GCODE_EXTENSIONS)
+
+
+def job_key(path):
+    """
+    A compressed "plate.gcode.gz" is keyed as "plate.gcode", as that is the name the printer reports once it is uploaded.
+    """
+    if path.lower().endswith(".gcode.gz"):
+        path = path[:-3]
+    try:
+        rel = os.path.relpath(path, WATCH_FOLDER)
+    except ValueError:
+        return os.path.abspath(path)  # different drive on Windows
+    return rel.replace(os.sep, "/")
+
+
+def job_path(key):
+    """
+    The other way round, for jobs reloaded from the metadata index. None if the file is gone (or was a handoff to begin with).
+    """
+    path = key if os.path.isabs(key) else os.path.join(WATCH_FOLDER, *key.split("/"))
+    for candidate in (path, path + ".gz"):
+        if os.path.exists(candidate):
+            return candidate
     return None
+
+
+def printer_job_key(folder, filename):
+    """
+    The printer only reports the file's name. With watch_recursive the file may sit in any subfolder, so look for a known job
+    with that name under the printer's folder, most recently used first.
+    """
+    key = job_key(os.path.join(folder, os.path.basename(filename)))
+    if not WATCH_RECURSIVE or key in pending_jobs or key in metadata_index.entries:
+        return key
+
+    name = key.rsplit("/", 1)[-1]
+    prefix = job_key(folder)
+    prefix = "" if prefix == "." else prefix + "/"
+    # The index is a snapshot, ingest threads add to it while we look
+    for candidate in itertools.chain(reversed(pending_jobs.records), metadata_index.names()):
+        if candidate.startswith(prefix) and candidate.rsplit("/", 1)[-1] == name:
+            return candidate
+    return key
+
+
+# -----------------------------
+# METADATA INDEX
+# -----------------------------
+"""
+Parsed metadata is kept in an append-only journal (one JSON object per line) so a restart doesn't have to reparse every G-code in the watch folder.
+Each entry is keyed by job key (see job_key) and remembers the file's size, mtime and inode. If any of those change the file is parsed again.
+A plain journal rather than a database, as the watch folder can be a network share and appending a line is safe there.
+In memory we only keep the file stats and where the entry's line starts in the journal. The metadata itself is read back with one seek
+when it is needed, which is also what lets pending_jobs drop old jobs (see PendingJobs).
+
+Entries also carry a content fingerprint, so a file with the same bytes under another name (a re-exported plate, a copy kept by
+delete_after_print off) reuses the metadata instead of being parsed again. By default the fingerprint is the size plus a hash of the
+first and last content_hash_sample bytes, which is where the slicer writes its header and the filament summary. A big config block
+can push the "filament used [g]" line out of the last content_hash_sample bytes, so for text G-code the tail that is hashed grows
+until it holds that line (the presets are in the config block below it). "full" hashes the whole file.
+Fingerprints outlive the file they came from, up to content_cache_max of them.
+"""
+CONTENT_HASH = config.get("content_hash", "sample")  # "sample", "full" or "off"
+CONTENT_HASH_SAMPLE = config.get("content_hash_sample", 64 * 1024)  # bytes hashed from each end of the file
+CONTENT_CACHE_MAX = config.get("content_cache_max", 10000)  # fingerprints remembered, including files that are gone
+
+
+def content_fingerprint(path, mode=None, sample=None):
+    """
+    Size plus a hash of the file (or of its two ends). None if content hashing is off or the file is gone.
+    """
+    mode = mode or CONTENT_HASH
+    sample = sample or CONTENT_HASH_SAMPLE
+    if mode not in ("sample", "full"):
+        return None
+
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if mode == "full" or size <= 2 * sample:
+                mode = "full"
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            else:
+                head = f.read(sample)
+                digest.update(head)
+                digest.update(read_fingerprint_tail(f, size, sample, text=not head.startswith((BGCODE_MAGIC, b"\x1f\x8b"))))
+    except FileNotFoundError:
+        return None
+    return f"{mode[0]}{size}:{digest.hexdigest()}"
+
+
+def has_usage_line(data):
+    """
+    True if data holds the per filament "filament used [g]" line, not just the total. Plain find, this runs for every fingerprint.
+    """
+    data = data.lower()
+    i = data.find(b"filament used [g]")
+    while i != -1:
+        if not data.endswith(b"total ", 0, i):
+            return True
+        i = data.find(b"filament used [g]", i + 1)
+    return False
+
+
+def read_fingerprint_tail(f, size, sample, text=True):
+    """
+    The last sample bytes, or for text G-code as much more as it takes to include the filament usage line (up to gcode_tail_max_bytes).
+    Never reaches into the head sample.
+    """
+    start = size - sample
+    limit = max(sample, size - GCODE_TAIL_MAX_BYTES)
+    tail = b""
+    while True:
+        f.seek(start)
+        chunk = f.read(size - start - len(tail))
+        # The line can straddle the boundary with what was read before, look a little into it
+        if not text or has_usage_line(chunk + tail[:64]) or start <= limit:
+            return chunk + tail
+        tail = chunk + tail
+        start = max(limit, start - len(tail))
+
+
+class IndexEntry:
+    __slots__ = ("size", "mtime_ns", "inode", "handoff_ts", "fingerprint", "offset", "meta")
+
+    def __init__(self, line, offset):
+        self.size = line.get("size")
+        self.mtime_ns = line.get("mtime_ns")
+        self.inode = line.get("inode")
+        self.handoff_ts = line.get("ts") if line.get("handoff") else None
+        self.fingerprint = line.get("fp")
+        self.offset = offset
+        # Only kept in memory if the line couldn't be written to the journal
+        self.meta = line["meta"] if offset is None else None
+
+
+class MetadataIndex:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}   # filename -> IndexEntry
+        self.content = {}   # fingerprint -> IndexEntry, least recently used first. Can point at entries whose file is gone
+        self.lines = 0      # lines in the journal, used to decide when to compact
+        self.lock = threading.Lock()
+        self.reader = None  # kept open for read_meta, the journal only ever grows until compact swaps it out
+        self.content_stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def file_key(st):
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def load(self):
+        self.close_reader()
+        self.entries = {}
+        self.content = {}
+        self.lines = 0
+        offset = 0
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    self.lines += 1
+                    start, offset = offset, offset + len(line)
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # half written line from a crash
+                    if entry.get("deleted"):
+                        self.entries.pop(entry["filename"], None)
+                        continue
+                    index_entry = IndexEntry(entry, start)
+                    if not entry.get("content_only"):
+                        self.entries[entry["filename"]] = index_entry
+                    self.remember_content(index_entry)
+        except FileNotFoundError:
+            pass
+        return self.entries
+
+    def remember_content(self, entry):
+        if entry.fingerprint is None:
+            return
+        self.content.pop(entry.fingerprint, None)
+        self.content[entry.fingerprint] = entry
+        while len(self.content) > CONTENT_CACHE_MAX:
+            del self.content[next(iter(self.content))]
+
+    def write_line(self, line):
+        """
+        Appends one entry, with the lock held. Returns the offset it was written at, None if the journal isn't writable.
+        """
+        try:
+            with open(self.path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write((json.dumps(line) + "\n").encode("utf-8"))
+            self.lines += 1
+            return offset
+        except OSError as e:
+            print(f"[INDEX] Failed to write metadata index: {e}")
+            return None
+
+    def append(self, line):
+        with self.lock:
+            self.write_line(line)
+
+    def add(self, line):
+        with self.lock:
+            entry = IndexEntry(line, self.write_line(line))
+            self.entries[line["filename"]] = entry
+            self.remember_content(entry)
+
+    def read_entry(self, entry):
+        """
+        Reads an entry's line back from the journal, with the lock held. None if it can't be read.
+        """
+        if entry.offset is None:
+            return {"meta": entry.meta}
+        try:
+            if self.reader is None:
+                self.reader = open(self.path, "rb")
+            self.reader.seek(entry.offset)
+            return json.loads(self.reader.readline())
+        except (OSError, ValueError) as e:
+            print(f"[INDEX] Failed to read the metadata index: {e}")
+            return None
+
+    def read_meta(self, filename):
+        """
+        The metadata saved for a job, read back from the journal. None if there is no entry.
+        """
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return None
+            line = self.read_entry(entry)
+        return line.get("meta") if line else None
+
+    def find_content(self, fingerprint):
+        """
+        Metadata of any file seen with this fingerprint, even one that has since been printed and deleted. None on a miss.
+        """
+        if fingerprint is None:
+            return None
+        with self.lock:
+            entry = self.content.get(fingerprint)
+            line = self.read_entry(entry) if entry is not None else None
+            if not line or "meta" not in line:
+                self.content_stats["misses"] += 1
+                return None
+            self.content_stats["hits"] += 1
+            self.remember_content(entry)
+        return line["meta"]
+
+    def count_content_hit(self):
+        with self.lock:
+            self.content_stats["hits"] += 1
+
+    def content_hit_rate(self):
+        lookups = self.content_stats["hits"] + self.content_stats["misses"]
+        return self.content_stats["hits"] / lookups if lookups else 0.0
+
+    def content_stats_line(self):
+        return f"hits={self.content_stats['hits']}, misses={self.content_stats['misses']}, hit_rate={self.content_hit_rate():.0%}"
+
+    def lookup(self, filename, st):
+        """
+        Returns the cached metadata if the file on disk is unchanged, otherwise None.
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        key = self.file_key(st)
+        if any(getattr(entry, k) != v for k, v in key.items()):
+            return None
+        return self.read_meta(filename)
+
+    def record(self, filename, st, meta, fingerprint=None):
+        line = {"filename": filename, **self.file_key(st), "meta": {k: v for k, v in meta.items() if k != "path"}}
+        if fingerprint is not None:
+            line["fp"] = fingerprint
+        self.add(line)
+
+    def record_handoff(self, filename, meta):
+        """
+        Metadata sent by copy_to_watch.py without a file in the watch folder. Kept until it is printed or handoff_ttl runs out.
+        """
+        self.add({"filename": filename, "handoff": True, "ts": time.time(), "meta": {k: v for k, v in meta.items() if k != "path"}})
+
+    def names(self):
+        with self.lock:
+            return list(self.entries)
+
+    def is_handoff(self, filename):
+        entry = self.entries.get(filename)
+        return entry is not None and entry.handoff_ts is not None
+
+    def handoffs(self):
+        handoffs = {}
+        for name in [name for name, entry in list(self.entries.items()) if entry.handoff_ts is not None]:
+            meta = self.read_meta(name)
+            if meta is not None:
+                handoffs[name] = meta
+        return handoffs
+
+    def forget(self, filename):
+        with self.lock:
+            if self.entries.pop(filename, None) is None:
+                return
+        self.append({"filename": filename, "deleted": True})
+
+    def prune(self, present):
+        """
+        Drops entries for files that are no longer in the folder (handed-off jobs live until handoff_ttl). Returns how many were removed.
+        """
+        now = time.time()
+        with self.lock:
+            stale = [
+                name for name, entry in self.entries.items()
+                if name not in present and not (entry.handoff_ts is not None and now - entry.handoff_ts < HANDOFF_TTL)
+            ]
+            for name in stale:
+                del self.entries[name]
+        return len(stale)
+
+    def compact(self):
+        """
+        Rewrites the journal with only the live entries, plus the fingerprints of files that are gone.
+        Written to a temp file and swapped in, same as copy_to_watch.py does.
+        """
+        with self.lock:
+            temp_path = self.path + ".tmp"
+            offsets = []    # (entry, new offset)
+            live = {id(entry) for entry in self.entries.values()}
+            try:
+                with open(self.path, "rb") as old, open(temp_path, "wb") as f:
+                    for entry in self.entries.values():
+                        if entry.offset is None:
+                            continue  # never made it into the journal, stays in memory
+                        old.seek(entry.offset)
+                        offsets.append((entry, f.tell()))
+                        f.write(old.readline())
+                    for entry in self.content.values():
+                        if id(entry) in live or entry.offset is None:
+                            continue
+                        old.seek(entry.offset)
+                        try:
+                            line = json.loads(old.readline())
+                        except ValueError:
+                            continue
+                        offsets.append((entry, f.tell()))
+                        f.write((json.dumps({**line, "content_only": True}) + "\n").encode("utf-8"))
+                self.close_reader()
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"[INDEX] Failed to compact metadata index: {e}")
+                return
+            for entry, offset in offsets:
+                entry.offset = offset
+            self.lines = len(offsets)
+
+
+metadata_index = MetadataIndex(METADATA_INDEX_PATH)
+
+
 # -----------------------------
 # INITIAL FOLDER SCAN
 # -----------------------------
 """
 Need for a race condition. So that if the file is already in the folder before the daemon starts, it can still load it into the metadata.
 Thoughts are so that if for some reason the daemon restarts, it can regrab the information for the print.
+Files already in the metadata index and unchanged on disk are not reparsed, and neither are copies of a file we have parsed before (see content_fingerprint).
 """
 
-def initial_folder_scan():
+def fingerprint_existing_gcode(path):
+    """
+    Runs in the scan pool. Files that have sat on disk longer than settle_skip_age are finished, so don't wait on them.
+    """
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        age = 0
+    if age < SETTLE_SKIP_AGE:
+        wait_for_file_complete(path)
+    return content_fingerprint(path)
+
+
+def make_scan_executor(workers=None, use_processes=None):
+    workers = workers or SCAN_WORKERS
+    use_processes = SCAN_USE_PROCESSES if use_processes is None else use_processes
+    if use_processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+
+
+async def initial_folder_scan(executor=None, folders=None):
+    """
+    Parsing fans out across the scan pool. The SDCP listener can already be running, a print start for a file still being parsed just waits on it in wait_for_job.
+    """
     print("[WATCH] Performing initial folder scan ... ")
-    for filename in os.listdir(WATCH_FOLDER):
-        if filename.lower().endswith(".gcode"):
-            path = os.path.join(WATCH_FOLDER, filename)
-            print(f"[WATCH] Found existing G-code: {filename}")
+    loop = asyncio.get_running_loop()
+    metadata_index.load()
+    present = {}  # job key -> path
+    reused = 0
+    copies = 0
+    to_parse = []
+
+    for folder in folders or watch_folders():
+        try:
+            paths = list_gcode_files(folder)
+        except FileNotFoundError:
+            print(f"[WATCH] Watch folder missing: {folder}")
+            continue
 
-            # Ensure file is complete
+        for path in paths:
+            key = job_key(path)
+            present[key] = path
 
-            wait_for_file_complete(path)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            meta = metadata_index.lookup(key, st)
+            if meta is not None:
+                register_job(key, {**meta, "path": path})
+                reused += 1
+                metrics.inc("spooler_jobs_ingested_total", source="index")
+                continue
+
+            print(f"[WATCH] Found existing G-code: {key}")
+            to_parse.append((key, path))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = make_scan_executor()
+
+    parsing = {}  # fingerprint -> future, identical files found by this scan wait on the one being parsed
+
+    async def parse_one(key, path):
+        nonlocal copies
+        try:
+            fingerprint = await loop.run_in_executor(executor, fingerprint_existing_gcode, path)
+            # Taken once the file has settled, the metadata below is only recorded if the file is still this one afterwards
+            st = os.stat(path)
+            meta = None
+            if fingerprint in parsing:
+                meta = await parsing[fingerprint]
+                if meta is not None:
+                    metadata_index.count_content_hit()
+            else:
+                meta = metadata_index.find_content(fingerprint)
+
+            if meta is not None:
+                meta = {**meta, "path": path}
+                copies += 1
+                metrics.inc("spooler_jobs_ingested_total", source="content_cache")
+            else:
+                future = loop.create_future()
+                if fingerprint is not None:
+                    parsing[fingerprint] = future
+                try:
+                    meta = await loop.run_in_executor(executor, parse_gcode_metadata, path)
+                    metrics.inc("spooler_jobs_ingested_total", source="parsed")
+                finally:
+                    # None lets anyone waiting on a failed parse try the file themselves
+                    parsing.pop(fingerprint, None)
+                    future.set_result(meta)
+        except Exception as e:
+            metrics.inc("spooler_failures_total", kind="parse")
+            print(f"[WATCH] Failed to parse {key}: {e}")
+            return
+
+        # A newer copy may have come in through the watcher while we were parsing, the watcher handles that one
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            return
+        if MetadataIndex.file_key(current) != MetadataIndex.file_key(st):
+            return
+        if key not in pending_jobs:
+            register_job(key, meta)
+        metadata_index.record(key, current, meta, fingerprint)
+
+    try:
+        await asyncio.gather(*(parse_one(key, path) for key, path in to_parse))
+
+        pruned = metadata_index.prune(present)
+        if pruned or metadata_index.lines > 2 * (len(metadata_index.entries) + len(metadata_index.content)):
+            metadata_index.compact()
+
+        # Jobs copy_to_watch.py handed straight to a previous run of the daemon, no file for them in the folder
+        for key, meta in metadata_index.handoffs().items():
+            if key not in pending_jobs:
+                register_job(key, {**meta, "path": None})
+
+        mark_startup("initial scan done")
+        print(f"[WATCH] Initial scan done: {len(present)} G-codes, {reused} from index, {copies} copies of known content, {len(to_parse) - copies} parsed, {pruned} stale entries pruned")
+        if to_parse:
+            print(f"[INDEX] Content cache: {metadata_index.content_stats_line()}")
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+
+# -----------------------------
+# JOB REGISTRY
+# -----------------------------
+"""
+Parsed files land in pending_jobs through register_job, always on the asyncio loop thread (the ingest workers go through call_soon_threadsafe).
+A print start that beats the parser waits on a future for that filename, which register_job resolves the moment the metadata arrives.
+Jobs are stored as JobRecords rather than the metadata dicts, a farm with delete_after_print off can keep thousands of them around.
+"""
+class PresetTable:
+    """
+    Every distinct preset string is kept once, jobs only hold its id. A farm prints the same handful of presets over and over.
+    """
+    def __init__(self):
+        self.names = []     # id -> preset
+        self.ids = {}       # preset -> id
+
+    def intern(self, name):
+        preset_id = self.ids.get(name)
+        if preset_id is None:
+            preset_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return preset_id
+
+
+preset_table = PresetTable()
+
+
+class JobRecord:
+    """
+    One job: preset ids into preset_table and the grams as float32. Grams are read back rounded to 2 decimals,
+    which is all the slicer writes and well inside what float32 holds.
+    """
+    __slots__ = ("preset_ids", "grams", "path")
+
+    def __init__(self, filament_presets, filament_g_list, path=None):
+        self.preset_ids = array("I", [preset_table.intern(p) for p in filament_presets])
+        self.grams = array("f", filament_g_list)
+        self.path = path
+
+    @classmethod
+    def from_meta(cls, meta):
+        if isinstance(meta, cls):
+            return meta
+        return cls(meta.get("filament_presets") or [], meta.get("filament_g_list") or [], meta.get("path"))
+
+    @property
+    def filament_presets(self):
+        return [preset_table.names[i] for i in self.preset_ids]
+
+    @property
+    def filament_g_list(self):
+        return [round(g, 2) for g in self.grams]
+
+    def as_meta(self):
+        return {"filament_presets": self.filament_presets, "filament_g_list": self.filament_g_list, "path": self.path}
+
+
+class PendingJobs:
+    """
+    Job key -> JobRecord, at most pending_jobs_max of them in memory. The least recently used job is dropped when it is full,
+    and read back from the metadata index (see MetadataIndex.read_meta) the next time a print asks for it, so nothing is lost.
+    "key in pending_jobs" only looks at what is in memory.
+    """
+    def __init__(self, max_entries=PENDING_JOBS_MAX):
+        self.records = OrderedDict()
+        self.max_entries = max_entries
+        self.stats = {"reloads": 0, "evictions": 0}
+
+    def put(self, key, meta):
+        record = JobRecord.from_meta(meta)
+        self.records[key] = record
+        self.records.move_to_end(key)
+        while self.max_entries and len(self.records) > self.max_entries:
+            self.records.popitem(last=False)
+            self.stats["evictions"] += 1
+        return record
+
+    def cached(self, key):
+        record = self.records.get(key)
+        if record is not None:
+            self.records.move_to_end(key)
+        return record
+
+    @staticmethod
+    def read_back(key):
+        """
+        Blocking. The job's metadata from the metadata index, None if it has none.
+        """
+        meta = metadata_index.read_meta(key)
+        if meta is None:
+            return None
+        return {**meta, "path": None if metadata_index.is_handoff(key) else job_path(key)}
+
+    def get(self, key, default=None):
+        """
+        Blocking if the job has to be read back from disk, the event loop uses fetch.
+        """
+        record = self.cached(key)
+        if record is not None:
+            return record
+        meta = self.read_back(key)
+        if meta is None:
+            return default
+        self.stats["reloads"] += 1
+        return self.put(key, meta)
+
+    async def fetch(self, key):
+        record = self.cached(key)
+        if record is not None:
+            return record
+        meta = await asyncio.to_thread(self.read_back, key)
+        # It may have been parsed and registered while we were reading
+        record = self.cached(key)
+        if record is not None or meta is None:
+            return record
+        self.stats["reloads"] += 1
+        return self.put(key, meta)
+
+    def pop(self, key, default=None):
+        return self.records.pop(key, default)
+
+    def clear(self):
+        self.records.clear()
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+
+pending_jobs = PendingJobs()
+
+
+def register_job(key, meta):
+    record = pending_jobs.put(key, meta)
+    waiter = job_waiters.pop(key, None)
+    if waiter is not None and not waiter.done():
+        waiter.set_result(record)
+
+
+async def wait_for_job(key, timeout=None):
+    """
+    Returns the job's JobRecord, waiting up to timeout seconds for it to be parsed. None if it never shows up.
+    """
+    job = await pending_jobs.fetch(key)
+    if job is not None:
+        return job
+
+    waiter = job_waiters.get(key)
+    if waiter is None or waiter.done():
+        waiter = asyncio.get_running_loop().create_future()
+        job_waiters[key] = waiter
+
+    try:
+        # shield so one waiter timing out doesn't cancel the future for anyone else waiting on the same file
+        return await asyncio.wait_for(asyncio.shield(waiter), timeout=JOB_WAIT_TIMEOUT if timeout is None else timeout)
+    except asyncio.TimeoutError:
+        if job_waiters.get(key) is waiter:
+            del job_waiters[key]
+        return None
 
-            meta = parse_gcode_metadata(path)
-            pending_jobs[filename] = meta
 
 # -----------------------------
 # FILE WRITE WAIT
@@ -187,7 +2264,7 @@ def wait_for_file_complete(path, timeout=5):
 
 def normalize_filament_usage(filament_presets, filament_g_list):
 
-    if len(filament_g_list) <= 1:
+    if not filament_presets or not filament_g_list or len(filament_g_list) <= 1:
         return filament_presets, filament_g_list
     
     max_idx = max(range(len(filament_g_list)), key=lambda i: filament_g_list[i])
@@ -231,30 +2308,173 @@ filament used [g] - will provide a list that is determined by how many filaments
             filament used [g] = ["0.00", "10.00", "0.00"]
             
             In my findings this would mean that Yellow filament has used 10 grams of filament. This is the exact information we need to pass onto spoolman as long as the filament_settings_id is in the correct format which is highlighted in the readme."""
-def parse_gcode_metadata(path):
+GCODE_TAIL_MAX_BYTES = config.get("gcode_tail_max_bytes", 16 * 1024 * 1024)
+
+# match_metadata_line and scan_gcode_tail live in gcode_tail.py, copy_to_watch.py reads the tail of a fresh export with them too
+
+
+def scan_gcode_forward(path):
+    """
+    Original top to bottom scan. Returns (filament_presets, filament_g_list, bytes_read).
+    """
     filament_presets = None
     filament_g_list = None
+    bytes_read = 0
 
-    with open(path, "r", errors="ignore") as f:
-        for line in f:
-            lower = line.lower()
+    with open(path, "rb") as f:
+        for raw in f:
+            bytes_read += len(raw)
+            filament_presets, filament_g_list = match_metadata_line(raw.decode("utf-8", errors="ignore"), filament_presets, filament_g_list)
 
-            # --- FILAMENT PRESETS ---
-            if "filament_settings_id" in lower and filament_presets is None:
-                # Extract all quoted strings
-                presets = re.findall(r'"([^"]+)"', line)
-                if presets:
-                    filament_presets = presets
+            # stop early if both found
+            if filament_g_list is not None and filament_presets is not None:
+                break
 
-            # --- FILAMENT USED [G] ---
-            if "filament used [g]" in lower and filament_g_list is None:
-                nums = re.findall(r"[-+]?\d*\.\d+|\d+", line)
-                if nums:
-                    filament_g_list = [float(n) for n in nums]
+    return filament_presets, filament_g_list, bytes_read
 
-            # stop early if both found
+
+# -----------------------------
+# COMPRESSED / BINARY GCODE
+# -----------------------------
+"""
+.gcode.gz is streamed through gzip line by line, memory stays flat no matter the size. The keys are at the end so this does decompress the whole file.
+.bgcode (binary G-code, as written by PrusaSlicer / OrcaSlicer) keeps the slicer settings and the print stats in their own blocks ahead of the toolpath.
+We walk the block headers and only read those metadata blocks, the G-code blocks are never touched.
+    file header:  "GCDE", version (u32), checksum type (u16)
+    block header: type (u16), compression (u16), uncompressed size (u32), compressed size (u32, only if compressed)
+    then block parameters, the data, and a CRC32 if the file uses checksums.
+"""
+BGCODE_MAGIC = b"GCDE"
+BGCODE_BLOCK_GCODE = 1
+BGCODE_BLOCK_THUMBNAIL = 5
+BGCODE_METADATA_BLOCKS = (0, 2, 3, 4)  # file, slicer, printer, print metadata
+
+
+def detect_gcode_format(path):
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == BGCODE_MAGIC:
+        return "bgcode"
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    return "text"
+
+
+def scan_gcode_gzip(path):
+    """
+    Returns (filament_presets, filament_g_list, bytes_read), bytes_read being compressed bytes off disk.
+    """
+    filament_presets = None
+    filament_g_list = None
+
+    with open(path, "rb") as raw, gzip.GzipFile(fileobj=raw) as f:
+        carry = b""
+        while filament_g_list is None or filament_presets is None:
+            chunk = f.read(GCODE_TAIL_BLOCK_SIZE * 4)
+            if not chunk:
+                lines = [carry]
+            else:
+                chunk = carry + chunk
+                cut = chunk.rfind(b"\n") + 1
+                lines = chunk[:cut].split(b"\n") if cut else []
+                carry = chunk[cut:]
+
+                # Nearly every chunk is toolpath, only decode lines when the chunk could hold one of our keys
+                if b"ilament" not in chunk and b"ILAMENT" not in chunk:
+                    continue
+
+            for line in lines:
+                if b"ilament" in line or b"ILAMENT" in line:
+                    filament_presets, filament_g_list = match_metadata_line(line.decode("utf-8", errors="ignore"), filament_presets, filament_g_list)
+
+            if not chunk:
+                break
+        bytes_read = raw.tell()
+
+    return filament_presets, filament_g_list, bytes_read
+
+
+def scan_gcode_binary(path):
+    """
+    Returns (filament_presets, filament_g_list, bytes_read), reading only the metadata blocks of a .bgcode.
+    """
+    filament_presets = None
+    filament_g_list = None
+    bytes_read = 0
+
+    with open(path, "rb") as f:
+        header = f.read(10)
+        bytes_read += len(header)
+        if len(header) < 10 or header[:4] != BGCODE_MAGIC:
+            return None, None, bytes_read
+        _, checksum_type = struct.unpack("<IH", header[4:10])
+        checksum_size = 4 if checksum_type == 1 else 0
+
+        while True:
+            block = f.read(8)
+            bytes_read += len(block)
+            if len(block) < 8:
+                break
+            block_type, compression, uncompressed_size = struct.unpack("<HHI", block)
+            data_size = uncompressed_size
+            if compression:
+                data_size = struct.unpack("<I", f.read(4))[0]
+                bytes_read += 4
+            params_size = 6 if block_type == BGCODE_BLOCK_THUMBNAIL else 2
+
+            # Metadata comes first, once we hit the toolpath there is nothing left for us
+            if block_type == BGCODE_BLOCK_GCODE:
+                break
+
+            if block_type not in BGCODE_METADATA_BLOCKS:
+                f.seek(params_size + data_size + checksum_size, os.SEEK_CUR)
+                continue
+
+            f.seek(params_size, os.SEEK_CUR)
+            data = f.read(data_size)
+            f.seek(checksum_size, os.SEEK_CUR)
+            bytes_read += params_size + data_size + checksum_size
+
+            if compression == 1:
+                data = zlib.decompress(data)
+            elif compression != 0:
+                print(f"[PARSE] Unsupported metadata compression {compression} in {os.path.basename(path)}")
+                continue
+
+            for line in data.decode("utf-8", errors="ignore").splitlines():
+                filament_presets, filament_g_list = match_metadata_line(line, filament_presets, filament_g_list)
             if filament_g_list is not None and filament_presets is not None:
                 break
+
+    return filament_presets, filament_g_list, bytes_read
+
+
+def parse_gcode_metadata(path, tail_first=True):
+    """
+    tail_first reads from the end of the file and only falls back to the full forward scan if either key is missing.
+    Compressed (.gcode.gz) and binary (.bgcode) files are detected from their first bytes, not the extension.
+    """
+    filament_presets = None
+    filament_g_list = None
+    bytes_read = 0
+    start = time.perf_counter()
+
+    file_format = detect_gcode_format(path)
+    if file_format == "bgcode":
+        filament_presets, filament_g_list, bytes_read = scan_gcode_binary(path)
+    elif file_format == "gzip":
+        filament_presets, filament_g_list, bytes_read = scan_gcode_gzip(path)
+    else:
+        if tail_first:
+            filament_presets, filament_g_list, bytes_read = scan_gcode_tail(path, max_bytes=GCODE_TAIL_MAX_BYTES)
+
+        if filament_presets is None or filament_g_list is None:
+            filament_presets, filament_g_list, forward_bytes = scan_gcode_forward(path)
+            bytes_read += forward_bytes
+
+    metrics.observe("spooler_parse_seconds", time.perf_counter() - start, format=file_format)
+    metrics.observe("spooler_parse_bytes", bytes_read, format=file_format)
+
     # Add any filaments < 1 and add them to the biggest filament. Helps when the purge line at the start of a print is a different color.. Yes, it is only 0.8g. But I want it to be close as we can as an estimate.      
     filament_presets, filament_g_list = normalize_filament_usage(filament_presets, filament_g_list)
 
@@ -265,34 +2485,457 @@ def parse_gcode_metadata(path):
     }
 
 
+# -----------------------------
+# LAYER USAGE INDEX
+# -----------------------------
+"""
+Optional ("layer_index": true). Lets a cancelled or failed print be charged for what it actually used instead of the whole file.
+Once a print has started and its deduction is queued, its toolpath is streamed once more and the filament pushed is added up per layer
+and per filament slot:
+    ;LAYER_CHANGE     a new layer starts (OrcaSlicer / PrusaSlicer)
+    T<n>              tool change, extrusion after it belongs to filament slot n
+    M82 / M83, G92    absolute / relative extrusion and E resets
+    G0-G3 ... E<x>    extrusion. E on any other line (M201 / M203 machine limits) or in a comment (the start / end G-code
+                      templates in the config block) is not
+Only files that actually get printed are indexed. With delete_after_print the file is deleted once this pass is done, not while it
+is still open (Windows refuses that).
+The mm totals are scaled to the slicer's own "filament used [g]", so the last layer always matches what print start deducted.
+Stored per job as a flat array('f') of (layers + 1) x filaments in layer_index_dir. Row n is the usage at the end of layer n,
+so the grams used up to the layer the printer last reported is a single slice.
+.bgcode files are skipped, their G-code blocks are usually packed. Handed-off jobs have no file, so no layer index either.
+"""
+LAYER_INDEX_ENABLED = config.get("layer_index", False)
+LAYER_INDEX_DIR = config.get("layer_index_dir") or os.path.join(WATCH_FOLDER, ".spooler_layers")
+LAYER_SCAN_CHUNK = 4 * 1024 * 1024
+
+# Everything that changes how the extrusion after it is counted. The leading "\n" gives the regex a literal to search for,
+# which is several times faster than a ^ anchor on files this size.
+LAYER_CONTROL_RE = re.compile(rb"\n(;LAYER_CHANGE|T\d+|M8[23]\b|G92 [^\n]*|; filament used \[g\] = [^\n]*|; filament_settings_id = [^\n]*)")
+# E of a G0-G3 move, up to a trailing comment. Every line of a moves part starts after a "\n", see scan_gcode_layers.
+LAYER_EXTRUDE_RE = re.compile(rb"\nG[0-3](?: [^\n;E]*)? E([-+]?[\d.]+)")
+LAYER_RESET_RE = re.compile(rb" E([-+]?[\d.]+)")
+
+
+def scan_gcode_layers(path):
+    """
+    One pass over a text or gzip G-code. Returns (presets, grams, rows) where rows[n] is the cumulative mm per filament slot
+    at the start of layer n + 1 (rows[0] is the start G-code and purge line). None if the file has no usable toolpath.
+    """
+    file_format = detect_gcode_format(path)
+    if file_format == "bgcode":
+        return None
+
+    filament_presets = None
+    filament_g_list = None
+    rows = []
+    used = [0.0]        # mm per filament slot so far
+    tool = 0
+    relative = False    # slicers emit M82 / M83 before the first move, absolute is the firmware default
+    base = 0.0          # last E position in absolute mode
+
+    opener = gzip.open if file_format == "gzip" else open
+    with opener(path, "rb") as f:
+        carry = b"\n"
+        while True:
+            chunk = f.read(LAYER_SCAN_CHUNK)
+            if chunk:
+                chunk = carry + chunk
+                cut = chunk.rfind(b"\n")
+                chunk, carry = chunk[:cut], chunk[cut:]
+            else:
+                chunk, carry = carry, b""
+
+            # split() with a group alternates: moves, control line, moves, control line, ...
+            parts = LAYER_CONTROL_RE.split(chunk)
+            for i, part in enumerate(parts):
+                if i % 2 == 0:
+                    extrusion = LAYER_EXTRUDE_RE.findall(part)
+                    if not extrusion:
+                        continue
+                    if relative:
+                        used[tool] += sum(map(float, extrusion))
+                    else:
+                        last = float(extrusion[-1])
+                        used[tool] += last - base
+                        base = last
+                elif part == b";LAYER_CHANGE":
+                    rows.append(tuple(used))
+                elif part[0:1] == b"T":
+                    tool = int(part[1:])
+                    # T255 / T1000 and the like are firmware specials, not filament slots
+                    if tool > 64:
+                        tool = 0
+                    if tool >= len(used):
+                        used.extend([0.0] * (tool + 1 - len(used)))
+                elif part.startswith(b"M8"):
+                    relative = part[2:3] == b"3"
+                elif part.startswith(b"G92"):
+                    reset = LAYER_RESET_RE.search(part.split(b";", 1)[0])
+                    if reset:
+                        base = float(reset.group(1))
+                else:
+                    filament_presets, filament_g_list = match_metadata_line(part.decode("utf-8", errors="ignore"), filament_presets, filament_g_list)
+
+            if not carry:
+                break
+
+    if not rows or not filament_g_list:
+        return None
+    rows.append(tuple(used))
+    return filament_presets or [], filament_g_list, rows
+
+
+class LayerIndex:
+    def __init__(self, folder, enabled=LAYER_INDEX_ENABLED):
+        self.folder = folder
+        self.enabled = enabled
+
+    def path_for(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + ".layers")
+
+    def header(self, key):
+        """
+        Just the JSON first line, enough to tell if the index is still for the file on disk.
+        """
+        try:
+            with open(self.path_for(key), "rb") as f:
+                return json.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+
+    def is_current(self, key, st):
+        header = self.header(key)
+        return header is not None and header.get("file") == MetadataIndex.file_key(st)
+
+    def build(self, key, path):
+        """
+        Blocking, runs in an ingest worker or the scan pool. Returns the number of layers indexed, 0 if the file has no usable toolpath.
+        """
+        st = os.stat(path)
+        scanned = scan_gcode_layers(path)
+        if scanned is None:
+            return 0
+        filament_presets, filament_g_list, rows = scanned
+
+        filaments = len(filament_g_list)
+        totals = rows[-1]
+        # mm -> g per slot, from the slicer's own totals. A slot the slicer lists but never extruded from stays at 0.
+        scale = [filament_g_list[i] / totals[i] if i < len(totals) and totals[i] > 0 else 0.0 for i in range(filaments)]
+        # Rows are padded first, slots only show up in "used" once a T<n> for them has been seen
+        grams = array("f", [mm * s if mm > 0 else 0.0 for row in rows for mm, s in zip(row + (0.0,) * (filaments - len(row)), scale)])
+
+        header = {
+            "key": key, "file": MetadataIndex.file_key(st), "layers": len(rows) - 1, "filaments": filaments,
+            "filament_presets": filament_presets, "filament_g_list": filament_g_list,
+        }
+        os.makedirs(self.folder, exist_ok=True)
+        target = self.path_for(key)
+        temp_path = target + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            grams.tofile(f)
+        os.replace(temp_path, target)
+        return header["layers"]
+
+    def ensure(self, key, path):
+        """
+        Builds the index unless an up to date one is already on disk. Never raises, a missing layer index only means no partial deduction.
+        """
+        try:
+            if not self.enabled or self.is_current(key, os.stat(path)):
+                return 0
+            started = time.perf_counter()
+            layers = self.build(key, path)
+            if layers:
+                print(f"[LAYERS] Indexed {layers} layers for {key} in {time.perf_counter() - started:.2f}s")
+            return layers
+        except Exception as e:
+            print(f"[LAYERS] Failed to index {key}: {e}")
+            return 0
+
+    def usage_at(self, key, layer):
+        """
+        Grams used up to the end of the given layer (1 based, as SDCP reports CurrentLayer).
+        Returns {preset: grams} with the same tiny filament merging as the print start deduction, or None without an index.
+        """
+        try:
+            with open(self.path_for(key), "rb") as f:
+                header = json.loads(f.readline())
+                filaments = header["filaments"]
+                row = min(max(layer, 0), header["layers"])
+                f.seek(row * filaments * 4, os.SEEK_CUR)
+                grams = array("f")
+                grams.fromfile(f, filaments)
+        except (OSError, ValueError, EOFError, KeyError):
+            return None
+
+        # Merge the same way parse_gcode_metadata did, scaled to this layer, so presets line up with what was charged
+        filament_presets, merged = normalize_filament_usage(list(header["filament_presets"]), list(header["filament_g_list"]))
+        usage = {}
+        for i, preset in enumerate(header["filament_presets"][:filaments]):
+            if preset not in filament_presets:
+                # A tiny slot folded into the biggest one, charge it there too
+                preset = filament_presets[max(range(len(merged)), key=lambda j: merged[j])]
+            usage[preset] = usage.get(preset, 0.0) + grams[i]
+        return usage
+
+    def forget(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[LAYERS] Failed to remove layer index for {key}: {e}")
+
+
+layer_index = LayerIndex(LAYER_INDEX_DIR)
+
+
 # -----------------------------
 # FILE WATCHER
 # -----------------------------
-class GcodeHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory:
+"""
+Watchdog only queues paths here. Parsing happens in the ingest pipeline's worker threads, so a burst of exports doesn't line up behind one big file on watchdog's single observer thread.
+    - on_moved: copy_to_watch.py writes "<name>.gcode.tmp" and os.replace()s it into place, so the rename means the file is complete.
+    - on_closed: the writer closed the file (Linux), also complete.
+    - on_created: anything else, we fall back to polling the size until it settles.
+"""
+class IngestPipeline:
+    def __init__(self, loop, on_parsed, workers=INGEST_WORKERS, max_queue=INGEST_QUEUE_SIZE):
+        self.loop = loop
+        self.on_parsed = on_parsed          # called on the asyncio loop thread as on_parsed(key, meta)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.pending = {}                   # path -> complete flag, queued but not started
+        self.running = set()                # paths a worker is parsing right now
+        self.dirty = {}                     # path -> complete flag, new event came in while it was being parsed
+        self.retry = deque()                # re-submits from the workers that didn't fit in the queue
+        self.stats = {"events": 0, "deduped": 0, "parsed": 0, "copies": 0, "failed": 0}
+        self.threads = [threading.Thread(target=self.worker, name=f"ingest-{i}", daemon=True) for i in range(workers)]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join(timeout=5)
+
+    def submit(self, path, complete, block=True):
+        """
+        Queue a path for parsing. Repeated events for a path that is already queued only upgrade it to complete.
+        Blocks when the queue is full, which holds watchdog back instead of growing without bound.
+        The workers re-submit with block=False: they are the only consumers, so they must never wait on a full queue themselves.
+        """
+        with self.lock:
+            self.stats["events"] += 1
+            if path in self.pending:
+                self.pending[path] = self.pending[path] or complete
+                self.stats["deduped"] += 1
+                return
+            if path in self.running:
+                self.dirty[path] = self.dirty.get(path, False) or complete
+                self.stats["deduped"] += 1
+                return
+            self.pending[path] = complete
+
+        if block:
+            self.queue.put(path)
             return
+        try:
+            self.queue.put_nowait(path)
+        except queue.Full:
+            with self.lock:
+                self.retry.append(path)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def next_path(self):
+        with self.lock:
+            if self.retry:
+                return self.retry.popleft()
+        return self.queue.get()
+
+    def worker(self):
+        while True:
+            path = self.next_path()
+            if path is None:
+                return
+
+            with self.lock:
+                complete = self.pending.pop(path, False)
+                self.running.add(path)
+
+            parsed_key = None
+            try:
+                parsed_key = self.ingest(path, complete)
+            except Exception as e:
+                self.count("failed")
+                metrics.inc("spooler_failures_total", kind="parse")
+                print(f"[WATCH] Failed to parse {os.path.basename(path)}: {e}")
+            finally:
+                with self.lock:
+                    self.running.discard(path)
+                    again = self.dirty.pop(path, None)
+                # Only parse again if the file actually changed after we read it (eg on_closed right after on_created)
+                if again is not None and parsed_key != self.file_key(path):
+                    self.submit(path, again, block=False)
+
+    @staticmethod
+    def file_key(path):
+        try:
+            return MetadataIndex.file_key(os.stat(path))
+        except FileNotFoundError:
+            return None
 
-        if event.src_path.endswith(".gcode"):
-            filename = os.path.basename(event.src_path)
-            wait_for_file_complete(event.src_path)
-            print(f"[WATCH] New G-code detected: {filename}")
+    def ingest(self, path, complete):
+        key = job_key(path)
+        if not complete:
+            wait_for_file_complete(path)
 
-            meta = parse_gcode_metadata(event.src_path)
-            pending_jobs[filename] = meta
+        if not os.path.exists(path):
+            return None
+
+        print(f"[WATCH] New G-code detected: {key}")
+        st = os.stat(path)
+        fingerprint = content_fingerprint(path)
+        meta = metadata_index.find_content(fingerprint)
+        if meta is not None:
+            meta = {**meta, "path": path}
+            self.count("copies")
+            metrics.inc("spooler_jobs_ingested_total", source="content_cache")
+            print(f"[WATCH] Same content as a G-code parsed before, reusing its metadata: {key}")
+        else:
+            with job_profiler.capture(key, "parse"):
+                meta = parse_gcode_metadata(path)
+            self.count("parsed")
+            metrics.inc("spooler_jobs_ingested_total", source="parsed")
+        metadata_index.record(key, st, meta, fingerprint)
+
+        print(f"[WATCH] Parsed metadata: {meta}")
+        self.loop.call_soon_threadsafe(self.on_parsed, key, meta)
+        return MetadataIndex.file_key(st)
+
+
+class GcodeHandler:
+    """
+    Watchdog handler. Watchdog only ever calls dispatch(), so this doesn't need to subclass FileSystemEventHandler (and import watchdog to do it).
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
 
-            print(f"[WATCH] Parsed metadata: {meta}")
+    def dispatch(self, event):
+        handler = getattr(self, f"on_{event.event_type}", None)
+        if handler is not None:
+            handler(event)
 
+    def on_created(self, event):
+        if not event.is_directory and is_gcode_file(event.src_path):
+            self.pipeline.submit(event.src_path, complete=False)
+
+    def on_closed(self, event):
+        if not event.is_directory and is_gcode_file(event.src_path):
+            self.pipeline.submit(event.src_path, complete=True)
+
+    def on_moved(self, event):
+        if not event.is_directory and is_gcode_file(event.dest_path):
+            self.pipeline.submit(event.dest_path, complete=True)
+
+
+def start_folder_watcher(pipeline):
+    from watchdog.observers import Observer
 
-def start_folder_watcher():
     observer = Observer()
-    handler = GcodeHandler()
-    observer.schedule(handler, WATCH_FOLDER, recursive=False)
+    handler = GcodeHandler(pipeline)
+    for folder in watch_folders():
+        os.makedirs(folder, exist_ok=True)
+        observer.schedule(handler, folder, recursive=WATCH_RECURSIVE)
     observer.start()
-    print("[WATCH] Folder watcher started")
+    print(f"[WATCH] Folder watcher started ({len(watch_folders())} folders)")
     return observer
 
 
+# -----------------------------
+# HANDOFF SERVER
+# -----------------------------
+"""
+When the daemon is already running, copy_to_watch.py doesn't copy the G-code at all. It reads the filament lines from the end of the file
+and sends them here as one JSON line on localhost:
+    {"filename": "plate.gcode", "filament_presets": [...], "filament_g_list": [...], "token": "..."}
+We reply "ok". The job is registered exactly like a parsed file in the main watch folder.
+Anything on this machine can connect to the port, so the token has to match: handoff_token from config.json, or a random one the daemon
+writes next to config.json (HANDOFF_TOKEN_PATH) for copy_to_watch.py to read.
+Only used in always running mode, a one time mode daemon exits after its own print and would never charge a job handed to it.
+"""
+def handoff_token():
+    token = config.get("handoff_token")
+    if token:
+        return token
+    import secrets
+    try:
+        with open(HANDOFF_TOKEN_PATH, "r") as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        token = None
+    if not token:
+        token = secrets.token_hex(16)
+        fd = os.open(HANDOFF_TOKEN_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+    return token
+
+
+async def handle_handoff(reader, writer, token):
+    import hmac
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout=5)
+        data = json.loads(line)
+        if not hmac.compare_digest(str(data.get("token") or ""), token):
+            raise ValueError("wrong or missing token")
+        key = job_key(os.path.join(WATCH_FOLDER, os.path.basename(data["filename"])))
+
+        filament_presets, filament_g_list = normalize_filament_usage(list(data.get("filament_presets") or []), [float(g) for g in data.get("filament_g_list") or []])
+        meta = {"filament_presets": filament_presets, "filament_g_list": filament_g_list, "path": None}
+
+        register_job(key, meta)
+        metrics.inc("spooler_jobs_ingested_total", source="handoff")
+        await asyncio.to_thread(metadata_index.record_handoff, key, meta)
+        print(f"[HANDOFF] Received metadata for {key}: {meta}")
+        writer.write(b"ok\n")
+    except Exception as e:
+        metrics.inc("spooler_failures_total", kind="handoff")
+        print(f"[HANDOFF] Bad handoff: {e}")
+        writer.write(b"error\n")
+    finally:
+        try:
+            await writer.drain()
+            writer.close()
+        except Exception:
+            pass
+
+
+async def start_handoff_server(port=None):
+    port = HANDOFF_PORT if port is None else port
+    if not port:
+        return None
+    try:
+        token = handoff_token()
+    except OSError as e:
+        print(f"[HANDOFF] Could not create {HANDOFF_TOKEN_PATH}, copy_to_watch.py will copy files instead: {e}")
+        return None
+    try:
+        server = await asyncio.start_server(lambda reader, writer: handle_handoff(reader, writer, token), "127.0.0.1", port)
+    except OSError as e:
+        print(f"[HANDOFF] Could not listen on port {port}, copy_to_watch.py will copy files instead: {e}")
+        return None
+    print(f"[HANDOFF] Listening on 127.0.0.1:{port}")
+    return server
+
+
 # -----------------------------
 # SDCP KEEP-ALIVE
 # -----------------------------
@@ -354,163 +2997,989 @@ async def simulate_fake_print(print_active_ref, waiting_for_idle_ref, config):
     return False
 
 
+# -----------------------------
+# PRINT START HANDLING
+# -----------------------------
+async def handle_print_start(key, tag="[SDCP]", printer="", task_id=None):
+    """
+    Waits for the job's metadata (if it isn't parsed yet), matches spools and deducts the filament.
+    key is the job key of the printer's file, see job_key.
+    """
+    seen_at = time.time()
+    charged = False
+    try:
+        job = await pending_jobs.fetch(key)
+        if job is None:
+            print(f"{tag} No matching job yet, waiting for metadata...")
+            started = time.monotonic()
+            job = await wait_for_job(key)
+            if job is None:
+                metrics.inc("spooler_failures_total", kind="job_timeout")
+                print(f"{tag} Still no matching job for '{key}' after {JOB_WAIT_TIMEOUT} seconds, skipping")
+                return
+            print(f"{tag} Match found after {time.monotonic() - started:.2f} seconds")
+
+        presets = job.filament_presets
+        usage_list = job.filament_g_list
+
+        print(f"{tag} Using metadata: presets={presets}, usage={usage_list}")
+
+        if not presets or not usage_list:
+            metrics.inc("spooler_failures_total", kind="missing_metadata")
+            print(f"[ERROR] Missing filament metadata for {key}")
+        else:
+            await spool_cache.ensure_fresh()
+
+            used = [(preset, usage_g) for preset, usage_g in zip(presets, usage_list) if usage_g > 0]
+            matched = [find_spool_for_preset(preset) for preset, _ in used]
+
+            # Only the matched spools are re-fetched. If one was archived / emptied since the last load, match again against the patched index.
+            if await spool_cache.revalidate([spool_id for spool_id in matched if spool_id]):
+                matched = [find_spool_for_preset(preset) for preset, _ in used]
+            for preset, _ in used:
+                metrics.inc("spooler_matches_total", stage=resolve_preset(preset)[1] or "none")
+
+            deductions = []
+            deducted = []
+            for (preset, usage_g), spool_id in zip(used, matched):
+                if not spool_id:
+                    print(f"[ERROR] No matching spool for preset '{preset}'")
+                    continue
+
+                print(f"[INFO] Subtracting {usage_g}g from spool {spool_id} ({preset})")
+                deductions.append((spool_id, usage_g))
+                deducted.append((preset, spool_id, usage_g))
+
+            # Written to the journal first, together with the print session, the drainer sends it to Spoolman in the background
+            session = {"printer": printer, "job": key, "task_id": task_id, "deducted": [list(d) for d in deducted]}
+            await queue_deductions(key, deductions, seen_at, session, [PrintSessions.task_key(printer, task_id)])
+            await print_sessions.mark_charged(printer, key, task_id, deducted)
+            charged = True
+    finally:
+        if not charged:
+            print_sessions.abandon(printer, key, task_id)
+
+    # Only needed if this print is stopped early. handle_print_end waits for this task, and the file is deleted below once it is read.
+    if charged and layer_index.enabled and job.path:
+        await asyncio.to_thread(layer_index.ensure, key, job.path)
+
+    # Cleanup
+    if DELETE_AFTER_PRINT:
+        """
+        I prefer this setup as most of the time we just print it once and that is that. No need to keep so many duplicates.
+        Although, we can turn this off in the config, a use for that could be say: 
+            We have "always_running": True and "delete_after_print": False, this would mean the file would stay in the folder and thus the metadata. We could then run a print again of the same GCODE from the printer itself
+                and it would still subtract the filament from spoolman.
+                
+            This would be useful if we prefered to use the printers interface to do the printing or even when we use other interfaces like octoeverywhere, or we do a mix of both. deleting the file means we need to move the gcode 
+                (manually or automatically with script) each time we print. I like this method as I have the pc here, but I can see pros for the other way also.
+                
+            Though, as I don't use the other way, I am not certain about how well it works when there are MANY GCODEs available. But as the daemon ensures to only use the settings of the matching GCODE file, then it should be okay.
+                Infact it should be fine as it saves the metadata as a dict {{filename}: {metadata}}. 
+            """
+        # Handed-off jobs have no file of ours to delete
+        if job.path:
+            try:
+                await asyncio.to_thread(os.remove, job.path)
+                print(f"[CLEANUP] Deleted {job.path}")
+            except Exception as e:
+                print(f"[CLEANUP] Failed to delete: {e}")
+        metadata_index.forget(key)
+
+    pending_jobs.pop(key, None)
+
+
+# -----------------------------
+# PRINT END HANDLING
+# -----------------------------
+async def handle_print_end(key, layer, total_layers, tag="[SDCP]", printer="", task_id=None, print_tasks=()):
+    """
+    The printer went idle after a print. If it stopped before its last layer (cancelled, failed, ran out of filament) the deduction
+    taken at print start is corrected down to what the layer index says was used by the end of the last layer it reported.
+    The correction goes through the journal like any other deduction, as a negative amount, see SpoolmanClient.refund.
+    """
+    # The print start deduction has to be in the session before we can correct it
+    if print_tasks:
+        await asyncio.gather(*print_tasks, return_exceptions=True)
+
+    try:
+        if not layer or not total_layers or layer >= total_layers:
+            return
+
+        session = print_sessions.get(printer, key, task_id)
+        if session is None or not session.get("deducted") or session.get("corrected"):
+            return
+
+        usage = await asyncio.to_thread(layer_index.usage_at, key, layer)
+        if usage is None:
+            print(f"{tag} Print stopped at layer {layer}/{total_layers} but {key} has no layer index, keeping the full deduction")
+            return
+
+        charged = {}  # preset -> [spool_id, grams]
+        for preset, spool_id, grams in session["deducted"]:
+            charged.setdefault(preset, [spool_id, 0.0])[1] += grams
+
+        corrections = []
+        for preset, (spool_id, grams) in charged.items():
+            refund = round(usage.get(preset, 0.0) - grams, 2)
+            if refund < 0:
+                print(f"[INFO] Print stopped at layer {layer}/{total_layers}, giving {-refund}g back to spool {spool_id} ({preset})")
+                corrections.append((spool_id, refund))
+
+        await queue_deductions(key, corrections)
+        await print_sessions.mark_corrected(printer, key, task_id)
+    finally:
+        if DELETE_AFTER_PRINT:
+            await asyncio.to_thread(layer_index.forget, key)
+
+
+# -----------------------------
+# SDCP PRINT STATE MACHINE
+# -----------------------------
+"""
+The print start / end / idle detection on its own, without any I/O. feed() takes one status update and returns the actions it calls for:
+    ("start", filename, task_id)                        status went to 13, a print started
+    ("ended",)                                          status left 13, the print ended or was paused
+    ("idle",)                                           any status 1, the printer's open print sessions can be closed
+    ("finished", job, layer, total_layers)              idle again after a print. job is (filename, task_id) or None
+    ("exit",)                                           one time mode is done with its print
+SdcpClient carries the actions out. The replayer drives the same machine with recorded traffic, see SDCP RECORD / REPLAY.
+"""
+class SdcpPrintState:
+    def __init__(self, always_running=True):
+        self.always_running = always_running
+        self.print_active = False  # This prevents repeating file checks
+        self.waiting_for_idle = False  # This prevents early exit on "always_running" = False.
+        self.last_status = None  # Not currently in use, but could be useful if needed.
+        self.job = None  # (filename, task_id) of the current / last print
+        self.layer = None  # last CurrentLayer / TotalLayer reported while printing
+        self.total_layers = None
+
+    def feed(self, current_status, filename, task_id=None, layer=None, total_layers=None):
+        actions = []
+
+        # -----------------------------
+        # PRINT START DETECTION
+        # -----------------------------
+        if current_status == 13 and not self.print_active:
+            self.print_active = True
+            if self.job != (filename, task_id):
+                self.job = (filename, task_id)
+                self.layer = self.total_layers = None
+            actions.append(("start", filename, task_id))
+
+        # Only while printing, some firmware resets CurrentLayer to 0 once a print is stopped
+        if current_status == 13 and layer is not None:
+            self.layer, self.total_layers = layer, total_layers
+
+        # -----------------------------
+        # PRINT END DETECTION
+        # -----------------------------
+        if current_status != 13 and self.print_active:
+            self.print_active = False
+            self.waiting_for_idle = True
+            actions.append(("ended",))
+
+        # Any idle closes this printer's open sessions, even ones left over from before a restart
+        if current_status == 1:
+            actions.append(("idle",))
+
+        if self.waiting_for_idle and current_status == 1:
+            actions.append(("finished", self.job, self.layer, self.total_layers))
+            self.job = None
+
+            if not self.always_running:
+                actions.append(("exit",))
+                return actions
+
+            self.waiting_for_idle = False
+
+        self.last_status = current_status
+        return actions
+
+
+# -----------------------------
+# SDCP STATUS QUEUE
+# -----------------------------
+"""
+Sits between the websocket reader and the processor. The printer repeats the same status over and over while printing,
+so an update identical to the last one queued is dropped instead of queued (coalesced).
+If it ever fills up the oldest entry is dropped, the reader never waits on the processor.
+"""
+class StatusQueue:
+    def __init__(self, maxsize=SDCP_QUEUE_SIZE):
+        self.items = deque()
+        self.maxsize = maxsize
+        self.last_put = None
+        self.ready = asyncio.Event()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, item):
+        if item == self.last_put:
+            self.coalesced += 1
+            return
+        if len(self.items) >= self.maxsize:
+            self.items.popleft()
+            self.dropped += 1
+        self.items.append(item)
+        self.last_put = item
+        self.ready.set()
+
+    async def get(self):
+        while not self.items:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.items.popleft()
+
+    def __len__(self):
+        return len(self.items)
+
+
 # -----------------------------
 # SDCP WEBSOCKET LISTENER (STATUS-BASED)
 # -----------------------------
-async def sdcp_listener():
-    last_status = None # Not currently in use, but could be useful if needed.
-    print_active = False # This prevents repeating file checks
-    waiting_for_idle = False  # This prevents early exit on "always_running" = False.
-    print_active_ref = [False]
-    waiting_for_idle_ref = [False]
-    test_print = False # SET TO TRUE TO TEST THE PRINT EXIT CONDITON.
+"""
+Split into two tasks:
+    reader    - receives messages, skips anything that isn't a Status packet before even decoding it, and queues (status, filename).
+    processor - runs the print start / end / idle detection off the queue.
+Each connection gets its own keepalive task which is cancelled when the connection drops.
+Reconnects back off exponentially with jitter, up to sdcp_backoff_max seconds.
+"""
+def parse_status_message(msg):
+    """
+    (status, filename, TaskId, CurrentLayer, TotalLayer) from one websocket message, None if it isn't a status packet.
+    """
+    if isinstance(msg, bytes):
+        msg = msg.decode("utf-8", errors="ignore")
 
-    while True:
-        try:
-            print("[SDCP] Connecting...")
-            async with websockets.connect(SDCP_WS_URL) as ws:
-                print("[SDCP] Connected")
+    # Cheap pre-filter, most traffic isn't a status packet
+    if '"Status"' not in msg:
+        return None
 
-                asyncio.create_task(keepalive(ws))
+    data = json.loads(msg)
+    if "Status" not in data:
+        return None
 
-                # Calls a Test Print.
-                if test_print:
-                    should_exit = await simulate_fake_print(print_active_ref, waiting_for_idle_ref, config)
-                    if should_exit:
-                        shutdown_event.set()
-                        return
-                    
-                async for msg in ws:
-                    data = json.loads(msg)
+    printinfo = data["Status"].get("PrintInfo", {})
+    current_status = printinfo.get("Status")
+    if current_status is None:
+        return None
+    return (current_status, printinfo.get("Filename", ""), printinfo.get("TaskId"), printinfo.get("CurrentLayer"), printinfo.get("TotalLayer"))
+
+
+class SdcpClient:
+    def __init__(self, url, name="", watch_folder=None):
+        self.url = url
+        self.name = name
+        self.watch_folder = watch_folder  # None = the main watch folder
+        self.tag = f"[SDCP:{name}]" if name else "[SDCP]"
+        self.queue = StatusQueue()
+        self.keepalive_task = None
+        self.print_tasks = set()  # running handle_print_start tasks
+        self.state = SdcpPrintState(config["always_running"])
+        self.job_key = None  # job key of the current / last print, for handle_print_end
+        self.recorder = SdcpRecorder(SDCP_RECORD_DIR, name) if SDCP_RECORD_DIR else None
+        self.test_print = False  # SET TO TRUE TO TEST THE PRINT EXIT CONDITON.
+        self.stats = {"messages": 0, "status_messages": 0, "reconnects": 0}
+        self.rate_mark = (time.monotonic(), 0)
+
+    # --- reader side ---
+
+    async def reader(self, ws):
+        async for msg in ws:
+            self.stats["messages"] += 1
+            if self.recorder is not None:
+                self.recorder.write(msg)
+
+            status = parse_status_message(msg)
+            if status is None:
+                continue
+
+            self.stats["status_messages"] += 1
+            self.queue.put(status)
+
+    # --- processor side ---
+
+    async def processor(self):
+        """
+        Returns True once one time mode is done and the daemon should exit.
+        """
+        while True:
+            status = await self.queue.get()
+            try:
+                if await self.handle_status(*status):
+                    return True
+            except Exception as e:
+                # One bad update must not end the processor, the printer connection would go with it
+                metrics.inc("spooler_failures_total", kind="status")
+                print(f"{self.tag} Failed to handle status {status}: {e}")
+
+    async def handle_status(self, current_status, filename, task_id=None, layer=None, total_layers=None):
+        for action in self.state.feed(current_status, filename, task_id, layer, total_layers):
+            if await self.perform(action):
+                return True
+        return False
+
+    async def perform(self, action):
+        """
+        Carries out one SdcpPrintState action. Returns True once one time mode is done.
+        """
+        kind = action[0]
+        if kind == "start":
+            _, filename, task_id = action
+            print(f"{self.tag} Print started detected via status transition")
+            print(f"{self.tag} Filename reported: {filename}")
+            key = self.job_key = printer_job_key(self.watch_folder or WATCH_FOLDER, filename)
+
+            # Reconnected or restarted in the middle of a print we've already charged
+            if print_sessions.already_charged(self.name, key, task_id):
+                print(f"{self.tag} Already deducted for this print, skipping")
+            else:
+                # Claimed right away, a reconnect replaying this start while we wait on metadata is then skipped above
+                print_sessions.begin(self.name, key, task_id)
+                # Waiting on metadata and the Spoolman calls happen in their own task, so status packets keep being read meanwhile
+                self.track(handle_print_start(key, self.tag, self.name, task_id))
+
+        elif kind == "ended":
+            print(f"{self.tag} Print ended or paused, resetting state")
+
+        elif kind == "idle":
+            await print_sessions.mark_ended(self.name)
+
+        elif kind == "finished":
+            _, job, layer, total_layers = action
+            print(f"{self.tag} Printer is idle")
+            if layer_index.enabled and job is not None and self.job_key is not None:
+                self.track(handle_print_end(self.job_key, layer, total_layers, self.tag, self.name, job[1], tuple(self.print_tasks)))
+
+        elif kind == "exit":
+            # Don't exit halfway through a deduction
+            if self.print_tasks:
+                await asyncio.gather(*self.print_tasks, return_exceptions=True)
+            await deduction_queue.flush(timeout=30)
+            print(f"{self.tag} One Time Mode: Exiting now")
+            return True
 
-                    # Only process status packets
-                    if "Status" not in data:
-                        continue
+        return False
 
-                    status_block = data["Status"]
-                    printinfo = status_block.get("PrintInfo", {})
+    def busy(self):
+        """
+        In the middle of a print, or still charging one.
+        """
+        return self.state.print_active or self.state.waiting_for_idle or bool(self.print_tasks)
 
-                    current_status = printinfo.get("Status")
-                    filename = printinfo.get("Filename", "")
+    def track(self, coro):
+        task = asyncio.create_task(coro)
+        self.print_tasks.add(task)
+        task.add_done_callback(self.print_tasks.discard)
 
-                    if current_status is None:
-                        continue
+    # --- connection ---
+
+    def backoff_delay(self, attempt):
+        # Full jitter: anywhere between 0 and the exponential cap, so a farm of daemons doesn't reconnect in lockstep
+        return random.uniform(0, min(SDCP_BACKOFF_MAX, 2 ** attempt))
+
+    def stop_keepalive(self):
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+            self.keepalive_task = None
+
+    def messages_per_second(self):
+        now = time.monotonic()
+        mark_time, mark_count = self.rate_mark
+        self.rate_mark = (now, self.stats["messages"])
+        elapsed = now - mark_time
+        return (self.stats["messages"] - mark_count) / elapsed if elapsed > 0 else 0.0
 
-                    # -----------------------------
-                    # PRINT START DETECTION
-                    # -----------------------------
-                    if current_status == 13 and not print_active:
-                        print_active = True
-                        print(f"[SDCP] Print started detected via status transition")
-                        print(f"[SDCP] Filename reported: {filename}")
-
-                        shortname = os.path.basename(filename)
-
-                        # Retry for race condition
-                        if shortname not in pending_jobs:
-                            print("[SDCP] No matching job yet, retrying...")
-
-                            max_retries = 60  # 60 seconds
-                            for attempt in range(max_retries):
-                                await asyncio.sleep(1)
-
-                                if shortname in pending_jobs:
-                                    print(f"[SDCP] Match found after {attempt+1} seconds")
-                                    break
-
-                                if attempt % 10 == 0:
-                                    print(f"[SDCP] Still waiting for metadata... ({attempt}/{max_retries})")
-
-                        if shortname not in pending_jobs:
-                            print(f"[SDCP] Still no matching job for '{shortname}' after full retry window, skipping")
-                        else:
-                            job = pending_jobs[shortname]
-                            presets = job.get("filament_presets", [])
-                            usage_list = job.get("filament_g_list", [])
-
-                            print(f"[SDCP] Using metadata: presets={presets}, usage={usage_list}")
-
-                            if not presets or not usage_list:
-                                print(f"[ERROR] Missing filament metadata for {shortname}")
-                            else:
-                                refresh_spool_cache()
-
-                                for preset, usage_g in zip(presets, usage_list):
-                                    if usage_g <= 0:
-                                        continue
-
-                                    spool_id = find_spool_for_preset(preset)
-                                    if not spool_id:
-                                        print(f"[ERROR] No matching spool for preset '{preset}'")
-                                        continue
-
-                                    print(f"[INFO] Subtracting {usage_g}g from spool {spool_id} ({preset})")
-                                    update_spoolman(spool_id, usage_g)
-
-                            # Cleanup
-                            if DELETE_AFTER_PRINT:
-                                """
-                                I prefer this setup as most of the time we just print it once and that is that. No need to keep so many duplicates.
-                                Although, we can turn this off in the config, a use for that could be say: 
-                                    We have "always_running": True and "delete_after_print": False, this would mean the file would stay in the folder and thus the metadata. We could then run a print again of the same GCODE from the printer itself
-                                        and it would still subtract the filament from spoolman.
-                                        
-                                    This would be useful if we prefered to use the printers interface to do the printing or even when we use other interfaces like octoeverywhere, or we do a mix of both. deleting the file means we need to move the gcode 
-                                        (manually or automatically with script) each time we print. I like this method as I have the pc here, but I can see pros for the other way also.
-                                        
-                                    Though, as I don't use the other way, I am not certain about how well it works when there are MANY GCODEs available. But as the daemon ensures to only use the settings of the matching GCODE file, then it should be okay.
-                                        Infact it should be fine as it saves the metadata as a dict {{filename}: {metadata}}. 
-                                    """
-                                try:
-                                    os.remove(job["path"])
-                                    print(f"[CLEANUP] Deleted {job['path']}")
-                                except Exception as e:
-                                    print(f"[CLEANUP] Failed to delete: {e}")
-
-                            del pending_jobs[shortname]
-
-                    # -----------------------------
-                    # PRINT END DETECTION
-                    # -----------------------------
-                    if current_status != 13 and print_active:
-                        print("[SDCP] Print ended or paused, resetting state")
-                        print_active = False
-                        waiting_for_idle = True
-                    
-                    
-
-                    if waiting_for_idle and current_status == 1:
-                        print("[SDCP] Printer is idle")
-
-                        if not config["always_running"]:
-                            print("[SDCP] One Time Mode: Exiting now")
-                            shutdown_event.set()
+    def stats_line(self):
+        return (f"{self.messages_per_second():.1f} msg/s, queue={len(self.queue)}, reconnects={self.stats['reconnects']}, "
+                f"coalesced={self.queue.coalesced}, dropped={self.queue.dropped}, status={self.stats['status_messages']}")
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(SDCP_STATS_INTERVAL)
+            print(f"{self.tag} Stats: {self.stats_line()}")
+
+    async def run(self):
+        processor = asyncio.create_task(self.processor())
+        reporter = asyncio.create_task(self.report_stats()) if SDCP_STATS_INTERVAL else None
+        attempt = 0
+
+        try:
+            while not processor.done():
+                reader = None
+                try:
+                    print(f"{self.tag} Connecting...")
+                    async with websockets.connect(self.url) as ws:
+                        mark_startup("websocket connected")
+                        print(f"{self.tag} Connected")
+                        attempt = 0
+
+                        self.stop_keepalive()
+                        self.keepalive_task = asyncio.create_task(keepalive(ws))
+
+                        # Calls a Test Print.
+                        if self.test_print:
+                            should_exit = await simulate_fake_print([self.state.print_active], [self.state.waiting_for_idle], config)
+                            if should_exit:
+                                return
+
+                        reader = asyncio.create_task(self.reader(ws))
+                        await asyncio.wait({reader, processor}, return_when=asyncio.FIRST_COMPLETED)
+                        if processor.done():
                             return
-                        
-                        waiting_for_idle = False
+                        reader.result()  # re-raises the connection error, if any
+                        print(f"{self.tag} Connection closed by printer")
+
+                except Exception as e:
+                    print(f"{self.tag} Connection error: {e}")
+                finally:
+                    self.stop_keepalive()
+                    if reader is not None:
+                        reader.cancel()
+
+                self.stats["reconnects"] += 1
+                metrics.inc("spooler_reconnects_total", target="sdcp", printer=self.name)
+                delay = self.backoff_delay(attempt)
+                attempt += 1
+                print(f"{self.tag} Reconnecting in {delay:.1f} seconds... ({self.stats_line()})")
+                await asyncio.sleep(delay)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            if not processor.done():
+                processor.cancel()
+            if self.recorder is not None:
+                self.recorder.close()
+
+
+async def sdcp_listener(printers=None):
+    """
+    One SdcpClient per printer, all in this event loop and sharing the spool cache, matcher index and Spoolman session.
+    In one time mode the daemon exits once a printer has finished its print and no other printer is still busy with one.
+    A busy printer exits by itself after its own print, so its deductions are never cut off.
+    """
+    clients = [SdcpClient(p["sdcp_ws_url"], p["name"], p["watch_folder"]) for p in (printers or PRINTERS)]
+    tasks = {asyncio.create_task(client.run()): client for client in clients}
+    pending = set(tasks)
+    try:
+        while pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if not any(tasks[task].busy() for task in pending):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+    shutdown_event.set()
 
-                        
 
-                    last_status = current_status
+# -----------------------------
+# SDCP RECORD / REPLAY
+# -----------------------------
+"""
+With sdcp_record_dir set, every message each printer sends is written to <dir>/<printer>-<date>-<time>.sdcp.gz as it arrives,
+one line per message: "<unix time> <message>". Status packets repeat all day, so gzip gets them down to a few bytes each.
+A recording is flushed every few seconds, a crash only loses the last moments of it.
+
+--replay feeds recordings back through parse_status_message and SdcpPrintState, exactly what the live reader and processor run,
+and prints the actions they produce instead of carrying them out (nothing is deducted). --replay-speed 1 keeps the recorded timing,
+0 (default) goes as fast as possible, which is also how the status handling throughput is measured.
+Each file is replayed as its own session, the same as a daemon restart. Replays always behave like always running mode.
+"""
+SDCP_RECORD_DIR = config.get("sdcp_record_dir")
+SDCP_RECORD_FLUSH = 5  # seconds between flushes of a recording
+
+
+class SdcpRecorder:
+    def __init__(self, folder, name="", flush_interval=SDCP_RECORD_FLUSH):
+        self.folder = folder
+        self.name = name or "printer"
+        self.flush_interval = flush_interval
+        self.file = None
+        self.path = None
+        self.last_flush = 0.0
+        self.failed = False
+
+    def open(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.path = os.path.join(self.folder, f"{self.name}-{datetime.now():%Y%m%d-%H%M%S}.sdcp.gz")
+        self.file = gzip.open(self.path, "at", encoding="utf-8")
+        print(f"[RECORD] Recording {self.name} to {self.path}")
+
+    def write(self, msg, ts=None):
+        if self.failed:
+            return
+        if isinstance(msg, bytes):
+            msg = msg.decode("utf-8", errors="ignore")
+        # JSON doesn't need the newlines, and the recording is one message per line
+        msg = msg.replace("\n", " ")
+        try:
+            if self.file is None:
+                self.open()
+            self.file.write(f"{time.time() if ts is None else ts:.3f} {msg}\n")
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+        except OSError as e:
+            print(f"[RECORD] Recording stopped: {e}")
+            self.failed = True
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+
+def read_recording(path):
+    """
+    Yields (unix time, message) from a recording. Plain text recordings work too.
+    """
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    with (gzip.open if compressed else open)(path, "rt", encoding="utf-8", errors="replace") as f:
+        try:
+            for line in f:
+                ts, _, msg = line.rstrip("\n").partition(" ")
+                try:
+                    ts = float(ts)
+                except ValueError:
+                    continue
+                yield ts, msg
+        except EOFError:
+            return  # recording cut off by a crash, keep what we have
+
+
+def replay_sdcp(paths, speed=0.0, max_gap=60.0, verbose=True):
+    """
+    Returns the stats of the replay. max_gap caps how long a real time replay waits between two messages (eg while disconnected).
+    """
+    stats = {"files": 0, "messages": 0, "status_messages": 0, "coalesced": 0, "actions": {}, "recorded_s": 0.0}
+    started = time.perf_counter()
+
+    for path in paths:
+        stats["files"] += 1
+        state = SdcpPrintState(always_running=True)
+        name = os.path.basename(path)
+        last = None
+        first_ts = prev_ts = None
+        for ts, msg in read_recording(path):
+            if first_ts is None:
+                first_ts = ts
+            if speed and prev_ts is not None and ts > prev_ts:
+                time.sleep(min(max_gap, (ts - prev_ts) / speed))
+            prev_ts = ts
+            stats["messages"] += 1
+
+            try:
+                status = parse_status_message(msg)
+            except ValueError:
+                continue
+            if status is None:
+                continue
+            stats["status_messages"] += 1
+            # Same coalescing as the StatusQueue
+            if status == last:
+                stats["coalesced"] += 1
+                continue
+            last = status
+
+            for action in state.feed(*status):
+                stats["actions"][action[0]] = stats["actions"].get(action[0], 0) + 1
+                if verbose:
+                    print(f"[REPLAY] {datetime.fromtimestamp(ts).isoformat(' ', 'milliseconds')} {name} {' '.join(str(a) for a in action)}")
+        if first_ts is not None:
+            stats["recorded_s"] += prev_ts - first_ts
+
+    stats["elapsed_s"] = time.perf_counter() - started
+    stats["messages_per_s"] = stats["messages"] / stats["elapsed_s"] if stats["elapsed_s"] > 0 else 0.0
+    return stats
+
+
+# -----------------------------
+# MATCH REPORT
+# -----------------------------
+async def match_report():
+    """
+    --match-report: a dry run of how every filament preset in the watch folder(s) would resolve against the Spoolman inventory right now.
+    Uses the metadata index where it can, nothing is deducted and nothing is written.
+    """
+    if not await spool_cache.refresh():
+        return
+
+    metadata_index.load()
+    jobs = {}  # preset -> [job keys]
+    for folder in watch_folders():
+        try:
+            paths = sorted(list_gcode_files(folder))
+        except FileNotFoundError:
+            print(f"[REPORT] Watch folder missing: {folder}")
+            continue
+        for path in paths:
+            key = job_key(path)
+            meta = metadata_index.lookup(key, os.stat(path)) or await asyncio.to_thread(parse_gcode_metadata, path)
+            for preset in meta.get("filament_presets", []):
+                jobs.setdefault(preset, []).append(key)
+    for key, meta in metadata_index.handoffs().items():
+        for preset in meta.get("filament_presets", []):
+            jobs.setdefault(preset, []).append(key)
+
+    print(f"[REPORT] {len(jobs)} presets in use, matched against {len(spool_cache.spools)} spools (fuzzy threshold {FUZZY_MATCH_THRESHOLD})")
+    unmatched = 0
+    for preset in sorted(jobs):
+        spool_id, stage, confidence = resolve_preset(preset)
+        if spool_id is None:
+            unmatched += 1
+            print(f"  {preset!r:45} -> NO MATCH")
+        else:
+            vendor, material, color = spool_match_fields(spool_cache.by_id.get(spool_id, {}))
+            print(f"  {preset!r:45} -> spool {spool_id} ({vendor} / {material} / {color}) via {stage}, confidence {confidence}")
+        print(f"      used by: {', '.join(jobs[preset])}")
+    print(f"[REPORT] {len(jobs) - unmatched} matched, {unmatched} unmatched")
+
+
+# -----------------------------
+# OFFLINE RECONCILIATION
+# -----------------------------
+# --reconcile catches up on prints the daemon missed (it was down, or a deduction never made it). It takes folders, .zip or .tar(.gz)
+# archives of G-codes and charges them in one go:
+#   1. every G-code is parsed across the scan pool, copies of content parsed before come from the metadata index (see content_fingerprint)
+#   2. with --history (or --history-file) the printer's own print history decides what was printed and how often. Only files it lists are
+#      charged, once per print. Stopped / failed prints are charged up to the last layer they reached, where the file has a layer pass
+#      (see LAYER USAGE INDEX). A file name shared by different G-codes is skipped, the history can't tell which one was printed.
+#      Without a history every distinct file counts as printed once, so check the --dry-run report first.
+#   3. each distinct preset is resolved once and the grams are summed per spool
+#   4. one deduction per spool goes through the deduction journal: the whole catch up is one inventory download plus one /use per spool
+# Whatever is charged goes into the journal's charged ledger in the same write as its deductions (see DEDUCTION JOURNAL): history prints
+# by printer + TaskId, like the daemon's own prints, files without a history by their content fingerprint. Both are skipped on later
+# runs, --force charges files without a history again.
+# --dry-run prints the same report and stops before step 4.
+SDCP_HISTORY_COMPLETED = 1  # TaskStatus of a finished print in the history, 2 is failed and 3 stopped
+
+
+def collect_reconcile_files(sources, extract_dir):
+    """
+    (name, path) of every G-code in the given folders, archives and files. Archive members are extracted to extract_dir.
+    name is the bare file name, which is what the printer's history reports.
+    """
+    import shutil
+    import tarfile
+    import zipfile
+
+    files = []
+
+    def extract(name, stream):
+        path = os.path.join(extract_dir, f"{len(files)}-{name}")  # never the member's own path, archives can hold "../"
+        with open(path, "wb") as out:
+            shutil.copyfileobj(stream, out, 1024 * 1024)
+        files.append((name, path))
+
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                files.extend((name, os.path.join(root, name)) for name in sorted(names) if is_gcode_file(name))
+        elif zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                for member in archive.infolist():
+                    name = os.path.basename(member.filename)
+                    if not member.is_dir() and is_gcode_file(name):
+                        with archive.open(member) as stream:
+                            extract(name, stream)
+        elif os.path.isfile(source) and tarfile.is_tarfile(source):
+            with tarfile.open(source) as archive:
+                for member in archive:
+                    name = os.path.basename(member.name)
+                    if member.isfile() and is_gcode_file(name):
+                        extract(name, archive.extractfile(member))
+        elif os.path.isfile(source) and is_gcode_file(source):
+            files.append((os.path.basename(source), source))
+        else:
+            print(f"[RECONCILE] Skipping {source}: not a folder, archive or G-code")
+    return files
+
+
+def reconcile_name(filename):
+    """
+    File names from archives, folders and the printer's history compared the same way, see job_key.
+    """
+    name = os.path.basename(filename.replace("\\", "/"))
+    return name[:-3] if name.lower().endswith(".gcode.gz") else name
+
+
+def normalize_history_entry(entry):
+    """
+    One task from an SDCP Cmd 321 reply (HistoryDetailTaskList), or one we normalized before.
+    """
+    if "task_id" in entry:
+        return entry
+    return {
+        "task_id": entry.get("TaskId"),
+        "filename": entry.get("TaskName") or "",
+        "begin": entry.get("BeginTime") or 0,
+        "end": entry.get("EndTime") or 0,
+        "status": entry.get("TaskStatus"),
+        "layer": entry.get("AlreadyPrintLayer") or 0,
+    }
+
+
+async def fetch_print_history(url, timeout=15):
+    """
+    The printer's print history over SDCP: Cmd 320 lists the task ids, Cmd 321 returns their details (50 at a time).
+    """
+    async def request(ws, mainboard, cmd, data):
+        request_id = uuid.uuid4().hex
+        await ws.send(json.dumps({
+            "Id": "", "Topic": f"sdcp/request/{mainboard}",
+            "Data": {"Cmd": cmd, "Data": data, "RequestID": request_id, "MainboardID": mainboard, "TimeStamp": int(time.time()), "From": 0},
+        }))
+        async for msg in ws:
+            try:
+                body = json.loads(msg).get("Data")
+            except (ValueError, AttributeError):
+                continue
+            if isinstance(body, dict) and body.get("Cmd") == cmd and body.get("RequestID") in (request_id, None):
+                return body.get("Data") or {}
+        raise ConnectionError("printer closed the connection")
+
+    async def session():
+        async with websockets.connect(url) as ws:
+            # The printer pushes its status on connect, which tells us the MainboardID requests have to be addressed to
+            await ws.send(json.dumps({"cmd": "get_state"}))
+            mainboard = ""
+            async for msg in ws:
+                try:
+                    data = json.loads(msg)
+                except ValueError:
+                    continue
+                mainboard = data.get("MainboardID") or data.get("Attributes", {}).get("MainboardID") or ""
+                if mainboard or "Status" in data:
+                    break
+
+            task_ids = (await request(ws, mainboard, 320, {})).get("HistoryData") or []
+            tasks = []
+            for i in range(0, len(task_ids), 50):
+                details = await request(ws, mainboard, 321, {"Id": task_ids[i:i + 50]})
+                tasks.extend(normalize_history_entry(entry) for entry in details.get("HistoryDetailTaskList") or [])
+            return tasks
+
+    return await asyncio.wait_for(session(), timeout=timeout)
+
+
+def aggregate_usage(charges):
+    """
+    charges is a list of (presets, grams) per print. Every print's presets and grams go into flat arrays, each distinct preset is
+    resolved to a spool once, and the grams are summed per spool in one pass over the arrays.
+    Returns ({spool_id: grams}, {spool_id: prints}, {preset: grams} for presets with no spool).
+    """
+    preset_ids = array("I")
+    grams = array("d")
+    prints = array("I")
+    for n, (presets, g_list) in enumerate(charges):
+        count = min(len(presets), len(g_list))
+        preset_ids.extend(preset_table.intern(preset) for preset in presets[:count])
+        grams.extend(g_list[:count])
+        prints.extend(itertools.repeat(n, count))
+
+    spool_of = {i: find_spool_for_preset(preset_table.names[i]) for i in set(preset_ids)}
+
+    per_spool, spool_prints, unmatched = {}, {}, {}
+    for i, g, n in zip(preset_ids, grams, prints):
+        spool_id = spool_of[i]
+        if spool_id is None:
+            name = preset_table.names[i]
+            unmatched[name] = unmatched.get(name, 0.0) + g
+        else:
+            per_spool[spool_id] = per_spool.get(spool_id, 0.0) + g
+            spool_prints.setdefault(spool_id, set()).add(n)
+    return per_spool, {spool_id: len(n) for spool_id, n in spool_prints.items()}, unmatched
+
+
+async def reconcile(sources, history=None, dry_run=False, printer=None, since=None, force=False):
+    """
+    history is a list of normalized history entries (see normalize_history_entry), None to charge every file once.
+    since (unix time) skips prints that started earlier, or without a history files last modified earlier.
+    force charges files without a history even if an earlier reconcile charged the same content.
+    """
+    import tempfile
+
+    printer = printer or PRINTERS[0]
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    metadata_index.load()
+    print_sessions.load()
+    deduction_queue.load()
+    print_sessions.recover(deduction_queue.sessions)
+    # The fingerprint is the ledger key of a file charged without a history, so it is needed even with the content cache off
+    hash_mode = "full" if CONTENT_HASH == "full" else "sample"
+
+    with tempfile.TemporaryDirectory() as extract_dir:
+        files = collect_reconcile_files(sources, extract_dir)
+        if since and history is None:
+            files = [(name, path) for name, path in files if os.path.getmtime(path) >= since]
+        print(f"[RECONCILE] {len(files)} G-codes to read")
+
+        executor = make_scan_executor()
+
+        async def read(path):
+            fingerprint = await loop.run_in_executor(executor, content_fingerprint, path, hash_mode)
+            meta = metadata_index.find_content(fingerprint) if CONTENT_HASH == hash_mode else None
+            if meta is None:
+                meta = await loop.run_in_executor(executor, parse_gcode_metadata, path)
+            return fingerprint, meta
+
+        try:
+            results = await asyncio.gather(*(read(path) for _, path in files), return_exceptions=True)
+        finally:
+            executor.shutdown(wait=False)
+
+        parsed = []  # (name, path, fingerprint, meta)
+        for (name, path), result in zip(files, results):
+            if isinstance(result, Exception):
+                print(f"[RECONCILE] Failed to parse {name}: {result}")
+                continue
+            parsed.append((reconcile_name(name), path, *result))
+        print(f"[RECONCILE] Parsed {len(parsed)} G-codes in {time.perf_counter() - started:.2f}s")
+
+        charges = []        # (presets, grams) per print
+        charged_keys = []   # charged ledger keys, journaled with the deductions
+        skipped = {}        # reason -> count
+        missing = set()
+
+        def skip(reason):
+            skipped[reason] = skipped.get(reason, 0) + 1
+
+        if history is None:
+            seen = set()
+            for name, path, fingerprint, meta in parsed:
+                key = f"file|{fingerprint}"
+                if fingerprint in seen:
+                    skip("same content as another file")
+                elif key in deduction_queue.charged and not force:
+                    skip("charged by an earlier reconcile (--force to charge again)")
+                else:
+                    charges.append((meta["filament_presets"], meta["filament_g_list"]))
+                    charged_keys.append(key)
+                seen.add(fingerprint)
+        else:
+            jobs = {}  # name -> (path, fingerprint, meta)
+            ambiguous = set()
+            for name, path, fingerprint, meta in parsed:
+                if name in jobs and jobs[name][1] != fingerprint:
+                    ambiguous.add(name)
+                jobs.setdefault(name, (path, fingerprint, meta))
+            for name in ambiguous:
+                del jobs[name]
+            if ambiguous:
+                print(f"[RECONCILE] Different G-codes share these names, their prints are skipped: {', '.join(sorted(ambiguous))}")
+
+            layers = LayerIndex(os.path.join(extract_dir, ".layers"), enabled=True)
+            for task in history:
+                name = reconcile_name(task["filename"])
+                ledger_key = PrintSessions.task_key(printer["name"], task["task_id"])
+                key = printer_job_key(printer["watch_folder"] or WATCH_FOLDER, task["filename"])
+                if since and task["begin"] < since:
+                    skip("before --since")
+                elif ledger_key in deduction_queue.charged or print_sessions.already_charged(printer["name"], key, task["task_id"]):
+                    skip("already charged")
+                elif name in ambiguous:
+                    skip("file name shared by different G-codes")
+                elif name not in jobs:
+                    missing.add(name)
+                    skip("G-code not found")
+                elif task["status"] == SDCP_HISTORY_COMPLETED:
+                    meta = jobs[name][2]
+                    charges.append((meta["filament_presets"], meta["filament_g_list"]))
+                    charged_keys.append(ledger_key)
+                else:
+                    # Stopped or failed part way, charge what was printed up to its last layer
+                    usage = None
+                    if task["layer"]:
+                        await loop.run_in_executor(None, layers.ensure, name, jobs[name][0])
+                        usage = layers.usage_at(name, task["layer"])
+                    if usage:
+                        charges.append((list(usage), [round(g, 2) for g in usage.values()]))
+                        charged_keys.append(ledger_key)
+                    else:
+                        skip("stopped / failed, no layer data")
+
+        if not await spool_cache.refresh():
+            print("[RECONCILE] Could not load spools from Spoolman, nothing charged")
+            return False
+
+        per_spool, spool_prints, unmatched = aggregate_usage(charges)
+
+    # Report
+    print(f"\n[RECONCILE] {len(charges)} prints to charge" + (f" from {len(history)} in the printer's history" if history is not None else ""))
+    for reason, count in sorted(skipped.items()):
+        print(f"    skipped {count:5d}  {reason}")
+    if missing:
+        print(f"    not found: {', '.join(sorted(missing)[:20])}{' ...' if len(missing) > 20 else ''}")
+
+    print(f"\n{'spool':>7}  {'prints':>6}  {'grams':>10}  {'remaining':>10}  {'after':>10}  filament")
+    for spool_id, grams in sorted(per_spool.items(), key=lambda kv: -kv[1]):
+        spool = spool_cache.by_id.get(spool_id, {})
+        remaining = spool.get("remaining_weight")
+        after = f"{remaining - grams:10.2f}" if remaining is not None else f"{'?':>10}"
+        warning = "  (goes below 0)" if remaining is not None and remaining < grams else ""
+        print(f"{spool_id:>7}  {spool_prints[spool_id]:>6}  {grams:10.2f}  {remaining if remaining is not None else '?':>10}  {after}  {' - '.join(spool_match_fields(spool)) if spool else ''}{warning}")
+    for preset, grams in sorted(unmatched.items(), key=lambda kv: -kv[1]):
+        print(f"{'-':>7}  {'':>6}  {grams:10.2f}  {'':>10}  {'':>10}  {preset}  (no matching spool, not charged)")
+    print(f"\n[RECONCILE] {sum(per_spool.values()):.2f}g over {len(per_spool)} spools, {sum(unmatched.values()):.2f}g unmatched")
+
+    if dry_run:
+        print("[RECONCILE] Dry run, nothing charged")
+        return True
+
+    # Apply. The ledger keys go in the same journal write as the deductions, so they are charged and recorded together or not at all.
+    try:
+        await deduction_queue.enqueue("reconcile", [(spool_id, round(grams, 2)) for spool_id, grams in per_spool.items()], ledger=charged_keys)
+    except OSError as e:
+        print(f"[RECONCILE] Failed to write the deduction journal, nothing charged: {e}")
+        return False
+
+    drainer = asyncio.create_task(deduction_queue.drainer())
+    try:
+        sent = await deduction_queue.flush(timeout=60)
+    finally:
+        drainer.cancel()
+    print(f"[RECONCILE] {'Done' if sent else 'Queued'}: {len(per_spool)} deductions in {time.perf_counter() - started:.2f}s")
+    return sent
 
-                    
 
-        except Exception as e:
-            print(f"[SDCP] Connection error: {e}")
-            print("[SDCP] Reconnecting in 3 seconds...")
-            await asyncio.sleep(3)
 # -----------------------------
 # MAIN
 # -----------------------------
 async def main_async():
-    refresh_spool_cache()
-    observer = start_folder_watcher()
+    mark_startup("event loop started")
+    print_sessions.load()
+    deduction_queue.load()
+    print_sessions.recover(deduction_queue.sessions)
 
-    initial_folder_scan()
-
-    # Start SDCP listener
+    # Printer connection goes first, everything else starts while it connects. A print start waits on whatever it still needs (spools, metadata).
     sdcp_task = asyncio.create_task(sdcp_listener())
 
+    spool_cache.refresh_in_background()
+    refresher_task = asyncio.create_task(spool_cache.background_refresher())
+    # One time mode is gone again after a single print, not worth a subscription
+    events_task = asyncio.create_task(spool_cache.watch_events()) if SPOOLMAN_EVENTS and config["always_running"] else None
+    drainer_task = asyncio.create_task(deduction_queue.drainer())
+    pipeline = IngestPipeline(asyncio.get_running_loop(), register_job)
+    pipeline.start()
+    observer = start_folder_watcher(pipeline)
+    # copy_to_watch.py only hands jobs to an always running daemon, see HANDOFF SERVER
+    handoff_server = await start_handoff_server() if config["always_running"] else None
+    metrics_server = await start_metrics_server()
+    # Only sampled when something reads the metrics
+    lag_task = asyncio.create_task(monitor_loop_lag()) if METRICS_PORT or METRICS_LOG_INTERVAL else None
+    metrics_log_task = asyncio.create_task(log_metrics()) if METRICS_LOG_INTERVAL else None
+
+    scan_task = asyncio.create_task(initial_folder_scan())
+
     # Wait for shutdown signal
     await shutdown_event.wait()
 
@@ -519,6 +3988,11 @@ async def main_async():
     # Stop folder watcher
     observer.stop()
     observer.join()
+    pipeline.stop()
+    if handoff_server is not None:
+        handoff_server.close()
+    if metrics_server is not None:
+        metrics_server.close()
 
     # Cancel SDCP listener if still running
     sdcp_task.cancel()
@@ -527,9 +4001,75 @@ async def main_async():
     except:
         pass
 
+    scan_task.cancel()
+    refresher_task.cancel()
+    if events_task is not None:
+        events_task.cancel()
+    if lag_task is not None:
+        lag_task.cancel()
+    if metrics_log_task is not None:
+        metrics_log_task.cancel()
+    drainer_task.cancel()
+    spoolman.close()
+
     print("[MAIN] Daemon exiting cleanly")
 
 def main():
+    global startup_profile
+
+    parser = argparse.ArgumentParser(description="SDCP → Spoolman daemon")
+    parser.add_argument("--startup-profile", action="store_true", help="print how long each startup step takes")
+    parser.add_argument("--match-report", action="store_true", help="show how every preset in the watch folder would match, then exit")
+    parser.add_argument("--replay", nargs="+", metavar="RECORDING", help="replay recorded printer traffic through the print detection, then exit")
+    parser.add_argument("--replay-speed", type=float, default=0, help="1 = recorded timing, 0 = as fast as possible (default)")
+    parser.add_argument("--replay-quiet", action="store_true", help="only print the summary")
+    parser.add_argument("--reconcile", nargs="+", metavar="PATH", help="charge G-codes from these folders / archives in one go, then exit")
+    parser.add_argument("--history", action="store_true", help="with --reconcile, only charge what the printer's print history lists")
+    parser.add_argument("--history-file", help="with --reconcile, a saved print history (JSON list) instead of asking the printer")
+    parser.add_argument("--printer", help="with --reconcile, the printer (name from \"printers\") whose history to use")
+    parser.add_argument("--since", help="with --reconcile, skip prints before this date (YYYY-MM-DD)")
+    parser.add_argument("--dry-run", action="store_true", help="with --reconcile, report only, charge nothing")
+    parser.add_argument("--force", action="store_true", help="with --reconcile and no history, charge files an earlier reconcile already charged")
+    args = parser.parse_args()
+
+    if args.match_report:
+        asyncio.run(match_report())
+        spoolman.close()
+        return
+
+    if args.reconcile:
+        printer = next((p for p in PRINTERS if p["name"] == args.printer), None) if args.printer else PRINTERS[0]
+        if printer is None:
+            print(f"[RECONCILE] No printer named '{args.printer}'")
+            return
+        since = datetime.strptime(args.since, "%Y-%m-%d").timestamp() if args.since else None
+
+        async def run():
+            history = None
+            if args.history_file:
+                with open(args.history_file, "r") as f:
+                    history = [normalize_history_entry(entry) for entry in json.load(f)]
+            elif args.history:
+                history = await fetch_print_history(printer["sdcp_ws_url"])
+                print(f"[RECONCILE] {len(history)} prints in the printer's history")
+            return await reconcile(args.reconcile, history, args.dry_run, printer, since, args.force)
+
+        asyncio.run(run())
+        spoolman.close()
+        return
+
+    if args.replay:
+        stats = replay_sdcp(args.replay, args.replay_speed, verbose=not args.replay_quiet)
+        print(f"[REPLAY] {stats['files']} recordings, {stats['messages']} messages ({stats['status_messages']} status, {stats['coalesced']} coalesced) "
+              f"covering {stats['recorded_s'] / 3600:.2f} hours, replayed in {stats['elapsed_s']:.2f}s ({stats['messages_per_s']:.0f} msg/s)")
+        print(f"[REPLAY] Actions: {stats['actions']}")
+        return
+
+    startup_profile = args.startup_profile
+    if startup_profile:
+        for label, seconds in startup_marks.items():
+            print(f"[PROFILE] {seconds * 1000:8.1f} ms  {label}")
+
     try:
         asyncio.run(main_async())
     except KeyboardInterrupt:
@@ -0,0 +1,73 @@
+import os
+import re
+
+# -----------------------------
+# GCODE TAIL SCAN
+# -----------------------------
+"""
+Finding the two filament lines in a text G-code, shared by daemon.py and copy_to_watch.py.
+Standard library only: copy_to_watch.py runs in the slicer's own Python, which doesn't have the daemon's dependencies.
+"""
+GCODE_TAIL_BLOCK_SIZE = 256 * 1024        # bytes read per backwards step
+GCODE_TAIL_MAX_BYTES = 16 * 1024 * 1024   # daemon.py overrides this with gcode_tail_max_bytes
+
+GCODE_PRESETS_RE = re.compile(r'"([^"]+)"')
+GCODE_NUMBER_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+
+
+def match_metadata_line(line, filament_presets, filament_g_list):
+    """
+    Checks a single G-code line for the two keys we care about.
+    Returns the (possibly updated) filament_presets and filament_g_list.
+    """
+    lower = line.lower()
+
+    # --- FILAMENT PRESETS ---
+    if filament_presets is None and "filament_settings_id" in lower:
+        # Extract all quoted strings
+        presets = GCODE_PRESETS_RE.findall(line)
+        if presets:
+            filament_presets = presets
+
+    # --- FILAMENT USED [G] ---
+    # Orca also writes "; total filament used [g] = x" right after the per-filament list. That one is a single sum, so skip it.
+    if filament_g_list is None and "filament used [g]" in lower and "total filament used" not in lower:
+        nums = GCODE_NUMBER_RE.findall(line)
+        if nums:
+            filament_g_list = [float(n) for n in nums]
+
+    return filament_presets, filament_g_list
+
+
+def scan_gcode_tail(path, block_size=GCODE_TAIL_BLOCK_SIZE, max_bytes=GCODE_TAIL_MAX_BYTES):
+    """
+    Reads the file backwards from EOF in blocks, line by line, and stops as soon as both keys are found.
+    Orca writes the filament summary and the config block at the very end, so this is normally only a few hundred KB even for huge files.
+    Returns (filament_presets, filament_g_list, bytes_read).
+    """
+    filament_presets = None
+    filament_g_list = None
+    bytes_read = 0
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        carry = b""  # partial line left over from the previous (later) block
+
+        while pos > 0 and bytes_read < max_bytes:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step) + carry
+            bytes_read += step
+
+            lines = chunk.split(b"\n")
+            # The first line may be cut in half unless we are at the start of the file
+            carry = lines.pop(0) if pos > 0 else b""
+
+            for raw in reversed(lines):
+                filament_presets, filament_g_list = match_metadata_line(raw.decode("utf-8", errors="ignore"), filament_presets, filament_g_list)
+                if filament_g_list is not None and filament_presets is not None:
+                    return filament_presets, filament_g_list, bytes_read
+
+    return filament_presets, filament_g_list, bytes_read
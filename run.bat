@@ -23,10 +23,19 @@ REM Activate venv
 echo [SETUP] Activating virtual environment...
 call "%VENV_PATH%\Scripts\activate.bat"
 
-REM Install dependencies
-echo [SETUP] Installing dependencies...
-pip install --upgrade pip
-pip install -r "%~dp0requirements.txt"
+REM Install dependencies, only when requirements.txt has changed since the last install
+set "STAMP_FILE=%VENV_PATH%\.requirements.sha256"
+for /f %%h in ('python -c "import hashlib, pathlib, sys; print(hashlib.sha256(pathlib.Path(sys.argv[1]).read_bytes() + sys.version.encode()).hexdigest())" "%~dp0requirements.txt"') do set "REQ_HASH=%%h"
+set "OLD_HASH="
+if exist "%STAMP_FILE%" set /p OLD_HASH=<"%STAMP_FILE%"
+
+if not "%OLD_HASH%"=="%REQ_HASH%" (
+    echo [SETUP] Installing dependencies...
+    python -m pip install --upgrade pip
+    pip install -r "%~dp0requirements.txt" && (echo %REQ_HASH%)>"%STAMP_FILE%"
+) else (
+    echo [SETUP] Dependencies up to date
+)
 
 REM Run daemon
 cls
@@ -43,6 +52,6 @@ echo ================================================================
 echo(
 
 echo [RUN] Starting SDCP → Spoolman daemon...
-python "%~dp0daemon.py"
+python "%~dp0daemon.py" %*
 
 endlocal
\ No newline at end of file
@@ -23,10 +23,17 @@ fi
 echo "[SETUP] Activating virtual environment..."
 source "$VENV_PATH/bin/activate"
 
-# Install dependencies
-echo "[SETUP] Installing dependencies..."
-pip install --upgrade pip
-pip install -r "$SCRIPT_DIR/requirements.txt"
+# Install dependencies, only when requirements.txt has changed since the last install
+STAMP_FILE="$VENV_PATH/.requirements.sha256"
+REQ_HASH="$(python -c "import hashlib, pathlib, sys; print(hashlib.sha256(pathlib.Path(sys.argv[1]).read_bytes() + sys.version.encode()).hexdigest())" "$SCRIPT_DIR/requirements.txt")"
+
+if [ ! -f "$STAMP_FILE" ] || [ "$(cat "$STAMP_FILE")" != "$REQ_HASH" ]; then
+    echo "[SETUP] Installing dependencies..."
+    pip install --upgrade pip
+    pip install -r "$SCRIPT_DIR/requirements.txt" && echo "$REQ_HASH" > "$STAMP_FILE"
+else
+    echo "[SETUP] Dependencies up to date"
+fi
 
 # Run daemon
 
@@ -44,4 +51,4 @@ cat << "EOF"
 ================================================================
 EOF
 echo "[RUN] Starting SDCP → Spoolman daemon..."
-python "$SCRIPT_DIR/daemon.py"
\ No newline at end of file
+python "$SCRIPT_DIR/daemon.py" "$@"
\ No newline at end of file
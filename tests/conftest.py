@@ -0,0 +1,25 @@
+import asyncio
+import os
+import sys
+import time
+
+# daemon.py and benchmark.py are scripts next to this folder, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_spool(spool_id, vendor, material, color, remaining=1000.0, filament_id=None, vendor_id=1):
+    return {
+        "id": spool_id,
+        "filament": {"id": filament_id or spool_id, "name": color, "material": material, "vendor": {"id": vendor_id, "name": vendor}},
+        "remaining_weight": remaining,
+        "used_weight": 0.0,
+        "archived": False,
+    }
+
+
+async def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for condition")
+        await asyncio.sleep(0.01)
@@ -0,0 +1,219 @@
+"""
+DeductionQueue: what load() rebuilds from the journal after a restart, and how draining and compaction change it.
+"""
+import asyncio
+import json
+
+import pytest
+
+import daemon
+from benchmark import FakeSpoolman
+from conftest import make_spool
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "deductions.jsonl")
+
+
+def write_lines(path, entries):
+    with open(path, "a") as f:
+        for entry in entries:
+            f.write((entry if isinstance(entry, str) else json.dumps(entry)) + "\n")
+
+
+def test_replay_keeps_only_what_is_owed(journal):
+    write_lines(journal, [
+        {"op": "add", "id": "a", "job": "one.gcode", "spool_id": 1, "grams": 5.0, "ts": 1},
+        {"op": "add", "id": "b", "job": "one.gcode", "spool_id": 2, "grams": 2.5, "ts": 1},
+        {"op": "add", "id": "c", "job": "two.gcode", "spool_id": 9, "grams": 1.0, "ts": 2},
+        {"op": "done", "id": "a"},
+        {"op": "dead", "id": "c", "status": 404, "job": "two.gcode", "spool_id": 9, "grams": 1.0, "ts": 2},
+        '{"op": "add", "id": "d", "job": "thr',  # half written line from a crash
+    ])
+
+    queue = daemon.DeductionQueue(journal)
+    pending = queue.load()
+
+    assert list(pending) == ["b"]
+    assert list(queue.dead) == ["c"]
+    assert queue.lines == 6
+
+
+def test_sessions_and_ledger_survive_a_restart(journal, tmp_path):
+    session = {"printer": "p", "job": "one.gcode", "task_id": "t1", "deducted": [["ELEGOO - PLA - Black", 1, 5.0]]}
+
+    async def enqueue():
+        queue = daemon.DeductionQueue(journal)
+        await queue.enqueue("one.gcode", [(1, 5.0), (2, 1.0)], session=session, ledger=["p|t1"])
+        await queue.enqueue("two.gcode", [], ledger=["p|t2"])  # nothing matched a spool, still charged
+
+    asyncio.run(enqueue())
+
+    queue = daemon.DeductionQueue(journal)
+    queue.load()
+    assert len(queue.pending) == 2
+    assert queue.sessions == [session]
+    assert queue.charged == {"p|t1", "p|t2"}
+
+    # The print sessions file never got saved, the journal still knows the print was charged
+    sessions = daemon.PrintSessions(str(tmp_path / "sessions.json"))
+    sessions.load()
+    sessions.recover(queue.sessions)
+    assert sessions.already_charged("p", "one.gcode", "t1")
+
+
+def test_compaction_keeps_pending_rejected_and_ledger(journal):
+    write_lines(journal, [{"op": "add", "id": str(i), "job": "j", "spool_id": 1, "grams": 1.0, "ts": i, "ledger": [f"p|{i}"]} for i in range(300)])
+    write_lines(journal, [{"op": "done", "id": str(i)} for i in range(298)])
+    write_lines(journal, [{"op": "dead", "id": "298", "status": 404, "job": "j", "spool_id": 1, "grams": 1.0, "ts": 298}])
+
+    queue = daemon.DeductionQueue(journal)
+    queue.load()
+    queue.compact()
+
+    with open(journal) as f:
+        assert sum(1 for _ in f) == 3
+    replayed = daemon.DeductionQueue(journal)
+    replayed.load()
+    assert list(replayed.pending) == ["299"]
+    assert list(replayed.dead) == ["298"]
+    assert replayed.charged == {f"p|{i}" for i in range(300)}
+
+
+def test_drain_marks_done_and_dead_letters_rejections(journal, monkeypatch):
+    with FakeSpoolman([make_spool(1, "ELEGOO", "PLA", "Black")]) as fake:
+        client = daemon.SpoolmanClient([fake.url])
+        monkeypatch.setattr(daemon, "spoolman", client)
+
+        async def drain():
+            queue = daemon.DeductionQueue(journal)
+            await queue.enqueue("one.gcode", [(1, 4.0), (1, 1.5), (42, 3.0)])  # spool 42 doesn't exist
+            return await queue.drain_once()
+
+        try:
+            assert asyncio.run(drain())
+        finally:
+            client.close()
+
+        assert len(fake.uses) == 1  # both deductions for spool 1 in one /use
+        assert fake.spools[1]["used_weight"] == 5.5
+
+    queue = daemon.DeductionQueue(journal)
+    queue.load()
+    assert not queue.pending
+    assert [entry["spool_id"] for entry in queue.dead.values()] == [42]
+
+
+def test_unreachable_spoolman_stays_pending(journal, monkeypatch):
+    with FakeSpoolman([]) as fake:
+        url = fake.url  # nothing listens here once the fake is gone
+    client = daemon.SpoolmanClient([url], timeout=1, retries=0)
+    monkeypatch.setattr(daemon, "spoolman", client)
+
+    async def drain():
+        queue = daemon.DeductionQueue(journal)
+        await queue.enqueue("one.gcode", [(1, 4.0)])
+        return await queue.drain_once()
+
+    try:
+        assert not asyncio.run(drain())
+    finally:
+        client.close()
+
+    queue = daemon.DeductionQueue(journal)
+    queue.load()
+    assert [entry["spool_id"] for entry in queue.pending.values()] == [1]
+    assert not queue.dead
+
+
+@pytest.fixture
+def late_spoolman(monkeypatch):
+    """
+    Applies every /use and only then answers, after the client has given up waiting.
+    """
+    with FakeSpoolman([make_spool(1, "ELEGOO", "PLA", "Black")], late_reply=1.0) as fake:
+        client = daemon.SpoolmanClient([fake.url], timeout=0.3, retries=0)
+        cache = daemon.SpoolCache(client)
+        cache.load([dict(spool) for spool in fake.spools.values()])
+        monkeypatch.setattr(daemon, "spoolman", client)
+        monkeypatch.setattr(daemon, "spool_cache", cache)
+        yield fake
+        client.close()
+
+
+def test_unanswered_deduction_is_not_sent_twice(journal, late_spoolman):
+    async def first_try():
+        queue = daemon.DeductionQueue(journal)
+        await queue.enqueue("one.gcode", [(1, 10.0)])
+        return await queue.drain_once()
+
+    assert not asyncio.run(first_try())
+    assert len(late_spoolman.uses) == 1
+
+    # Picked up again after a restart: Spoolman is asked whether it took it, not sent it again
+    async def restart():
+        queue = daemon.DeductionQueue(journal)
+        queue.load()
+        assert all("unanswered" in entry for entry in queue.pending.values())
+        for _ in range(5):
+            assert await queue.drain_once()
+        return queue
+
+    queue = asyncio.run(restart())
+    assert not queue.pending
+    assert len(late_spoolman.uses) == 1
+    assert late_spoolman.spools[1]["used_weight"] == 10.0
+
+
+def test_unanswered_deduction_that_was_not_taken_is_sent_again(journal, late_spoolman):
+    late_spoolman.late_reply = 0
+    write_lines(journal, [
+        {"op": "add", "id": "a", "job": "one.gcode", "spool_id": 1, "grams": 10.0, "ts": 1},
+        {"op": "unanswered", "ids": ["a"], "spool_id": 1, "grams": 10.0, "used_weight": 0.0, "batch": "x"},
+    ])
+
+    async def drain():
+        queue = daemon.DeductionQueue(journal)
+        queue.load()
+        assert await queue.drain_once()
+        return queue
+
+    assert not asyncio.run(drain()).pending
+    assert len(late_spoolman.uses) == 1
+    assert late_spoolman.spools[1]["used_weight"] == 10.0
+
+
+def test_unanswered_refund_is_checked_the_other_way(journal, late_spoolman):
+    late_spoolman.spools[1]["used_weight"] = 20.0
+    write_lines(journal, [
+        {"op": "add", "id": "a", "job": "one.gcode", "spool_id": 1, "grams": -5.0, "ts": 1},
+        {"op": "unanswered", "ids": ["a"], "spool_id": 1, "grams": -5.0, "used_weight": 25.0, "batch": "x"},
+    ])
+
+    async def drain():
+        queue = daemon.DeductionQueue(journal)
+        queue.load()
+        assert await queue.drain_once()
+        return queue
+
+    assert not asyncio.run(drain()).pending
+    assert not late_spoolman.uses  # used_weight already came down by 5 g
+
+
+def test_unanswered_without_a_known_used_weight_is_dead_lettered(journal, late_spoolman):
+    write_lines(journal, [
+        {"op": "add", "id": "a", "job": "one.gcode", "spool_id": 1, "grams": 10.0, "ts": 1},
+        {"op": "unanswered", "ids": ["a"], "spool_id": 1, "grams": 10.0, "used_weight": None, "batch": "x"},
+    ])
+
+    async def drain():
+        queue = daemon.DeductionQueue(journal)
+        queue.load()
+        assert await queue.drain_once()
+        return queue
+
+    queue = asyncio.run(drain())
+    assert not queue.pending
+    assert list(queue.dead) == ["a"]
+    assert not late_spoolman.uses
@@ -0,0 +1,65 @@
+"""
+The plain, gzip and binary (.bgcode) G-code readers all give the same metadata.
+"""
+import gzip
+
+import pytest
+
+import daemon
+from benchmark import write_synthetic_bgcode, write_synthetic_gcode, write_synthetic_gcode_gz
+
+PRESETS = ["ELEGOO - PLA - Black", "Sunlu - PETG - Red"]
+GRAMS = [12.5, 3.25]
+WRITERS = {
+    "plate.gcode": (write_synthetic_gcode, "text"),
+    "plate.gcode.gz": (write_synthetic_gcode_gz, "gzip"),
+    "plate.bgcode": (write_synthetic_bgcode, "bgcode"),
+}
+
+
+@pytest.mark.parametrize("name", list(WRITERS))
+def test_formats_parse_the_same(tmp_path, name):
+    writer, fmt = WRITERS[name]
+    path = str(tmp_path / name)
+    writer(path, 0.2, PRESETS, GRAMS)
+
+    assert daemon.detect_gcode_format(path) == fmt
+    meta = daemon.parse_gcode_metadata(path)
+    assert meta["filament_presets"] == PRESETS
+    assert meta["filament_g_list"] == GRAMS
+    assert meta["path"] == path
+
+
+def test_gzip_reader_counts_compressed_bytes(tmp_path):
+    path = tmp_path / "plate.gcode.gz"
+    write_synthetic_gcode_gz(str(path), 0.2, PRESETS, GRAMS)
+
+    presets, grams, bytes_read = daemon.scan_gcode_gzip(str(path))
+    assert (presets, grams) == (PRESETS, GRAMS)
+    assert 0 < bytes_read <= path.stat().st_size
+
+
+def test_gzip_without_metadata(tmp_path):
+    path = str(tmp_path / "empty.gcode.gz")
+    with gzip.open(path, "wt") as f:
+        f.write("G28\nG1 X10 Y10\n")
+
+    presets, grams, _ = daemon.scan_gcode_gzip(path)
+    assert not presets and not grams
+
+
+def test_bgcode_reader_stops_at_the_gcode_blocks(tmp_path):
+    path = str(tmp_path / "plate.bgcode")
+    write_synthetic_bgcode(path, 1, PRESETS, GRAMS)
+
+    presets, grams, bytes_read = daemon.scan_gcode_binary(path)
+    assert (presets, grams) == (PRESETS, GRAMS)
+    assert bytes_read < (tmp_path / "plate.bgcode").stat().st_size
+
+
+def test_bgcode_with_a_bad_header(tmp_path):
+    path = tmp_path / "broken.bgcode"
+    path.write_bytes(daemon.BGCODE_MAGIC + b"\x00" * 3)
+
+    presets, grams, _ = daemon.scan_gcode_binary(str(path))
+    assert presets is None and grams is None
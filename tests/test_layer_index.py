@@ -0,0 +1,80 @@
+"""
+The layer usage index behind partial charges: which extrusion counts towards a layer, and how it is scaled to the slicer's grams.
+"""
+import gzip
+
+import pytest
+
+import daemon
+
+PRESET = "ELEGOO - PLA - Black"
+
+
+def write_layers(path, layers=10, mm_per_layer=20.0, grams=10.0, extra_header="", config=""):
+    """
+    A relative extrusion G-code: a purge line, then layers of the same length, then the slicer's totals and config block.
+    """
+    lines = ["; HEADER_BLOCK_START", "; total layer number: %d" % layers, "; HEADER_BLOCK_END", extra_header, "M83", "G92 E0"]
+    for layer in range(layers):
+        lines += [";LAYER_CHANGE", ";Z:%.1f" % (layer * 0.2), "G1 Z%.1f F600" % (layer * 0.2)]
+        lines += ["G1 X10 Y10 E%.3f" % (mm_per_layer / 2), "G1 X20 Y10 E%.3f ; perimeter" % (mm_per_layer / 2)]
+        lines += ["G1 E-0.8 F2100", "G1 E0.8 F2100"]  # retract and prime, nets out
+    lines += ["; filament used [g] = %.2f" % grams, "; CONFIG_BLOCK_START", config, '; filament_settings_id = "%s"' % PRESET, "; CONFIG_BLOCK_END"]
+    text = "\n".join(lines) + "\n"
+    if path.endswith(".gz"):
+        with gzip.open(path, "wt") as f:
+            f.write(text)
+    else:
+        with open(path, "w") as f:
+            f.write(text)
+
+
+@pytest.fixture
+def index(tmp_path):
+    return daemon.LayerIndex(str(tmp_path / "layers"), enabled=True)
+
+
+def test_usage_is_proportional_to_the_layers_printed(tmp_path, index):
+    path = str(tmp_path / "plate.gcode")
+    write_layers(path)
+
+    assert index.build("plate.gcode", path) == 10
+    assert index.usage_at("plate.gcode", 5) == {PRESET: pytest.approx(5.0, abs=0.01)}
+    assert index.usage_at("plate.gcode", 10) == {PRESET: pytest.approx(10.0, abs=0.01)}
+
+
+def test_machine_limits_and_config_templates_are_not_extrusion(tmp_path, index):
+    path = str(tmp_path / "plate.gcode")
+    write_layers(
+        path,
+        extra_header="M201 X20000 Y20000 Z500 E5000\nM203 X500 Y500 Z12 E30\nM205 X10 Y10 Z0.2 E2.5",
+        config="; machine_start_gcode = G28\\nG1 X0 Y0 E25 F1200\\nG92 E0\n"
+               "; machine_end_gcode = G1 E-5 F1800\\nM104 S0\n"
+               "; retract_length = 0.8\n; G1 E99 commented out move",
+    )
+
+    index.build("plate.gcode", path)
+    assert index.usage_at("plate.gcode", 5) == {PRESET: pytest.approx(5.0, abs=0.01)}
+
+
+def test_absolute_extrusion_and_resets(tmp_path, index):
+    path = str(tmp_path / "plate.gcode.gz")
+    lines = ["M82", "G92 E0"]
+    for _ in range(4):
+        lines += [";LAYER_CHANGE", "G1 X1 Y1 E5", "G1 X2 Y1 E10", "G92 E0 ; reset"]
+    lines += ["; filament used [g] = 4.00", '; filament_settings_id = "%s"' % PRESET]
+    with gzip.open(path, "wt") as f:
+        f.write("\n".join(lines) + "\n")
+
+    assert index.build("plate.gcode.gz", path) == 4
+    assert index.usage_at("plate.gcode.gz", 1) == {PRESET: pytest.approx(1.0, abs=0.01)}
+    assert index.usage_at("plate.gcode.gz", 3) == {PRESET: pytest.approx(3.0, abs=0.01)}
+
+
+def test_no_layers_no_index(tmp_path, index):
+    path = str(tmp_path / "plate.gcode")
+    with open(path, "w") as f:
+        f.write("G28\nG1 X10 E5\n; filament used [g] = 1.00\n")
+
+    assert index.build("plate.gcode", path) == 0
+    assert index.usage_at("plate.gcode", 1) is None
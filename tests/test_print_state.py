@@ -0,0 +1,69 @@
+"""
+SdcpPrintState: the status codes one printer reports, turned into print start / end actions.
+"""
+import daemon
+
+PRINTING = 13
+IDLE = 1
+STOPPING = 8
+
+
+def feed_all(state, updates):
+    actions = []
+    for update in updates:
+        actions.extend(state.feed(*update))
+    return actions
+
+
+def test_full_print_in_always_running_mode():
+    state = daemon.SdcpPrintState(always_running=True)
+    actions = feed_all(state, [
+        (IDLE, "plate.gcode", None),
+        (PRINTING, "plate.gcode", "t1", 1, 100),
+        (PRINTING, "plate.gcode", "t1", 50, 100),
+        (PRINTING, "plate.gcode", "t1", 100, 100),
+        (IDLE, "plate.gcode", "t1"),
+    ])
+    assert actions == [
+        ("idle",),
+        ("start", "plate.gcode", "t1"),
+        ("ended",),
+        ("idle",),
+        ("finished", ("plate.gcode", "t1"), 100, 100),
+    ]
+    assert not state.print_active and not state.waiting_for_idle
+
+
+def test_repeated_printing_status_starts_once():
+    state = daemon.SdcpPrintState()
+    actions = feed_all(state, [(PRINTING, "plate.gcode", "t1", layer, 10) for layer in range(1, 6)])
+    assert actions == [("start", "plate.gcode", "t1")]
+
+
+def test_stopped_print_keeps_the_last_printing_layer():
+    state = daemon.SdcpPrintState()
+    actions = feed_all(state, [
+        (PRINTING, "plate.gcode", "t1", 40, 100),
+        (STOPPING, "plate.gcode", "t1", 0, 100),  # some firmware resets CurrentLayer once stopped
+        (IDLE, "plate.gcode", "t1", 0, 100),
+    ])
+    assert ("finished", ("plate.gcode", "t1"), 40, 100) in actions
+
+
+def test_one_time_mode_exits_after_the_print():
+    state = daemon.SdcpPrintState(always_running=False)
+    actions = feed_all(state, [(PRINTING, "plate.gcode", "t1"), (IDLE, "plate.gcode", "t1")])
+    assert actions[-1] == ("exit",)
+
+
+def test_resumed_print_keeps_its_layers():
+    state = daemon.SdcpPrintState()
+    feed_all(state, [(PRINTING, "plate.gcode", "t1", 30, 100), (STOPPING, "plate.gcode", "t1")])
+    # Back to printing the same task (paused and resumed), the start is reported again but the layers carry over
+    actions = state.feed(PRINTING, "plate.gcode", "t1")
+    assert actions == [("start", "plate.gcode", "t1")]
+    assert (state.layer, state.total_layers) == (30, 100)
+
+    state.feed(STOPPING, "next.gcode", "t2")
+    state.feed(PRINTING, "next.gcode", "t2")
+    assert state.layer is None
@@ -0,0 +1,69 @@
+"""
+aggregate_usage: many prints summed into one deduction per spool, and the helpers --reconcile uses to line files up with the history.
+"""
+import pytest
+
+import daemon
+from conftest import make_spool
+
+
+@pytest.fixture
+def spools(monkeypatch):
+    cache = daemon.SpoolCache(None)
+    cache.load([
+        make_spool(1, "ELEGOO", "PLA", "Black"),
+        make_spool(2, "Sunlu", "PETG", "Red", vendor_id=2),
+    ])
+    monkeypatch.setattr(daemon, "spool_cache", cache)
+    return cache
+
+
+def test_usage_is_summed_per_spool(spools):
+    per_spool, prints, unmatched = daemon.aggregate_usage([
+        (["ELEGOO - PLA - Black", "Sunlu - PETG - Red"], [10.0, 2.5]),
+        (["ELEGOO - PLA - Black"], [4.0]),
+        (["Sunlu - PETG - Red", "Sunlu - PETG - Red"], [1.0, 1.0]),  # same preset on two extruders
+    ])
+
+    assert per_spool == {1: 14.0, 2: 4.5}
+    assert prints == {1: 2, 2: 2}
+    assert unmatched == {}
+
+
+def test_unmatched_presets_are_reported_not_charged(spools):
+    per_spool, prints, unmatched = daemon.aggregate_usage([
+        (["ELEGOO - PLA - Black", "Nobody - ABS - Pink"], [3.0, 7.0]),
+        (["Nobody - ABS - Pink"], [2.0]),
+    ])
+
+    assert per_spool == {1: 3.0}
+    assert prints == {1: 1}
+    assert unmatched == {"Nobody - ABS - Pink": 9.0}
+
+
+def test_presets_and_grams_of_different_lengths(spools):
+    # A slicer that lists more presets than it has usage for, only the pairs count
+    per_spool, _, _ = daemon.aggregate_usage([(["ELEGOO - PLA - Black", "Sunlu - PETG - Red"], [6.0])])
+    assert per_spool == {1: 6.0}
+
+
+def test_no_prints(spools):
+    assert daemon.aggregate_usage([]) == ({}, {}, {})
+
+
+@pytest.mark.parametrize("filename, name", [
+    ("/local/plate.gcode", "plate.gcode"),
+    ("C:\\exports\\plate.gcode", "plate.gcode"),
+    ("plate.gcode.gz", "plate.gcode"),
+    ("plate.bgcode", "plate.bgcode"),
+])
+def test_reconcile_name(filename, name):
+    assert daemon.reconcile_name(filename) == name
+
+
+def test_history_entries_are_normalized():
+    entry = daemon.normalize_history_entry({
+        "TaskId": "t1", "TaskName": "/local/plate.gcode", "BeginTime": 100, "EndTime": 200, "TaskStatus": 3, "AlreadyPrintLayer": 42,
+    })
+    assert entry == {"task_id": "t1", "filename": "/local/plate.gcode", "begin": 100, "end": 200, "status": 3, "layer": 42}
+    assert daemon.normalize_history_entry(entry) is entry
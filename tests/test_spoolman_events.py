@@ -0,0 +1,94 @@
+"""
+The spool cache subscribed to the fake Spoolman's change event websocket: edits made in Spoolman reach the matcher without a refresh.
+"""
+import asyncio
+
+import pytest
+
+import daemon
+from benchmark import FakeSpoolman, FakeSpoolmanEvents
+from conftest import make_spool, wait_for
+
+
+@pytest.fixture
+def spoolman(monkeypatch):
+    spools = [
+        make_spool(1, "ELEGOO", "PLA", "Black", remaining=800.0),
+        make_spool(2, "ELEGOO", "PLA", "Black", remaining=300.0),
+        make_spool(3, "Sunlu", "PETG", "Red", filament_id=30, vendor_id=2),
+    ]
+    with FakeSpoolman(spools) as fake:
+        client = daemon.SpoolmanClient([fake.url])
+        monkeypatch.setattr(daemon, "spoolman", client)
+        monkeypatch.setattr(daemon, "spool_cache", daemon.SpoolCache(client, ttl=3600))
+        monkeypatch.setattr(daemon, "SPOOLMAN_EVENTS_URL", None)  # set by run_subscribed
+        yield fake
+        client.close()
+
+
+def run_subscribed(fake, scenario):
+    """
+    Runs scenario(events) with the spool cache subscribed to fake's change events.
+    """
+    async def run():
+        async with FakeSpoolmanEvents(fake) as events:
+            daemon.SPOOLMAN_EVENTS_URL = events.url
+            watcher = asyncio.create_task(daemon.spool_cache.watch_events())
+            try:
+                await wait_for(lambda: daemon.spool_cache.subscribed)
+                await scenario(events)
+            finally:
+                watcher.cancel()
+                await asyncio.gather(watcher, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_archived_spool_is_no_longer_matched(spoolman):
+    async def scenario(events):
+        matched = daemon.find_spool_for_preset("ELEGOO - PLA - Black")
+        assert matched in (1, 2)
+        before = spoolman.requests
+
+        spoolman.edit_spool(matched, archived=True)
+        await wait_for(lambda: daemon.find_spool_for_preset("ELEGOO - PLA - Black") != matched)
+
+        assert daemon.find_spool_for_preset("ELEGOO - PLA - Black") == 3 - matched
+        assert spoolman.requests == before  # applied from the event, no refresh
+
+    run_subscribed(spoolman, scenario)
+
+
+def test_filament_and_delete_events_update_the_index(spoolman):
+    async def scenario(events):
+        assert daemon.find_spool_for_preset("Sunlu - PETG - Red") == 3
+
+        # Renamed in Spoolman: every spool embedding the filament follows
+        spoolman.publish("filament", "updated", {"id": 30, "name": "Blue", "material": "PETG", "vendor": {"id": 2, "name": "Sunlu"}})
+        await wait_for(lambda: daemon.find_spool_for_preset("Sunlu - PETG - Blue") == 3)
+        assert daemon.find_spool_for_preset("Sunlu - PETG - Red") is None
+
+        spoolman.publish("spool", "deleted", {"id": 3})
+        await wait_for(lambda: 3 not in daemon.spool_cache.by_id)
+        assert daemon.find_spool_for_preset("Sunlu - PETG - Blue") is None
+
+    run_subscribed(spoolman, scenario)
+
+
+def test_deduction_is_reflected_in_the_cache(spoolman):
+    async def scenario(events):
+        assert await daemon.deduct_filament([(1, 12.5)]) == [True]
+        await wait_for(lambda: daemon.spool_cache.by_id[1]["remaining_weight"] == 787.5)
+
+    run_subscribed(spoolman, scenario)
+
+
+def test_dropped_subscription_falls_back_to_polling(spoolman):
+    async def scenario(events):
+        assert not daemon.spool_cache.is_stale()
+        await events.drop_clients()
+        await wait_for(lambda: not daemon.spool_cache.subscribed)
+        # Events may have been missed, so the next print start refreshes first
+        assert daemon.spool_cache.is_stale()
+
+    run_subscribed(spoolman, scenario)